@@ -25,7 +25,12 @@ from mne.preprocessing import find_bad_channels_maxwell
 import matplotlib.pyplot as plt
 
 from config import site_id, subject_id, data_path, file_names, out_path
-from config import cal_path, method, st_duration
+from config import cal_path, method, st_duration, sss_buffer_duration
+from config import n_jobs, max_mem_per_job, psd_method
+from parallel import run_parallel
+from cache import file_hash, make_key, cache_fname, atomic_open
+from sss_basis import maxwell_filter_cached
+from psd import compute_psd, plot_psd
 
 
 def run_maxwell_filter(method = 'sss'):
@@ -33,122 +38,36 @@ def run_maxwell_filter(method = 'sss'):
     # sys.stdout = open(op.join(out_path,     # open log file
     # os.path.basename(__file__) + "_%s.txt" % (site_id+subject_id)),'w')
     
-    # Load the fine calibration file (which encodes site-specific information 
-    # about sensor orientation and calibration) as well as a crosstalk 
-    # compensation file (which reduces interference between Elekta’s co-located
-    # magnetometer and paired gradiometer sensor units)
-    crosstalk_file = op.join(cal_path, "ct_sparse_" + site_id + ".fif")
-    fine_cal_file = op.join(cal_path, "sss_cal_" + site_id + ".dat")
-    
-    # Create empty dataframe for bad channel list
-    df = pd.DataFrame()
-    
     # Prepare PDF report
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     
     print("Processing subject: %s" % subject_id)
-    run = 0
-    for file_name in file_names:
-        run = run + 1
-        print("  File: %s" % file_name)
-        
-        # Read raw data
-        raw_fname_in = op.join(data_path, file_name + '.fif')
-        raw = mne.io.read_raw_fif(
-            raw_fname_in,
-            allow_maxshield=True,
-            preload=False,
-            verbose=True)
-        
-        # Detect bad channels
-        raw.info['bads'] = []
-        raw_check = raw.copy()
-        auto_noisy_chs, auto_flat_chs, auto_scores = find_bad_channels_maxwell(
-            raw_check, 
-            cross_talk=crosstalk_file, 
-            calibration=fine_cal_file,
-            return_scores=True,
-            verbose=True)
-        raw.info['bads'].extend(auto_noisy_chs + auto_flat_chs)
-        
-        # Append bad channels to the list 
-        df = df.append({'run': run,
-                        'noisy': auto_noisy_chs, 
-                        'flat': auto_flat_chs},
-                        ignore_index=True)        
-        
-        # Visualize the scoring used to classify channels as noisy or flat
-        ch_type = 'grad'
-        fig = viz_badch_scores(auto_scores, ch_type)
-        fname_fig = op.join(out_path,
-                            "01_r%s_badchannels_%sscore.png" % (run,ch_type))
-        fig.savefig(fname_fig)
-        plt.close()
-        ch_type = 'mag'
-        fig = viz_badch_scores(auto_scores, ch_type)
-        fname_fig = op.join(out_path,
-                            "01_r%s_badchannels_%sscore.png" % (run,ch_type))
-        fig.savefig(fname_fig)
-        plt.close()
-        
-        # Fix Elekta magnetometer coil types
-        raw.fix_mag_coil_types()
-        
-        # Perform tSSS/SSS and Maxwell filtering
-        raw_sss = mne.preprocessing.maxwell_filter(
-            raw,
-            cross_talk=crosstalk_file,
-            calibration=fine_cal_file,
-            st_duration=st_duration,
-            #coord_frame="meg", #only for empy room, comment it if using HPI
-            verbose=True)
-        
-        # Show original and filtered signals
-        fig = raw.copy().pick(['meg']).plot(duration=5,
-                                            start=100,
-                                            butterfly=True)        
-        fname_fig = op.join(out_path,
-                            '01_r%s_plotraw.png' % run)
-        fig.savefig(fname_fig)
-        plt.close()
-        fig = raw_sss.copy().pick(['meg']).plot(duration=5,
-                                                start=100,
-                                                butterfly=True)
-        fname_fig = op.join(out_path,
-                            '01_r%s_plotraw%s.png' % (run,method))
-        fig.savefig(fname_fig)
-        plt.close()
-        
-        # Show original and filtered power
-        fig1 = raw.plot_psd(picks = ['meg'],fmin = 1,fmax = 100)
-        fname_fig1 = op.join(out_path,
-                            '01_r%s_plot_psd_raw100.png' % run)
-        fig1.savefig(fname_fig1)
-        plt.close()
-        fig2 = raw_sss.plot_psd(picks = ['meg'],fmin = 1,fmax = 100)
-        fname_fig2 = op.join(out_path,
-                            '01_r%s_plot_psd_raw100%s.png' % (run,method))
-        fig2.savefig(fname_fig2)
-        plt.close()
+    
+    # Maxwell filter each run (in parallel worker processes if n_jobs > 1)
+    jobs = [(run, file_name, method) 
+            for run, file_name in enumerate(file_names, start=1)]
+    results = run_parallel(maxwell_filter_run, 
+                           jobs,
+                           n_jobs=n_jobs,
+                           max_mem=max_mem_per_job)
+    
+    # Merge the per-run results in run order
+    for result in results:
         
         # Add figures to report
         pdf.add_page()
         pdf.set_font('helvetica', 'B', 16)
-        pdf.cell(0, 10, file_name)
+        pdf.cell(0, 10, result['file_name'])
         pdf.ln(20)
         pdf.set_font('helvetica', 'B', 12)
         pdf.cell(0, 10, 'Power Spectrum of Raw MEG Data', 'B', ln=1)
-        pdf.image(fname_fig1, 0, 45, pdf.epw)
+        pdf.image(result['fname_fig1'], 0, 45, pdf.epw)
         pdf.ln(120)
         pdf.cell(0, 10, 'Power Spectrum of Filtered MEG Data', 'B', ln=1)
-        pdf.image(fname_fig2, 0, 175, pdf.epw)
-        
-        # Save filtered data
-        fname_out = op.join(out_path,
-                            file_name + '_' + method + '.fif')
-        raw_sss.save(fname_out, overwrite=True)
+        pdf.image(result['fname_fig2'], 0, 175, pdf.epw)
         
-    # Save bad channel list
+    # Make and save bad channel list (one row per run)
+    df = pd.DataFrame([result['badch'] for result in results])
     df.to_csv(op.join(out_path,
                       '01_rAll_meg_badch_list.csv'),
               index=False)
@@ -161,6 +80,236 @@ def run_maxwell_filter(method = 'sss'):
     # sys.stdout = stdout_obj # restore command prompt
 
 
+def maxwell_filter_run(run, file_name, method = 'sss'):
+    '''
+    Detect bad channels and Maxwell filter a single run. Returns the bad 
+    channel row and the figures to be added to the report.
+    '''
+    
+    # Load the fine calibration file (which encodes site-specific information 
+    # about sensor orientation and calibration) as well as a crosstalk 
+    # compensation file (which reduces interference between Elekta’s co-located
+    # magnetometer and paired gradiometer sensor units)
+    crosstalk_file = op.join(cal_path, "ct_sparse_" + site_id + ".fif")
+    fine_cal_file = op.join(cal_path, "sss_cal_" + site_id + ".dat")
+    
+    print("  File: %s" % file_name)
+    
+    # Read raw data
+    raw_fname_in = op.join(data_path, file_name + '.fif')
+    raw = mne.io.read_raw_fif(
+        raw_fname_in,
+        allow_maxshield=True,
+        preload=False,
+        verbose=True)
+    
+    # Detect bad channels (or read them from the cache)
+    raw.info['bads'] = []
+    auto_noisy_chs, auto_flat_chs, auto_scores = find_bad_channels_cached(
+        raw,
+        raw_fname_in,
+        crosstalk_file,
+        fine_cal_file)
+    raw.info['bads'].extend(auto_noisy_chs + auto_flat_chs)
+    
+    # Visualize the scoring used to classify channels as noisy or flat
+    ch_type = 'grad'
+    fig = viz_badch_scores(auto_scores, ch_type)
+    fname_fig = op.join(out_path,
+                        "01_r%s_badchannels_%sscore.png" % (run,ch_type))
+    fig.savefig(fname_fig)
+    plt.close()
+    ch_type = 'mag'
+    fig = viz_badch_scores(auto_scores, ch_type)
+    fname_fig = op.join(out_path,
+                        "01_r%s_badchannels_%sscore.png" % (run,ch_type))
+    fig.savefig(fname_fig)
+    plt.close()
+    
+    # Fix Elekta magnetometer coil types
+    raw.fix_mag_coil_types()
+    
+    # Perform tSSS/SSS and Maxwell filtering and save filtered data
+    fname_out = op.join(out_path,
+                        file_name + '_' + method + '.fif')
+    if sss_buffer_duration is None:
+        raw_sss = maxwell_filter_cached(
+            raw,
+            cross_talk=crosstalk_file,
+            calibration=fine_cal_file,
+            st_duration=st_duration,
+            #coord_frame="meg", #only for empy room, comment it if using HPI
+            verbose=True)
+        raw_sss.save(fname_out, overwrite=True)
+    else:
+        # Filter the recording buffer by buffer to bound memory usage
+        raw_sss = maxwell_filter_buffered(
+            raw,
+            fname_out,
+            sss_buffer_duration,
+            cross_talk=crosstalk_file,
+            calibration=fine_cal_file,
+            st_duration=st_duration,
+            verbose=True)
+    
+    # Show original and filtered signals
+    fig = raw.copy().pick(['meg']).plot(duration=5,
+                                        start=100,
+                                        butterfly=True)        
+    fname_fig = op.join(out_path,
+                        '01_r%s_plotraw.png' % run)
+    fig.savefig(fname_fig)
+    plt.close()
+    fig = raw_sss.copy().pick(['meg']).plot(duration=5,
+                                            start=100,
+                                            butterfly=True)
+    fname_fig = op.join(out_path,
+                        '01_r%s_plotraw%s.png' % (run,method))
+    fig.savefig(fname_fig)
+    plt.close()
+    
+    # Show original and filtered power (spectra are cached)
+    psds, freqs, _, ch_types = compute_psd(raw, ['meg'],
+                                           fmin=1, fmax=100,
+                                           method=psd_method,
+                                           fname=raw_fname_in)
+    fig1 = plot_psd(psds, freqs, ch_types)
+    fname_fig1 = op.join(out_path,
+                        '01_r%s_plot_psd_raw100.png' % run)
+    fig1.savefig(fname_fig1)
+    plt.close()
+    psds, freqs, _, ch_types = compute_psd(raw_sss, ['meg'],
+                                           fmin=1, fmax=100,
+                                           method=psd_method)
+    fig2 = plot_psd(psds, freqs, ch_types)
+    fname_fig2 = op.join(out_path,
+                        '01_r%s_plot_psd_raw100%s.png' % (run,method))
+    fig2.savefig(fname_fig2)
+    plt.close()
+    
+    return {'file_name': file_name,
+            'badch': {'run': run,
+                      'noisy': auto_noisy_chs, 
+                      'flat': auto_flat_chs},
+            'fname_fig1': fname_fig1,
+            'fname_fig2': fname_fig2}
+
+
+def maxwell_filter_buffered(raw, fname_out, buffer_duration, 
+                            st_duration=None, **kwargs):
+    '''
+    Maxwell filter a (not preloaded) raw in consecutive buffers and save it 
+    to fname_out, so that only one buffer is held in memory at a time. For 
+    tSSS the buffers are aligned to st_duration, so that buffer edges fall on 
+    tSSS window edges. Returns the filtered raw read from fname_out (not 
+    preloaded).
+    '''
+    
+    # Get buffer length in samples
+    sfreq = raw.info['sfreq']
+    if st_duration is not None:
+        buffer_duration = max(round(buffer_duration / st_duration), 1) \
+            * st_duration
+    n_buffer = int(round(buffer_duration * sfreq))
+    
+    # Get buffer limits (a last buffer shorter than the tSSS window is merged 
+    # with the previous one)
+    starts = list(range(0, len(raw.times), n_buffer))
+    if st_duration is not None and len(starts) > 1 and \
+            len(raw.times) - starts[-1] < st_duration * sfreq:
+        starts = starts[:-1]
+    stops = starts[1:] + [len(raw.times)]
+    
+    # Filter each buffer and save it to a temporary file
+    fnames_buf = []
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        print("    Maxwell filtering buffer %d/%d" % (i+1, len(starts)))
+        raw_buf = raw.copy().crop(tmin=raw.times[start],
+                                  tmax=raw.times[stop-1],
+                                  include_tmax=True)
+        raw_buf.load_data()
+        raw_buf_sss = maxwell_filter_cached(
+            raw_buf,
+            st_duration=st_duration,
+            **kwargs)
+        root, ext = op.splitext(fname_out)
+        fname_buf = root + '-buf%03d' % i + ext
+        raw_buf_sss.save(fname_buf, overwrite=True)
+        fnames_buf.append(fname_buf)
+        del raw_buf, raw_buf_sss
+    
+    # Join the buffers into the output file (saving a not preloaded raw 
+    # reads and writes its data in blocks)
+    raw_sss = mne.concatenate_raws([mne.io.read_raw_fif(fname_buf,
+                                                        preload=False,
+                                                        verbose='error')
+                                    for fname_buf in fnames_buf])
+    
+    # Remove the boundary annotations added by the concatenation
+    boundaries = [i for i, desc in enumerate(raw_sss.annotations.description)
+                  if desc in ['BAD boundary', 'EDGE boundary']]
+    raw_sss.annotations.delete(boundaries)
+    raw_sss.save(fname_out, overwrite=True)
+    del raw_sss
+    
+    # Remove temporary files
+    for fname_buf in fnames_buf:
+        os.remove(fname_buf)
+    
+    return mne.io.read_raw_fif(fname_out, preload=False, verbose='error')
+
+
+def find_bad_channels_cached(raw, raw_fname, crosstalk_file, fine_cal_file,
+                             limit=7., duration=5., min_count=5, h_freq=40.):
+    '''
+    Run find_bad_channels_maxwell, or read its results from the cache when 
+    the raw, calibration and crosstalk files and the detection parameters 
+    have not changed.
+    '''
+    
+    # Get cache entry of these files and parameters
+    key = make_key(file_hash(raw_fname),
+                   file_hash(crosstalk_file),
+                   file_hash(fine_cal_file),
+                   limit=limit,
+                   duration=duration,
+                   min_count=min_count,
+                   h_freq=h_freq,
+                   mne=mne.__version__)
+    fname_cache = cache_fname('maxwell_badch', key)
+    
+    # Read cached results
+    if op.exists(fname_cache):
+        print("    Reading bad channels from cache: %s" % fname_cache)
+        with np.load(fname_cache) as cached:
+            auto_noisy_chs = cached['noisy'].tolist()
+            auto_flat_chs = cached['flat'].tolist()
+            auto_scores = {k[len('scores-'):]: cached[k] for k in cached.files
+                           if k.startswith('scores-')}
+        return auto_noisy_chs, auto_flat_chs, auto_scores
+    
+    # Detect bad channels
+    auto_noisy_chs, auto_flat_chs, auto_scores = find_bad_channels_maxwell(
+        raw.copy(), 
+        cross_talk=crosstalk_file, 
+        calibration=fine_cal_file,
+        limit=limit,
+        duration=duration,
+        min_count=min_count,
+        h_freq=h_freq,
+        return_scores=True,
+        verbose=True)
+    
+    # Store results in the cache
+    with atomic_open(fname_cache) as f:
+        np.savez(f,
+                 noisy=np.array(auto_noisy_chs, dtype=str),
+                 flat=np.array(auto_flat_chs, dtype=str),
+                 **{'scores-' + k: v for k, v in auto_scores.items()})
+    
+    return auto_noisy_chs, auto_flat_chs, auto_scores
+
+
 def viz_badch_scores(auto_scores, ch_type):
     fig, ax = plt.subplots(1, 4, figsize=(12, 8))
     fig.suptitle(f'Automated noisy/flat channel detection: {ch_type}',
@@ -250,4 +399,5 @@ def viz_badch_scores(auto_scores, ch_type):
 # RUN
 # =============================================================================
 
-run_maxwell_filter(method=method)
+if __name__ == '__main__':
+    run_maxwell_filter(method=method)
@@ -15,214 +15,79 @@ import pandas as pd
 from fpdf import FPDF
 
 import mne
-from mne.time_frequency import psd_multitaper
 import matplotlib.pyplot as plt
 import scipy.stats
 
-from config import site_id, subject_id, file_names, out_path
-from config import no_eeg_sbj, method
+from config import site_id, subject_id, file_exts, out_path
+from config import no_eeg_sbj, method, psd_method
+from config import n_jobs, max_mem_per_job, eeg_batch_subjects
+from config import use_sidecars
+from config import corr_window, corr_bad_fraction
+from psd import compute_psd, plot_psd
+from eeg_criteria import deviation_zscore, lowpass, window_correlation
+from eeg_criteria import band_power
+from eeg_interp import EEGInterpolator
+from eeg_workset import EEGWorkingSet
+from parallel import run_parallel
+from sidecar import write_eeg_operator
 
 
-def find_bad_eeg():
+def find_bad_eeg(subjects=None):
+    '''
+    Find the bad EEG channels of each run of each subject (default: the 
+    subject of config.py), in parallel worker processes if n_jobs > 1.
+    The bad channel lists and the reports of all runs are merged in run 
+    order.
+    '''
     # stdout_obj = sys.stdout                 # store original stdout 
     # sys.stdout = open(op.join(out_path,     # open log file
     #                           os.path.basename(__file__) + "_%s.txt" % (site_id+subject_id)),'w')
     
-    # Create empty dataframe for bad channel list
-    df = pd.DataFrame()
+    # Get subjects
+    if subjects is None:
+        subjects = [subject_id]
+    subjects = [s for s in subjects if s not in no_eeg_sbj]
     
     # Prepare PDF report
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     
-    print("Processing subject: %s" % subject_id)
-    run = 0
-    for file_name in file_names:
-        run = run + 1
-        print("  File: %s" % file_name)
-        
-        # Read raw data
-        raw_fname_in = op.join(out_path,
-                               file_name + '_' + method + '.fif')
-        raw = mne.io.read_raw_fif(
-            raw_fname_in, 
-            preload=True, 
-            verbose='error')
-        
-        # Check if there are EEG data
-        try:
-            raw.copy().pick('eeg')
-        except Exception as e:
-            print(e)
-            raise ValueError("Error: there is no EEG recording for this participant (%s)" % (site_id+subject_id))
-        
-        ##############################################
-        # PHASE 1 : Estimate the true signal average #
-        ##############################################
-        
-        # Select EEG data
-        raw_eeg = raw.copy().pick('eeg')
-        
-        # Reset bads
-        raw_eeg.info['bads'] = []
-        
-        # Plot EEG data
-        fig = raw.copy().pick('eeg').plot(bad_color=(1., 0., 0.),
-                                          scalings = dict(eeg=10e-5),
-                                          duration=5,
-                                          start=100)
-        fname_fig = op.join(out_path,
-                            '02_r%s_bad_egg_0raw.png' % run)
-        fig.savefig(fname_fig)
-        plt.close()
+    # Get the runs of each subject (figures are tagged with the subject 
+    # when there are several)
+    jobs = []
+    for sbj in subjects:
+        for run, file_ext in enumerate(file_exts, start=1):
+            fig_tag = 'r%s' % run
+            if len(subjects) > 1:
+                fig_tag = '%s_%s' % (sbj, fig_tag)
+            jobs.append((sbj, run, file_ext % (site_id+sbj), fig_tag))
+    
+    # Process each run (in parallel worker processes if n_jobs > 1)
+    results = run_parallel(find_bad_eeg_run,
+                           jobs,
+                           n_jobs=n_jobs,
+                           max_mem=max_mem_per_job)
+    
+    # Merge the per-run results in subject and run order
+    for result in results:
         
-        # Plot EEG power spectrum
-        fig1 = viz_psd(raw_eeg)
-        fname_fig1 = op.join(out_path,
-                            '02_r%s_bad_egg_0pow.png' % run)
-        fig1.savefig(fname_fig1)
-        plt.close()
+        # Keep the subject in the bad channel list when there are several
+        if len(subjects) < 2:
+            del result['badch']['subject']
         
-        # Add figure to report
+        # Add figures to report
         pdf.add_page()
         pdf.set_font('helvetica', 'B', 16)
-        pdf.cell(0, 10, file_name)
+        pdf.cell(0, 10, result['file_name'])
         pdf.ln(20)
         pdf.set_font('helvetica', 'B', 12)
         pdf.cell(0, 10, 'Power Spectrum of Raw EEG Data', 'B', ln=1)
-        pdf.image(fname_fig1, 0, 45, pdf.epw)
-        
-        # Init temporary copy of EEG
-        raw_eeg_temp = raw_eeg.copy()
-        
-        # Init average reference
-        ref_temp = np.median(raw_eeg_temp._data.copy(), axis=-2, keepdims=True)
-        
-        # Apply initial average reference
-        raw_eeg_temp._data -= ref_temp
-        
-        # Init bad channel list
-        bad_channels = []
-        
-        # Set max number of iterations and init iteration
-        iteration_max = 100
-        
-        # Detect bad channels and recalculate the reference based on their interpolation
-        for i in range(iteration_max):
-            # Actual bad channel detection
-            bads_temp = []
-            bads_temp = find_bad_channels_eeg(raw_eeg_temp)
-            
-            # Exit loop if no new bad channels are found
-            if all(bad in bad_channels for bad in bads_temp):
-                break
-            else:
-                # Add new bad channel to the list
-                bad_channels += bads_temp
-                
-                # Set bad channels
-                raw_eeg_temp.info['bads'].extend(bads_temp)
-                
-                # Interpolate bad channels from the original data
-                raw_eeg_temp = raw_eeg_temp.interpolate_bads(reset_bads=True)
-                
-                # Get the new average reference
-                ref_temp = raw_eeg_temp._data.copy().mean(-2, keepdims=True)
-                
-                # Get new temp data by removing the new reference from the orignal data
-                raw_eeg_temp._data = raw_eeg._data.copy() - ref_temp
-        
-        # Mark loop bad channels in a new copy of the data
-        raw_eeg_bad = raw_eeg.copy()
-        raw_eeg_bad.info['bads'].extend(bad_channels)
-        
-        # Interpolate loop bad channels
-        raw_eeg_bad = raw_eeg_bad.interpolate_bads(reset_bads=False)
-        
-        # Get the true average reference
-        ref_true = raw_eeg_bad._data.copy().mean(-2, keepdims=True)
-        
-        ############################################################################
-        # PHASE 2 : Find the bad channels relative to true average and interpolate #
-        ############################################################################
-        
-        # Remove true average reference from original EEG data
-        eeg_idx = mne.pick_types(raw.info, meg=False, eeg=True, exclude=[])
-        raw._data[..., eeg_idx, :] -= ref_true
-        
-        # Plot true referenced EEG data
-        fig = raw.copy().pick('eeg').plot(bad_color=(1., 0., 0.),
-                                          scalings = dict(eeg=10e-5),
-                                          duration=5,
-                                          start=100)
-        fname_fig = op.join(out_path,
-                            '02_r%s_bad_egg_1true.png' % run)
-        fig.savefig(fname_fig)
-        plt.close()
-        
-        # Find true bad channels
-        bads_true = find_bad_channels_eeg(raw.copy().pick('eeg'))
-        
-        # Append true bad channels to the list 
-        df = df.append({'run': run,
-                        'bad': bads_true}, 
-                        ignore_index=True)
-        
-        # Mark true bad channels
-        raw.info['bads'].extend(bads_true)
-        
-        # Interpolate true bad channels
-        raw = raw.interpolate_bads(reset_bads=False)
-        
-        # Plot interpolated EEG data
-        fig = raw.copy().pick('eeg').plot(bad_color=(1., 0., 0.),
-                                          scalings = dict(eeg=10e-5),
-                                          duration=5,
-                                          start=100)
-        fname_fig = op.join(out_path,
-                            '02_r%s_bad_egg_2intrp.png' % run)
-        fig.savefig(fname_fig)
-        plt.close()
-        
-        # Remove the new average reference to correct for the previous referencing
-        raw.set_eeg_reference(ref_channels='average', projection=False)  #if projection=True, the reference is added as a projection and is not applied to the data (it can be applied afterwards with the apply_proj method)
-        
-        # Get reference correction
-        ref_corr = raw.copy().pick('eeg')._data.mean(-2, keepdims=True)
-        
-        # Add correction to reference signal stored in raw
-        ref_true += ref_corr  #TODO: where in raw is the ref stored?
-        
-        # Plot referenced EEG data
-        fig = raw.copy().pick('eeg').plot(bad_color=(1., 0., 0.),
-                                          scalings = dict(eeg=10e-5),
-                                          duration=5,
-                                          start=100)
-        fname_fig = op.join(out_path,
-                            '02_r%s_bad_egg_3refer.png' % run)
-        fig.savefig(fname_fig)
-        plt.close()
-        
-        # Plot referenced EEG power spectrum
-        fig2 = viz_psd(raw)
-        fname_fig2 = op.join(out_path,
-                            '02_r%s_bad_egg_Ipow.png' % run)
-        fig2.savefig(fname_fig2)
-        plt.close()
-        
-        # Add figures to report
+        pdf.image(result['fname_fig1'], 0, 45, pdf.epw)
         pdf.ln(120)
         pdf.cell(0, 10, 'Power Spectrum of Filtered EEG Data', 'B', ln=1)
-        pdf.image(fname_fig2, 0, 175, pdf.epw)
+        pdf.image(result['fname_fig2'], 0, 175, pdf.epw)
         
-        # Reset bads
-        raw.info['bads'] = []
-        
-        # Save data
-        fname_out = op.join(out_path,
-                            file_name + '_intpl.fif')
-        raw.save(fname_out, overwrite=True)
-        
-    # Save bad channel list
+    # Make and save bad channel list (one row per run)
+    df = pd.DataFrame([result['badch'] for result in results])
     df.to_csv(op.join(out_path,
                       '02_rAll_eeg_badch_list.csv'),
               index=False)
@@ -235,29 +100,213 @@ def find_bad_eeg():
     # sys.stdout = stdout_obj # restore command prompt
 
 
-def find_bad_channels_eeg(raw):
+def find_bad_eeg_run(sbj, run, file_name, fig_tag):
+    '''
+    Find and interpolate the bad EEG channels of a run and save the 
+    interpolated data (or the operator applied to the EEG data). Returns
+    the bad channel list entry and the power spectrum figures of the run.
+    '''
+    print("Processing subject: %s" % sbj)
+    print("  File: %s" % file_name)
+    
+    # Read raw data
+    raw_fname_in = op.join(out_path,
+                           file_name + '_' + method + '.fif')
+    raw = mne.io.read_raw_fif(
+        raw_fname_in, 
+        preload=False, 
+        verbose='error')
+    
+    # Check if there are EEG data and read them (once, as float32)
+    try:
+        eeg = EEGWorkingSet(raw)
+    except Exception as e:
+        print(e)
+        raise ValueError("Error: there is no EEG recording for this participant (%s)" % (site_id+sbj))
+    
+    ##############################################
+    # PHASE 1 : Estimate the true signal average #
+    ##############################################
+    
+    # Plot EEG data
+    fig = eeg.plot(bad_color=(1., 0., 0.),
+                   scalings = dict(eeg=10e-5),
+                   duration=5,
+                   start=100)
+    fname_fig = op.join(out_path,
+                        '02_%s_bad_egg_0raw.png' % fig_tag)
+    fig.savefig(fname_fig)
+    plt.close()
+    
+    # Plot EEG power spectrum
+    fig1 = viz_psd(raw, fname=raw_fname_in)
+    fname_fig1 = op.join(out_path,
+                        '02_%s_bad_egg_0pow.png' % fig_tag)
+    fig1.savefig(fname_fig1)
+    plt.close()
+    
+    # Init interpolator of bad channels (matrices are cached across 
+    # iterations and runs)
+    interpolator = EEGInterpolator(eeg.info)
+    
+    # Init average reference
+    ref_temp = eeg.median_reference()
+    
+    # Apply initial average reference (in the re-referencing buffer)
+    eeg_temp = eeg.referenced(ref_temp)
+    
+    # Init bad channel list
+    bad_channels = []
+    
+    # Set max number of iterations and init iteration
+    iteration_max = 100
+    
+    # Detect bad channels and recalculate the reference based on their interpolation
+    for i in range(iteration_max):
+        # Actual bad channel detection
+        bads_temp = []
+        bads_temp = find_bad_channels_eeg(eeg_temp, eeg.sfreq)
+        
+        # Exit loop if no new bad channels are found
+        if all(bad in bad_channels for bad in bads_temp):
+            break
+        else:
+            # Add new bad channel to the list
+            bad_channels += bads_temp
+            
+            # Get the new average reference of the data with the bad 
+            # channels interpolated
+            ref_temp = interpolator.average_reference(eeg_temp, bads_temp)
+            
+            # Get new temp data by removing the new reference from the orignal data
+            eeg_temp = eeg.referenced(ref_temp)
+    
+    # Get the true average reference (of the data with the loop bad 
+    # channels interpolated)
+    ref_true = interpolator.average_reference(eeg.data, bad_channels)
+    
+    # Release the re-referencing buffer
+    del eeg_temp
+    eeg.free_buffer()
+    
+    ############################################################################
+    # PHASE 2 : Find the bad channels relative to true average and interpolate #
+    ############################################################################
+    
+    # Remove true average reference from original EEG data
+    eeg.data -= ref_true
+    
+    # Plot true referenced EEG data
+    fig = eeg.plot(bad_color=(1., 0., 0.),
+                   scalings = dict(eeg=10e-5),
+                   duration=5,
+                   start=100)
+    fname_fig = op.join(out_path,
+                        '02_%s_bad_egg_1true.png' % fig_tag)
+    fig.savefig(fname_fig)
+    plt.close()
+    
+    # Find true bad channels
+    bads_true = find_bad_channels_eeg(eeg.data, eeg.sfreq)
+    
+    # Interpolate true bad channels
+    interpolator.apply(eeg.data, bads_true)
+    
+    # Plot interpolated EEG data (true bad channels marked)
+    fig = eeg.plot(bads=bads_true,
+                   bad_color=(1., 0., 0.),
+                   scalings = dict(eeg=10e-5),
+                   duration=5,
+                   start=100)
+    fname_fig = op.join(out_path,
+                        '02_%s_bad_egg_2intrp.png' % fig_tag)
+    fig.savefig(fname_fig)
+    plt.close()
+    
+    # Remove the new average reference to correct for the previous 
+    # referencing (as set_eeg_reference, the bad channels are neither 
+    # used nor re-referenced)
+    goods = [i for i, ch in enumerate(eeg.ch_names) if ch not in bads_true]
+    eeg.data[goods] -= eeg.data[goods].mean(-2, keepdims=True)
+    
+    # Get reference correction
+    ref_corr = eeg.data.mean(-2, keepdims=True)
+    
+    # Add correction to reference signal stored in raw
+    ref_true += ref_corr  #TODO: where in raw is the ref stored?
+    
+    # Plot referenced EEG data
+    fig = eeg.plot(bads=bads_true,
+                   bad_color=(1., 0., 0.),
+                   scalings = dict(eeg=10e-5),
+                   duration=5,
+                   start=100)
+    fname_fig = op.join(out_path,
+                        '02_%s_bad_egg_3refer.png' % fig_tag)
+    fig.savefig(fname_fig)
+    plt.close()
+    
+    # Plot referenced EEG power spectrum (true bad channels excluded)
+    raw_eeg = mne.io.RawArray(eeg.data, eeg.info, verbose='error')
+    raw_eeg.info['bads'] = list(bads_true)
+    fig2 = viz_psd(raw_eeg)
+    fname_fig2 = op.join(out_path,
+                        '02_%s_bad_egg_Ipow.png' % fig_tag)
+    fig2.savefig(fname_fig2)
+    plt.close()
+    del raw_eeg
+    
+    if use_sidecars:
+        # Get the linear operator applied to the original EEG data: true 
+        # reference, interpolation of the true bad channels and average 
+        # reference of the good channels
+        n_eeg = len(eeg.ch_names)
+        operator = (np.eye(n_eeg) 
+                    - interpolator.reference_weights(bad_channels)[np.newaxis])
+        operator = interpolator.operator(bads_true) @ operator
+        goods_mean = np.zeros(n_eeg)
+        goods_mean[goods] = 1. / len(goods)
+        operator[goods] -= goods_mean @ operator
+        
+        # Save operator instead of the data
+        write_eeg_operator(file_name, eeg.ch_names, operator)
+    
+    else:
+        # Write the processed EEG data back into raw
+        raw.load_data()
+        raw._data[eeg.picks] = eeg.data
+        
+        # Save data
+        fname_out = op.join(out_path,
+                            file_name + '_intpl.fif')
+        raw.save(fname_out, overwrite=True)
+    
+    return {'file_name': file_name,
+            'badch': {'subject': sbj,
+                      'run': run,
+                      'bad': bads_true},
+            'fname_fig1': fname_fig1,
+            'fname_fig2': fname_fig2}
+
+
+def find_bad_channels_eeg(amps, sfreq):
     ''' 
     Find bad EEG channels using on four criteria:
         - deviation criterion
         - correlation critetion
         - noisiness criterion
+    amps is the (n_eeg_channels, n_times) EEG data, which is not modified 
+    nor copied. It is low-passed once, the noisiness criterion uses a single 
+    spectral estimate.
     '''
     
     #######################
     # DEVIATION CRITERION #
     #######################
-        
-    # Get eeg signal
-    amps = raw.copy().pick('eeg')._data
-    
-    # Remove offset
-    amps = amps - amps.mean(axis=1)[:,None]
     
-    # Normalize (z-score) channel-specific amplitude
-    amps_z= scipy.stats.zscore(amps, axis=None)
-        
-    # Average channel-specific amplitude
-    amp_z_a = amps_z.mean(axis=1)
+    # Remove offset, normalize (z-score) and average channel-specific 
+    # amplitude
+    amp_z_a = deviation_zscore(amps)
     
     # Find channels with amplitude above threshold
     thr = 5
@@ -268,35 +317,31 @@ def find_bad_channels_eeg(raw):
     #########################
     
     # Low-pass eeg data to 50 Hz
-    lowpass_signal = raw.copy().pick('eeg').filter(None, 50)
+    lowpass_signal = lowpass(amps, sfreq, 50)
     
-    # Compute channel-to-channel correlation
-    data_for_corr = pd.DataFrame(np.transpose(lowpass_signal._data))
-    all_corr = data_for_corr.corr()
-    
-    # Get max correlation of each channel  #TODO: store nr of datapoints and corr matrix
-    all_corr[all_corr == 1] = 0
-    max_cor = all_corr.max(axis=1)
-    
-    # Find channels with max correlation below threshold
+    # Compute max channel-to-channel correlation of each channel in windows
     thr = .4
-    bad_by_correlation = np.where(max_cor < thr)[0]
+    max_cor, frac_bad = window_correlation(lowpass_signal,
+                                           sfreq,
+                                           thr=thr,
+                                           win_duration=corr_window)
+    del lowpass_signal
+    
+    # Find channels with max correlation below threshold in too many windows
+    bad_by_correlation = np.where(frac_bad > corr_bad_fraction)[0]
+    for i in bad_by_correlation:
+        print("    %s: max correlation < %.1f in %.1f%% of %d windows" 
+              % ("EEG0%02d" % (i+1), thr, 100 * frac_bad[i], 
+                 len(max_cor)))
     
     #######################
     # NOISINESS CRITERION #
     #######################
     
-    # Divide low and high frequency signals at 50 Hz
-    lowpass_signal = raw.copy().pick('eeg').filter(None, 50)
-    
-    highpass_signal = raw.copy().pick('eeg').filter(50, 100)
-    
-    # Compute power
-    low_power, _ = psd_multitaper(lowpass_signal)
-    low_power = np.sum(low_power, axis=1)
-    
-    high_power, _ = psd_multitaper(highpass_signal)
-    high_power = np.sum(high_power, axis=1)
+    # Compute power below and above 50 Hz in one spectral pass
+    power = band_power(amps, sfreq, [(0, 50), (50, 100)])
+    low_power = power[:, 0]
+    high_power = power[:, 1]
     
     # Get the high/low ratio
     pow_ratio = high_power/low_power
@@ -321,21 +366,23 @@ def find_bad_channels_eeg(raw):
     return bads
 
 
-def viz_psd(raw):
+def viz_psd(raw, fname=None):
+    # Compute power spectrum (or read it from the cache)
+    psds, freqs, ch_names, ch_types = compute_psd(raw, ['eeg'],
+                                                  fmin=1, fmax=40,
+                                                  method=psd_method,
+                                                  fname=fname)
+    # Show power spectral density plot
+    fig, ax = plt.subplots(2, 1, figsize=(12, 8))
+    plot_psd(psds, freqs, ch_types, axes=ax[0])
     # Compute averaged power
-    psds, freqs = psd_multitaper(raw,fmin = 1,fmax = 40, picks=['eeg'])
     psds = np.sum(psds,axis = 1)
     psds = 10. * np.log10(psds)
-    # Show power spectral density plot
-    fig, ax = plt.subplots(2, 1, figsize=(12, 8))
-    raw.plot_psd(picks = ["eeg"], 
-                  fmin = 1,fmax = 40,
-                  ax=ax[0])
     # Normalize (z-score) channel-specific average power values 
     psd = {}
     psd_zscore = scipy.stats.zscore(psds)
     for i in range(len(psd_zscore)):
-        psd["EEG%03d"%(i+1)] = psd_zscore[i]
+        psd[ch_names[i]] = psd_zscore[i]
     # Plot chennels ordered by power
     ax[1].bar(sorted(psd, key=psd.get,reverse = True),sorted(psd.values(),reverse = True),width = 0.5)
     labels = sorted(psd, key=psd.get,reverse = True)
@@ -348,8 +395,11 @@ def viz_psd(raw):
 # RUN
 # =============================================================================
 
-if subject_id in no_eeg_sbj:
-    raise ValueError("Error: no EEG collected for this participant (%s)" % (site_id+subject_id))
-else:
-    find_bad_eeg()
-    
\ No newline at end of file
+if __name__ == '__main__':
+    if eeg_batch_subjects is not None:
+        find_bad_eeg(subjects=eeg_batch_subjects)
+    elif subject_id in no_eeg_sbj:
+        raise ValueError("Error: no EEG collected for this participant (%s)" % (site_id+subject_id))
+    else:
+        find_bad_eeg()
+    
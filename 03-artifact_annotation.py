@@ -17,11 +17,13 @@ import os
 from fpdf import FPDF
 
 import mne
-from mne.preprocessing import annotate_muscle_zscore
 import matplotlib.pyplot as plt
 
 from config import site_id, subject_id, file_names, out_path
-from config import no_eeg_sbj
+from config import no_eeg_sbj, muscle_chunk_duration, use_sidecars
+from muscle import annotate_muscle_stream
+from eog import remap_eog, detect_eog_cached
+from sidecar import base_fname, read_raw_stage, write_artifacts
 
 
 def artifact_annotation():  
@@ -39,12 +41,7 @@ def artifact_annotation():
         print("  File: %s" % file_name)
         
         # Read raw data
-        raw_fname_in = op.join(out_path,
-                               file_name + '_intpl.fif')
-        raw = mne.io.read_raw_fif(
-            raw_fname_in, 
-            preload=True, 
-            verbose='error')
+        raw = read_raw_stage(file_name, 'intpl')
         
         # Create empty annotations list
         annot_artifact = mne.Annotations(onset=[], 
@@ -55,21 +52,18 @@ def artifact_annotation():
         # Detect ocular artifacts #
         ###########################
         
-        # Resetting the EOG channel
-        eog_ch = raw.copy().pick_types(meg=False, eeg=False, eog=True)
-        if len(eog_ch.ch_names) < 2:
-            raw.set_channel_types({'BIO002':'eog'})
-            raw.rename_channels({'BIO002': 'EOG002'})
+        # Resetting the EOG channel  #TODO: test on Birmingham's data
+        eog_renames = remap_eog(raw)
         
         if EEG:
-            # Resetting the EOG channel  #TODO: test on Birmingham's data
-            eog_ch = raw.copy().pick_types(meg=False, eeg=False, eog=True)
-            if len(eog_ch.ch_names) < 2:
-                raw.set_channel_types({'BIO002':'eog'})
-                raw.rename_channels({'BIO002': 'EOG002'})
-            
-            # Find EOG events
-            eog_events = mne.preprocessing.find_eog_events(raw)
+            # Find EOG events (blinks and saccades on all EOG channels, 
+            # stored in a sidecar file reused by reruns). 
+            # The EOG channels are those of the Maxwell filtered file
+            eog = detect_eog_cached(raw,
+                                    base_fname(file_name),
+                                    op.join(out_path,
+                                            file_name + '_eog.npz'))
+            eog_events = eog['blinks']
             onsets = (eog_events[:, 0] - raw.first_samp) / raw.info['sfreq'] - 0.25
             durations = [0.5] * len(eog_events)
             descriptions = ['Blink'] * len(eog_events)
@@ -84,6 +78,15 @@ def artifact_annotation():
             # Add blinks to annotations list
             annot_artifact = annot_artifact + annot_blink
             
+            # Annotate saccades (from their onset) and add them to 
+            # annotations list
+            saccade_events = eog['saccades']
+            annot_saccade = mne.Annotations(
+                (saccade_events[:, 0] - raw.first_samp) / raw.info['sfreq'],
+                [0.1] * len(saccade_events),
+                ['Saccade'] * len(saccade_events))
+            annot_artifact = annot_artifact + annot_saccade
+            
             # Plot blink with EEG data
             eeg_picks = mne.pick_types(raw.info, 
                                       meg=False,
@@ -101,28 +104,29 @@ def artifact_annotation():
         # Detect muscle artifacts #
         ###########################
         
-        # Notch filter
-        raw_muscle = raw.copy().notch_filter([50, 100])
-        
         # The threshold is data dependent, check the optimal threshold by plotting
         # ``scores_muscle``.
         threshold_muscle = 5  # z-score
         
         # Choose one channel type, if there are axial gradiometers and magnetometers,
         # select magnetometers as they are more sensitive to muscle activity.
-        annot_muscle, scores_muscle = annotate_muscle_zscore(
-            raw_muscle, 
+        # The data are notch filtered (50 and 100 Hz), band-pass filtered and
+        # scored chunk by chunk, without full-length filtered copies
+        annot_muscle, times_muscle, scores_muscle = annotate_muscle_stream(
+            raw, 
             ch_type="mag", 
             threshold=threshold_muscle, 
             min_length_good=0.2,
-            filter_freq=[110, 140])
+            filter_freq=[110, 140],
+            notch_freqs=[50, 100],
+            chunk_duration=muscle_chunk_duration)
         
         # Add muscle artifacts to annotations list
         annot_artifact = annot_artifact + annot_muscle
         
         # Plot muscle z-scores across recording
         fig1, ax = plt.subplots()
-        ax.plot(raw.times, scores_muscle)
+        ax.plot(times_muscle, scores_muscle)
         ax.axhline(y=threshold_muscle, color='r')
         ax.set(xlabel='time, (s)', ylabel='zscore', title='Muscle activity')
         fname_fig1 = op.join(out_path,
@@ -160,10 +164,17 @@ def artifact_annotation():
         pdf.cell(0, 10, 'Data and annotations', 'B', ln=1)
         pdf.image(fname_fig2, 0, 175, pdf.epw)
         
-        # Save data with annotated artifacts
-        fname_out = op.join(out_path,
-                            file_name + '_artif.fif')                            
-        raw.save(fname_out, overwrite=True)
+        # Save data with annotated artifacts (or only the annotations and
+        # remapped channels)
+        if use_sidecars:
+            write_artifacts(file_name, 
+                            raw.annotations,
+                            ch_types={ch: 'eog' for ch in eog_renames},
+                            ch_renames=eog_renames)
+        else:
+            fname_out = op.join(out_path,
+                                file_name + '_artif.fif')                            
+            raw.save(fname_out, overwrite=True)
     
     # Save report
     pdf.output(op.join(out_path,
@@ -13,13 +13,18 @@ import os
 # import sys
 import matplotlib.pyplot as plt
 from fpdf import FPDF
-
-import mne
-from mne.preprocessing import ICA
+import pandas as pd
 
 from config import site_id, subject_id, file_names, out_path
 from config import l_freq, h_freq, sfreq, no_eeg_sbj
 from config import ica_method, n_components, max_iter, random_state
+from config import ica_load_threads, ica_fused_loader, ica_fit_jobs
+from config import ica_warm_start, max_mem_per_job
+from config import ica_n_samples, ica_skip_annotations, ica_subsample_check
+from config import ica_eog_threshold, ica_ecg_threshold
+from ica_data import training_raw, training_head
+from ica_fit import fit_icas, head_raw, read_init, component_match
+from ica_score import score_components, scores_fname
 
 
 def run_ica(max_iter = 100, n_components = 0.99, random_state = 1):
@@ -29,32 +34,97 @@ def run_ica(max_iter = 100, n_components = 0.99, random_state = 1):
     #                           os.path.basename(__file__) + "_%s.txt" % (site_id+subject_id)),'w')
     
     print("Processing subject: %s" % subject_id)
-    run = 0
-    for file_name in file_names:
-        run = run + 1
-        print("  File: %s" % file_name)
-        
-        # Read raw data
-        raw_fname_in = op.join(out_path,
-                               file_name + '_artif.fif')
-        raw = mne.io.read_raw_fif(
-            raw_fname_in, 
-            preload=True, 
-            verbose='error')
-        
-        # Downsample copy of raw
-        raw_resmpl = raw.copy().resample(sfreq)
-            
-        # Band-pass filter raw copy
-        raw_resmpl.filter(l_freq, h_freq)
-            
-        # Concatenate raw copies
-        if run == 1:
-            raw_resmpl_all = mne.io.concatenate_raws([raw_resmpl])
-        else:
-            raw_resmpl_all = mne.io.concatenate_raws([raw_resmpl_all, raw_resmpl])
-        
-        del raw, raw_resmpl
+    
+    # Read, downsample and band-pass filter all runs, concatenated (all
+    # samples, or ica_n_samples samples outside artifacts)
+    raw_resmpl_all = training_raw(file_names, sfreq, l_freq, h_freq,
+                                  n_threads=ica_load_threads,
+                                  fused=ica_fused_loader,
+                                  shared=ica_fit_jobs > 1,
+                                  n_samples=ica_n_samples,
+                                  skip=ica_skip_annotations)
+    
+    ############
+    # Fit ICAs #
+    ############
+    
+    # Define ICA settings
+    ica_params = dict(method=ica_method,
+                      random_state=random_state,
+                      n_components=n_components,
+                      max_iter=max_iter,
+                      verbose=True)
+    
+    # Start from the ICAs saved by the previous run, if any and if enabled
+    # (warm start)
+    fits = []
+    for kind in (['meg', 'eeg'] if EEG else ['meg']):
+        init = None
+        if ica_warm_start:
+            ica_fname = op.join(out_path,
+                                file_names[0][0:14] + 'ALL-ica_%s.fif' % kind)
+            init = read_init(ica_fname)
+        fits.append((kind, dict(ica_params, init=init)))
+    
+    # Run MEG and EEG ICAs on filtered raw data at the same time
+    icas, fit_stats = zip(*fit_icas(raw_resmpl_all, fits,
+                                    n_jobs=ica_fit_jobs,
+                                    max_mem=max_mem_per_job))
+    
+    # Fit the ICAs on all samples and compare the components
+    if ica_n_samples is not None and ica_subsample_check:
+        raw_full = training_raw(file_names, sfreq, l_freq, h_freq,
+                                n_threads=ica_load_threads,
+                                fused=ica_fused_loader,
+                                shared=ica_fit_jobs > 1)
+        refs = fit_icas(raw_full, [(kind, ica_params) for kind, params in fits],
+                        n_jobs=ica_fit_jobs,
+                        max_mem=max_mem_per_job)
+        del raw_full
+        for ica, stats, (ref, ref_stats) in zip(icas, fit_stats, refs):
+            stats['fit_time_all'] = ref_stats['fit_time']
+            stats['match_mean'], stats['match_min'] = component_match(ica, ref)
+            print("    %s ICA: correlation with the components fitted on all "
+                  "samples %.3f (min %.3f)" % (stats['picks'],
+                                               stats['match_mean'],
+                                               stats['match_min']))
+    
+    # Save iterations and fit times
+    pd.DataFrame(list(fit_stats)).to_csv(op.join(out_path,
+                                                 "05_rAll_ica_fits.csv"),
+                                         index=False)
+    
+    #############
+    # Score ICs #
+    #############
+    
+    # Score the sources of all MEG and EEG components at once against the
+    # EOG and ECG channels (correlation and CTPS) and select the EOG- and
+    # ECG-related components
+    scores = score_components(icas, raw_resmpl_all,
+                              [stats['picks'] for stats in fit_stats],
+                              eog_threshold=ica_eog_threshold,
+                              ecg_threshold=ica_ecg_threshold,
+                              contiguous=ica_n_samples is None)
+    for kind in scores['ica'].unique():
+        kind_scores = scores[scores['ica'] == kind]
+        print("    %s ICA: EOG-related ICs %s, ECG-related ICs %s"
+              % (kind,
+                 kind_scores['component'][kind_scores['eog']].tolist(),
+                 kind_scores['component'][kind_scores['ecg']].tolist()))
+    
+    # Save scores, read by 06
+    fname_scores = scores_fname(file_names[0])
+    print("    Writing ICA component scores to: %s" % fname_scores)
+    scores.to_csv(fname_scores, index=False)
+    
+    # Keep the data shown in the timecourse plots only
+    if ica_n_samples is None:
+        raw_plot = head_raw(raw_resmpl_all, 110.)
+    else:
+        raw_plot = training_head(file_names[0], sfreq, l_freq, h_freq, 110.,
+                                 fused=ica_fused_loader)
+    del raw_resmpl_all
     
     ###################
     # ICA on MEG data #
@@ -63,19 +133,10 @@ def run_ica(max_iter = 100, n_components = 0.99, random_state = 1):
     # Prepare PDF report
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     
-    # Define ICA settings
-    ica = ICA(method=ica_method,
-              random_state=random_state,
-              n_components=n_components,
-              verbose=True)
-    
-    # Run ICA on filtered raw data
-    ica.fit(raw_resmpl_all,
-            picks='meg',
-            verbose=True)
+    ica = icas[0]
     
     # Plot timecourse of estimated sources
-    fig = ica.plot_sources(raw_resmpl_all,
+    fig = ica.plot_sources(raw_plot,
                            start=100,
                            show_scrollbars=False,
                            title='ICA_MEG')
@@ -119,7 +180,7 @@ def run_ica(max_iter = 100, n_components = 0.99, random_state = 1):
         
     # Save files
     ica_fname = op.join(out_path,
-                        file_name[0:14] + 'ALL-ica_meg.fif')
+                        file_names[0][0:14] + 'ALL-ica_meg.fif')
     ica.save(ica_fname)
     
     # Save report
@@ -135,19 +196,10 @@ def run_ica(max_iter = 100, n_components = 0.99, random_state = 1):
         # Prepare PDF report
         pdf = FPDF(orientation="P", unit="mm", format="A4")
         
-        # Define ICA settings
-        ica = ICA(method=ica_method,
-                  random_state=random_state,
-                  n_components=n_components,
-                  verbose=True)
-        
-        # Run ICA on filtered raw data
-        ica.fit(raw_resmpl_all,
-                picks='eeg',
-                verbose=True)
+        ica = icas[1]
         
         # Plot timecourse of estimated sources
-        fig = ica.plot_sources(raw_resmpl_all,
+        fig = ica.plot_sources(raw_plot,
                                start=100,
                                show_scrollbars=False,
                                title='ICA_EEG') 
@@ -184,7 +236,7 @@ def run_ica(max_iter = 100, n_components = 0.99, random_state = 1):
         
         # Save files
         ica_fname = op.join(out_path,
-                            file_name[0:14] + 'ALL-ica_eeg.fif')
+                            file_names[0][0:14] + 'ALL-ica_eeg.fif')
         ica.save(ica_fname)
         
         # Save report
@@ -205,6 +257,11 @@ else:
     EEG = True
     
 
-run_ica(max_iter = max_iter, 
-        n_components = n_components, 
-        random_state = random_state)
+# =============================================================================
+# RUN
+# =============================================================================
+
+if __name__ == '__main__':
+    run_ica(max_iter = max_iter, 
+            n_components = n_components, 
+            random_state = random_state)
@@ -3,7 +3,9 @@
 06. Apply ICA
 ===============
 
-This relies on the ICAs computed in 05-run_ica.py
+This relies on the ICAs computed in 05-run_ica.py, and on the EOG- and
+ECG-related components selected there (component score table, see
+ica_score.py)
 
 Open issues:
     1. Should we automitaze EOG- and ECG-related ICs detection?
@@ -22,12 +24,13 @@ import os
 import matplotlib.pyplot as plt
 from fpdf import FPDF
 
-import mne
-from mne.preprocessing import read_ica
 # from mne.preprocessing import create_eog_epochs, create_ecg_epochs
 
 from config import site_id, subject_id, file_names, out_path
-from config import no_eeg_sbj
+from config import no_eeg_sbj, use_sidecars
+from sidecar import read_raw_stage, write_ica
+from ica_apply import read_icas, cleaning_operator, CleanedRaw
+from ica_score import scores_fname, read_scores
 
 
 def apply_ica(meg_ica_eog = [], meg_ica_ecg = [],
@@ -41,18 +44,32 @@ def apply_ica(meg_ica_eog = [], meg_ica_ecg = [],
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     
     print("Processing subject: %s" % subject_id)
+    
+    ######################
+    # Read ICA solutions #
+    ######################
+    
+    # Restore MEG and EEG ICA solutions from fif files, with the EOG- and
+    # ECG-related components selected for exclusion
+    ica_fnames = [op.join(out_path,
+                          file_names[0][0:14] + 'ALL-ica_meg.fif')]
+    excludes = [meg_ica_eog + meg_ica_ecg]
+    if EEG:
+        ica_fnames.append(op.join(out_path,
+                                  file_names[0][0:14] + 'ALL-ica_eeg.fif'))
+        excludes.append(eeg_ica_eog + eeg_ica_ecg)
+    icas = read_icas(ica_fnames, excludes)
+    
+    # Combine the MEG and EEG cleaning into one block-diagonal operator
+    ch_names, operator, offset = cleaning_operator(icas)
+    
     run = 0
     for file_name in file_names:
         run = run + 1
         print("  File: %s" % file_name)
         
-        # Read raw data
-        raw_fname_in = op.join(out_path,
-                               file_name + '_artif.fif')
-        raw = mne.io.read_raw_fif(
-            raw_fname_in, 
-            preload=True, 
-            verbose='error')
+        # Read raw data (not preloaded)
+        raw = read_raw_stage(file_name, 'artif')
         
         # Show original signal
         if EEG:
@@ -77,80 +94,13 @@ def apply_ica(meg_ica_eog = [], meg_ica_ecg = [],
         pdf.cell(0, 10, 'Timecourse of input data', 'B', ln=1)
         pdf.image(fname_fig1, 0, 45, pdf.epw)
         
-        ###################
-        # ICA on MEG data #
-        ###################
-        
-        if [meg_ica_eog + meg_ica_ecg] != []:
-            
-            # Restore ICA solution from fif file
-            ica_meg_fname = op.join(out_path,
-                                file_name[0:14] + 'ALL-ica_meg.fif')
-            ica_meg = read_ica(ica_meg_fname)
-            
-            # Select EOG- and ECG-related components for exclusion
-            ica_meg.exclude.extend(meg_ica_eog + meg_ica_ecg)
-            
-            # # Plot excluded ICs
-            # if meg_ica_eog != []:
-            #     # Display component properties
-            #     fig = ica.plot_properties(raw, 
-            #                               picks=meg_ica_eog)
-            #     for i in range(len(fig)):
-            #         fname_fig = op.join(out_path, 
-            #                             "04_r%s_ica_meg_eog%d.png" % (run,i))
-            #         fig[i].savefig(fname_fig)
-            #         plt.close(fig[i])
-            # if meg_ica_ecg != []:
-            #     # Display component properties
-            #     fig = ica.plot_properties(raw, 
-            #                               picks=meg_ica_ecg)
-            #     for i in range(len(fig)):
-            #         fname_fig = op.join(out_path, 
-            #                             "04_r%s_ica_meg_ecg%d.png" % (run,i))
-            #         fig[i].savefig(fname_fig)
-            #         plt.close(fig[i])
-            
-        ###################
-        # ICA on EEG data #
-        ###################
+        #############
+        # Apply ICA #
+        #############
         
-        if eeg_ica_eog + eeg_ica_ecg != []:
-            
-            # Restore ICA solution from fif file
-            ica_eeg_fname = op.join(out_path,
-                                file_name[0:14] + 'ALL-ica_eeg.fif')
-            ica_eeg = read_ica(ica_eeg_fname)
-            
-            # Select EOG- and ECG-related components for exclusion
-            ica_eeg.exclude.extend(eeg_ica_eog + eeg_ica_ecg)
-            
-            # # Plot excluded ICs
-            # if eeg_ica_eog != []:
-            #     # Display component properties
-            #     fig = ica.plot_properties(raw, 
-            #                               picks=eeg_ica_eog)
-            #     for i in range(len(fig)):
-            #         fname_fig = op.join(out_path, 
-            #                             "04_r%s_ica_eeg_eog%d.png" % (run,i))
-            #         fig[i].savefig(fname_fig)
-            #         plt.close(fig[i])
-            # if eeg_ica_ecg != []:
-            #     # Display component properties
-            #     fig = ica.plot_properties(raw, 
-            #                               picks=eeg_ica_ecg)
-            #     for i in range(len(fig)):
-            #         fname_fig = op.join(out_path, 
-            #                             "04_r%s_ica_eeg_ecg%d.png" % (run,i))
-            #         fig[i].savefig(fname_fig)
-            #         plt.close(fig[i])
-        
-        ###################
-        
-        # Remove selected components from the signal  #TODO: @Ling why "apply" is done in two different steps?
-        raw_ica = raw.copy()
-        ica_meg.apply(raw_ica)
-        ica_eeg.apply(raw_ica)
+        # Remove selected MEG and EEG components from the signal in one pass
+        # (applied while the data are read)
+        raw_ica = CleanedRaw(raw, ch_names, operator, offset)
         
         # Show cleaned signal
         fig_ica = raw_ica.plot(order=chan_idxs,
@@ -166,10 +116,16 @@ def apply_ica(meg_ica_eog = [], meg_ica_ecg = [],
         pdf.cell(0, 10, 'Timecourse of output data', 'B', ln=1)
         pdf.image(fname_fig_ica, 0, 175, pdf.epw)
         
-        # Save cleaned raw data
-        fname_out = op.join(out_path,
-                            file_name + '_ica.fif')
-        raw_ica.save(fname_out,overwrite=True)
+        # Save cleaned raw data (or only the ICA solutions and excluded 
+        # components)
+        if use_sidecars:
+            write_ica(file_name,
+                      ica_fnames,
+                      [ica.exclude for ica in icas])
+        else:
+            fname_out = op.join(out_path,
+                                file_name + '_ica.fif')
+            raw_ica.save(fname_out,overwrite=True)
     
     # Save report  #TODO: add note about removed ICs
     pdf.output(op.join(out_path,
@@ -188,13 +144,17 @@ if subject_id in no_eeg_sbj:
 else:
     EEG = True
     
-# Manually selected ICs  #TODO: move and read these info from a separate table file
+# ICs selected in 05, read from the component score table
+fname_scores = scores_fname(file_names[0])
 #MEG
-meg_ica_eog = [0]
-meg_ica_ecg = [18]
+meg_ica_eog, meg_ica_ecg = read_scores(fname_scores, 'meg')
 #EEG
-eeg_ica_eog = [0]
-eeg_ica_ecg = [6]
+if EEG:
+    eeg_ica_eog, eeg_ica_ecg = read_scores(fname_scores, 'eeg')
+else:
+    eeg_ica_eog, eeg_ica_ecg = [], []
+print("EOG-related ICs: MEG %s, EEG %s" % (meg_ica_eog, eeg_ica_eog))
+print("ECG-related ICs: MEG %s, EEG %s" % (meg_ica_ecg, eeg_ica_ecg))
 
 
 apply_ica(meg_ica_eog = meg_ica_eog,
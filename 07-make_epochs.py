@@ -26,6 +26,9 @@ import mne
 from config import site_id, subject_id, file_names, out_path
 from config import no_eeg_sbj
 from config import events_id, tmin, tmax, reject_meg_eeg, reject_meg
+from sidecar import read_raw_stage
+from annot_index import AnnotationIndex
+from trial_store import trials_fname, read_trials, append_trials, concat_metadata
 
 
 def run_epochs():
@@ -45,25 +48,20 @@ def run_epochs():
     metadata_list = list()
     
     print("Processing subject: %s" % subject_id)
+    
+    # Read the trial tables of all runs
+    trials = read_trials(trials_fname(file_names[0]), file_names)
+    
     run = 0
     for file_name in file_names:
         run = run + 1
         print("  File: %s" % file_name)
         
         # Read raw data
-        raw_fname_in = op.join(out_path,
-                               file_name + '_ica.fif')
-        raw_tmp = mne.io.read_raw_fif(
-            raw_fname_in, 
-            preload=False, 
-            verbose='error')
+        raw_tmp = read_raw_stage(file_name, 'ica')
         
-        # Read events
-        events_tmp = mne.read_events(op.join(out_path,
-                                             file_name + '-eve.fif'))                           
-        # Read metadata
-        metadata_tmp = pd.read_csv(op.join(out_path,
-                                           file_name + '-meta.csv'))
+        # Read events and metadata
+        events_tmp, metadata_tmp = trials[file_name]
         
         # Append read data to list
         raw_list.append(raw_tmp)
@@ -76,10 +74,7 @@ def run_epochs():
     del raw_list
     
     # Concatenate metadata tables
-    metadata = pd.concat(metadata_list)
-    metadata.to_csv(op.join(out_path,
-                            file_name[0:14] + 'ALL-meta.csv'),
-                    index=False)
+    metadata = concat_metadata(metadata_list)
     
     # Set reject criteria
     if EEG:
@@ -111,11 +106,26 @@ def run_epochs():
     
     # epochs.metadata = metadata
     
+    # Index bad annotated segments (muscle artifacts, boundaries between 
+    # runs)
+    bad_index = AnnotationIndex.from_raw(raw)
+    sfreq = raw.info['sfreq']
+    
     del raw
     
     # Add metadata
     epochs.metadata = metadata
     
+    # Flag the epochs overlapping a bad segment (all epochs at once; they 
+    # are kept, as reject_by_annotation=False)
+    metadata = epochs.metadata
+    metadata['bad_annot'] = bad_index.overlaps(
+        epochs.events[:, 0] + int(round(tmin * sfreq)),
+        epochs.events[:, 0] + int(round(tmax * sfreq)) + 1)
+    epochs.metadata = metadata
+    print("    %d of %d epochs overlap bad annotated segments" 
+          % (metadata['bad_annot'].sum(), len(metadata)))
+    
     # Drop bad epochs based on peak-to-peak magnitude
     epochs.drop_bad()
     
@@ -165,6 +175,10 @@ def run_epochs():
                         file_names[0][0:13] + 'ALL_epo.fif'),                           
                     overwrite=True)
     
+    # Save events and metadata of the epochs to the trial store
+    append_trials(trials_fname(file_names[0]), 'ALL_epo',
+                  epochs.events, epochs.metadata)
+    
     # Save report  #TODO: add note about removed ICs
     pdf.output(op.join(out_path,
                        os.path.basename(__file__) + '-report.pdf'))
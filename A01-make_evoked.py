@@ -20,6 +20,7 @@ import PIL
 
 from config import site_id, subject_id, file_names, out_path
 from config import no_eeg_sbj
+from trial_store import trials_fname, epochs_trials, select_trials
 from config import tmin, tmax, factor, conditions
 
 
@@ -38,6 +39,9 @@ def run_evoked(make_plot = True):
                              preload=True,
                              verbose=True)
     
+    # Read the metadata of the epochs from the trial store
+    metadata = epochs_trials(trials_fname(file_names[0]), epochs)
+    
     #############################
     # Averaging over conditions #
     #############################
@@ -45,7 +49,7 @@ def run_evoked(make_plot = True):
     # Get evoked responses by condition
     evokeds = dict()
     for condition in conditions:
-        evokeds[str(condition)] = epochs['%s == "%s"' % (factor, condition)].average()
+        evokeds[str(condition)] = epochs[select_trials(metadata, factor, condition)].average()
         
     # Plot
     if make_plot:
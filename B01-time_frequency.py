@@ -17,6 +17,7 @@ import mne
 
 from config import site_id, subject_id, file_names, out_path
 from config import no_eeg_sbj
+from trial_store import trials_fname, epochs_trials, select_trials
 #from config import study_path, out_path, site_id, no_eeg_sbj_exp1#, n_run
 from config import baseline_w, freq_band, factor, conditions
 
@@ -34,6 +35,9 @@ def run_time_frequency(make_plot = True):
                              preload=True,
                              verbose=True)
     
+    # Read the metadata of the epochs from the trial store
+    metadata = epochs_trials(trials_fname(file_names[0]), epochs)
+    
     ### Run time-frequency decomposition
     # TFR of low frequencoes (< 30 Hz)
     if freq_band in ['low', 'both']:
@@ -45,7 +49,7 @@ def run_time_frequency(make_plot = True):
         # Run over each condition
         for condition in conditions:
             power = mne.time_frequency.tfr_multitaper(
-                epochs['%s == "%s"' % (factor, condition)],
+                epochs[select_trials(metadata, factor, condition)],
                 freqs=freqs, 
                 n_cycles=n_cycles, 
                 use_fft=True,
@@ -92,7 +96,7 @@ def run_time_frequency(make_plot = True):
         # Run over each condition
         for condition in conditions:
             power = mne.time_frequency.tfr_multitaper(
-                epochs['%s == "%s"' % (factor, condition)],
+                epochs[select_trials(metadata, factor, condition)],
                 freqs=freqs, 
                 n_cycles=n_cycles, 
                 use_fft=True,
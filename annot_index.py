@@ -0,0 +1,87 @@
+"""
+================
+Annotation index
+================
+
+Index of the bad annotated segments of a recording (muscle artifacts,
+boundaries...), to find which of many windows (e.g. all the epochs of a
+recording) overlap a bad segment in one batch of binary searches instead of
+checking every window against every annotation.
+
+"""
+
+import numpy as np
+
+
+class AnnotationIndex:
+    '''
+    Segments [start, stop) in samples, merged into sorted disjoint intervals.
+    '''
+    
+    def __init__(self, starts, stops):
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        
+        # Sort segments by start
+        order = np.argsort(starts, kind='stable')
+        starts, stops = starts[order], stops[order]
+        
+        # Merge the segments overlapping (or touching) the previous ones
+        if len(starts):
+            reach = np.maximum.accumulate(stops)
+            first = np.concatenate([[True], starts[1:] > reach[:-1]])
+            idx = np.where(first)[0]
+            starts = starts[idx]
+            stops = np.maximum.reduceat(stops, idx)
+        self.starts = starts
+        self.stops = stops
+    
+    @classmethod
+    def from_raw(cls, raw, descriptions=('bad',)):
+        '''
+        Index of the annotations of raw whose description starts with one
+        of descriptions (case insensitive, default: the segments rejected
+        by reject_by_annotation). Samples include raw.first_samp, as in
+        events.
+        '''
+        annot = raw.annotations
+        prefixes = tuple(d.lower() for d in descriptions)
+        keep = np.array([str(d).lower().startswith(prefixes)
+                         for d in annot.description], dtype=bool)
+        onset = annot.onset[keep]
+        starts = raw.time_as_index(onset,
+                                   use_rounding=True,
+                                   origin=annot.orig_time)
+        stops = raw.time_as_index(onset + annot.duration[keep],
+                                  use_rounding=True,
+                                  origin=annot.orig_time)
+        
+        # Segments last at least one sample (e.g. 'BAD boundary')
+        stops = np.maximum(stops, starts + 1)
+        
+        return cls(starts + raw.first_samp, stops + raw.first_samp)
+    
+    def __len__(self):
+        return len(self.starts)
+    
+    def overlaps(self, starts, stops):
+        '''
+        Whether each window [start, stop) overlaps a segment (boolean array).
+        '''
+        starts = np.asarray(starts)
+        stops = np.asarray(stops)
+        
+        # First segment ending after the start of each window
+        idx = np.searchsorted(self.stops, starts, side='right')
+        
+        # The window overlaps it if the segment starts before its end
+        inside = idx < len(self.starts)
+        result = np.zeros(starts.shape, dtype=bool)
+        result[inside] = self.starts[idx[inside]] < stops[inside]
+        return result
+    
+    def duration(self):
+        '''
+        Total number of samples in segments.
+        '''
+        return int(np.sum(self.stops - self.starts))
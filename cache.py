@@ -0,0 +1,100 @@
+"""
+===============
+Cache utilities
+===============
+
+Keys and file names for results that are cached on disk across reruns.
+
+A cache key is the hash of everything the cached result depends on: the
+content of the input files and the parameters of the computation.
+
+"""
+
+import os.path as op
+import os
+import hashlib
+import json
+
+from config import cache_path
+
+
+def file_hash(fname, block_size=2**24):
+    '''
+    Content hash (sha1) of a file. The hash is stored next to the cache 
+    entries and only recomputed when the size or modification time of the 
+    file change.
+    '''
+    
+    # Look up the stored hash
+    fname = op.abspath(fname)
+    stat = os.stat(fname)
+    fname_memo = op.join(cache_path,
+                         'filehash_%s.json' % _hash_str(fname)[:16])
+    if op.exists(fname_memo):
+        with open(fname_memo) as f:
+            memo = json.load(f)
+        if memo['size'] == stat.st_size and memo['mtime'] == stat.st_mtime_ns:
+            return memo['hash']
+    
+    # Hash the file content block by block
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    
+    # Store the hash
+    memo = {'fname': fname,
+            'size': stat.st_size, 
+            'mtime': stat.st_mtime_ns,
+            'hash': h.hexdigest()}
+    _write_json(fname_memo, memo)
+    
+    return memo['hash']
+
+
+def make_key(*hashes, **params):
+    '''
+    Cache key combining file hashes and the parameters of a computation.
+    '''
+    return _hash_str(json.dumps([hashes, params], sort_keys=True, default=str))
+
+
+def cache_fname(kind, key, ext='.npz'):
+    '''
+    File name of the cache entry of the given kind (e.g. 'maxwell_badch').
+    '''
+    return op.join(cache_path, '%s_%s%s' % (kind, key, ext))
+
+
+def atomic_open(fname):
+    '''
+    Open a temporary file for writing, which is renamed to fname when closed, 
+    so that readers (e.g. other worker processes) never see a partial entry.
+    '''
+    return _AtomicFile(fname)
+
+
+class _AtomicFile:
+    def __init__(self, fname):
+        self.fname = fname
+        self.fname_tmp = '%s.%d.tmp' % (fname, os.getpid())
+    
+    def __enter__(self):
+        self.f = open(self.fname_tmp, 'wb')
+        return self.f
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.f.close()
+        if exc_type is None:
+            os.replace(self.fname_tmp, self.fname)
+        else:
+            os.remove(self.fname_tmp)
+
+
+def _hash_str(s):
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def _write_json(fname, obj):
+    with atomic_open(fname) as f:
+        f.write(json.dumps(obj).encode())
@@ -40,8 +40,41 @@ file_names = [f % (site_id+subject_id) for f in file_exts]
 out_path = op.join(data_path, "out_path")
 if not op.exists(out_path):
     os.mkdir(out_path)
+
+# Set cache folder (results reused across reruns) or create it if it doesn't 
+# exist
+cache_path = op.join(out_path, "cache")
+if not op.exists(cache_path):
+    os.mkdir(cache_path)
+
+# Write lightweight sidecar files (EEG operator, annotations, ICA exclusions)
+# instead of full copies of the recording at stages 02, 03 and 06. The 
+# later stages apply them when reading the data
+use_sidecars = True
+
+# Set method used to estimate the power spectra of the QC figures ('welch' or
+# 'multitaper')
+psd_method = 'welch'
         
 
+# =============================================================================
+# PARALLEL PROCESSING SETTINGS
+# =============================================================================
+
+# Number of worker processes used to process runs in parallel (1 = serial)
+n_jobs = 1
+
+# Address space cap per worker process in GB, plus parallel.mem_headroom 
+# (None = no cap). The address space includes memory maps and thread 
+# arenas, so size it above the peak memory of a job; lower n_jobs to limit 
+# the memory in use
+max_mem_per_job = None
+
+# Subjects whose runs are processed together by 02-find_bad_eeg.py (None = 
+# only subject_id). Subjects without EEG are skipped
+eeg_batch_subjects = None
+
+
 # =============================================================================
 # MAXWELL FILTERING SETTINGS
 # =============================================================================
@@ -53,6 +86,35 @@ if method == 'tsss':
 else:
     st_duration = None
 
+# Set length (in s) of the buffers Maxwell filtered one at a time to bound 
+# memory usage on long recordings (rounded to a multiple of st_duration for 
+# tSSS). None = filter the whole recording at once
+sss_buffer_duration = None
+
+# Reuse the cached SSS basis of another run when the device-to-head transforms
+# differ by less than these tolerances (translation in m, rotation in deg)
+sss_basis_tol_trans = 0.0005
+sss_basis_tol_rot = 0.5
+
+
+# =============================================================================
+# BAD EEG CHANNEL DETECTION SETTINGS
+# =============================================================================
+
+# Set length (in s) of the windows in which channel correlations are computed
+corr_window = 1.
+
+# Set fraction of windows with low correlation above which a channel is bad
+corr_bad_fraction = 0.01
+
+
+# =============================================================================
+# ARTIFACT ANNOTATION SETTINGS
+# =============================================================================
+
+# Length (in s) of the chunks of data read at once to detect muscle artifacts
+muscle_chunk_duration = 60.
+
 
 # =============================================================================
 # FILTERING AND DOWNSAMPLING SETTINGS
@@ -91,11 +153,51 @@ for j,t in enumerate(types):
 # ICA SETTINGS
 # =============================================================================
 
+# ICA solver: 'fastica', 'picard' or 'extended-infomax' (run ica_fit.py to
+# compare them on synthetic data)
 ica_method = 'fastica'
 n_components = 0.99
 max_iter = 800
 random_state = 1688
 
+# Start the ICA solvers from the unmixing matrices of the ICA files of the 
+# previous run of 05 (faster refits, but the solution then depends on the 
+# files already in out_path; False = random initial matrices, reproducible)
+ica_warm_start = False
+
+# Number of runs read, downsampled and filtered at the same time (threads) 
+# to make the ICA training data
+ica_load_threads = 1
+
+# Resample and band-pass filter the ICA training data in a single streamed 
+# pass (False = raw.resample then raw.filter)
+ica_fused_loader = True
+
+# Number of ICAs (MEG, EEG) fitted at the same time in worker processes 
+# sharing the training data (1 = one after the other)
+ica_fit_jobs = 2
+
+# Number of samples (after downsampling) the ICAs are fitted on, taken 
+# evenly from all runs outside the annotations in ica_skip_annotations 
+# (None = all samples)
+ica_n_samples = None
+
+# Descriptions (prefixes) of the annotations whose samples are not used 
+# when ica_n_samples is set
+ica_skip_annotations = ['bad', 'blink']
+
+# Also fit the ICAs on all samples and report how well the components match 
+# (slow, to choose ica_n_samples)
+ica_subsample_check = False
+
+# EOG-related components: correlation with an EOG channel more than 
+# ica_eog_threshold z-scores away from that of the other components
+ica_eog_threshold = 3.0
+
+# ECG-related components: cross-trial phase statistics over the heartbeats 
+# above ica_ecg_threshold
+ica_ecg_threshold = 0.3
+
 
 # =============================================================================
 #  FACTOR AND CONDITIONS OF INTEREST
@@ -0,0 +1,127 @@
+"""
+========================
+EEG bad channel criteria
+========================
+
+Vectorised NumPy engines for the criteria used to find bad EEG channels in
+02-find_bad_eeg.py.
+
+"""
+
+import numpy as np
+import scipy.signal
+
+import mne
+
+from psd import welch
+
+
+def deviation_zscore(data):
+    '''
+    Average over time of the z-scored amplitude of each channel, where the 
+    data are demeaned per channel and z-scored over all channels and samples
+    (same as scipy.stats.zscore(data - mean, axis=None).mean(axis=1)). 
+    Computed one channel at a time, without copying the data.
+    '''
+    
+    # Get mean and variance of each channel
+    ch_mean = np.array([ch.mean(dtype=np.float64) for ch in data])
+    ch_var = np.array([ch.var(dtype=np.float64) for ch in data])
+    
+    # Get std over all channels and samples of the demeaned data
+    std = np.sqrt(ch_var.mean())
+    
+    # Average z-scored amplitude of each channel
+    return np.array([((ch - m) / std).mean(dtype=np.float64)
+                     for ch, m in zip(data, ch_mean)])
+
+
+def lowpass(data, sfreq, h_freq, block_size=8):
+    '''
+    Zero-phase FIR low-pass filter (same filter as 
+    mne.filter.filter_data(data, sfreq, None, h_freq)) computed in the 
+    precision of data (e.g. float32), a few channels at a time.
+    Returns the filtered data.
+    '''
+    
+    # Design filter
+    h = mne.filter.create_filter(None, sfreq, None, h_freq, 
+                                 verbose='error').astype(data.dtype)
+    n = len(h)
+    
+    # Filter blocks of channels (padded with point reflections as in MNE)
+    out = np.empty_like(data)
+    for start in range(0, len(data), block_size):
+        x = data[start:start + block_size]
+        x = np.concatenate([2 * x[:, :1] - x[:, n:0:-1],
+                            x,
+                            2 * x[:, -1:] - x[:, -2:-n - 2:-1]], axis=-1)
+        out[start:start + block_size] = scipy.signal.oaconvolve(
+            x, h[np.newaxis], mode='same', axes=-1)[:, n:-n]
+    
+    return out
+
+
+def window_correlation(data, sfreq, thr=.4, win_duration=1., batch_size=256):
+    '''
+    Channel-to-channel correlation in fixed windows (as in PREP).
+        - data: (n_channels, n_times) EEG data
+        - thr: correlation below which a window is bad for a channel
+        - win_duration: length of the windows in s
+    Returns the maximum correlation of each channel with any other channel
+    in each window (n_windows, n_channels) and the fraction of bad windows
+    of each channel (n_channels,).
+    '''
+    
+    # Get number of windows (a last partial window is dropped)
+    n_ch, n_times = data.shape
+    n_win = int(round(win_duration * sfreq))
+    n_windows = n_times // n_win
+    
+    # Compute windows in batches to bound the memory of the float32 copy
+    max_corr = np.empty((n_windows, n_ch), dtype=np.float32)
+    for start in range(0, n_windows, batch_size):
+        stop = min(start + batch_size, n_windows)
+        
+        # Get (windows, channels, samples) float32 copy of the batch
+        x = data[:, start * n_win:stop * n_win].astype(np.float32)
+        x = np.ascontiguousarray(
+            x.reshape(n_ch, stop - start, n_win).transpose(1, 0, 2))
+        
+        # Remove offset and normalize each window (flat windows stay 0)
+        x -= x.mean(axis=-1, keepdims=True)
+        norm = np.linalg.norm(x, axis=-1, keepdims=True)
+        np.divide(x, norm, out=x, where=norm > 0)
+        
+        # Correlation matrices of all windows in one batched matrix product
+        corr = np.matmul(x, x.transpose(0, 2, 1))
+        
+        # Get max correlation of each channel with the other channels
+        corr[:, np.arange(n_ch), np.arange(n_ch)] = 0
+        max_corr[start:stop] = corr.max(axis=-1)
+    
+    # Get fraction of windows with max correlation below threshold
+    frac_bad = (max_corr < thr).mean(axis=0)
+    
+    return max_corr, frac_bad
+
+
+def band_power(data, sfreq, bands, n_fft=2048, block_duration=60.):
+    '''
+    Power of each channel in each frequency band, from a single Welch 
+    estimate computed block by block over the data.
+        - data: (n_channels, n_times) EEG data
+        - bands: list of (fmin, fmax) in Hz (fmin included, fmax excluded)
+    Returns the band powers (n_channels, n_bands).
+    '''
+    
+    # Compute power spectrum
+    freqs, psds = welch(lambda start, stop: data[:, start:stop],
+                        data.shape[1], 
+                        sfreq, 
+                        n_fft=n_fft,
+                        block_duration=block_duration)
+    
+    # Sum power in each band
+    return np.stack([psds[:, (freqs >= fmin) & (freqs < fmax)].sum(axis=-1)
+                     for fmin, fmax in bands], axis=-1)
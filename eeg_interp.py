@@ -0,0 +1,155 @@
+"""
+=================
+EEG interpolation
+=================
+
+Spherical-spline interpolation of bad EEG channels on a fixed montage.
+
+The interpolation matrix of each set of bad channels is computed once and
+cached, in memory and on disk, so that it is reused by the iterations of the
+robust-reference loop of 02-find_bad_eeg.py and by the other runs of the
+same subject (the montage does not change between runs).
+
+"""
+
+import os.path as op
+import numpy as np
+
+import mne
+import mne.channels.interpolation
+
+from cache import make_key, cache_fname, atomic_open
+from mne_private import mne_private
+
+
+# Interpolation matrices already used in this process, by cache key
+_matrices = {}
+
+
+class EEGInterpolator:
+    '''
+    Interpolates bad EEG channels of data recorded with the montage of info.
+    Same as raw.interpolate_bads() for EEG channels (origin='auto').
+    '''
+    
+    def __init__(self, info):
+        # Get EEG channels and positions
+        self.picks = mne.pick_types(info, meg=False, eeg=True, exclude=[])
+        self.ch_names = [info['ch_names'][i] for i in self.picks]
+        pos = np.array([info['chs'][i]['loc'][:3] for i in self.picks])
+        
+        # Get origin of the spherical fit to the head shape
+        try:
+            _, origin, _ = mne.bem.fit_sphere_to_headshape(info,
+                                                           units='m',
+                                                           verbose='error')
+        except (RuntimeError, ValueError):
+            origin = np.array([0., 0., 0.04])
+        self.pos = pos - origin
+        
+        # Identify the montage
+        self.montage_key = make_key(ch_names=self.ch_names,
+                                    pos=self.pos.round(8).tolist())
+    
+    def matrix(self, bads):
+        '''
+        Returns the indices of good and bad channels (within the EEG
+        channels) and the interpolation matrix (n_bads, n_goods).
+        '''
+        
+        # Get good and bad channels
+        bads_idx = np.array([i for i, ch in enumerate(self.ch_names)
+                             if ch in bads], dtype=int)
+        goods_idx = np.setdiff1d(np.arange(len(self.ch_names)), bads_idx)
+        
+        # Look in this process, then on disk
+        key = make_key(self.montage_key,
+                       bads=bads_idx.tolist(),
+                       mne=mne.__version__)
+        if key not in _matrices:
+            fname_cache = cache_fname('eeg_interp', key)
+            if op.exists(fname_cache):
+                with np.load(fname_cache) as cached:
+                    _matrices[key] = cached['interpolation']
+            else:
+                # Compute (with the private function of MNE, in the MNE
+                # versions it was tested with) and store the interpolation
+                # matrix
+                make_matrix = mne_private(mne.channels.interpolation,
+                                          '_make_interpolation_matrix',
+                                          'The EEG interpolation cache')
+                _matrices[key] = make_matrix(self.pos[goods_idx],
+                                             self.pos[bads_idx])
+                with atomic_open(fname_cache) as f:
+                    np.savez(f, interpolation=_matrices[key])
+        
+        return goods_idx, bads_idx, _matrices[key]
+    
+    def apply(self, data, bads, picks=None):
+        '''
+        Interpolate the bad channels of data in place.
+            - data: (n_channels, n_times) array
+            - picks: rows of the EEG channels in data (default: all rows)
+        '''
+        if len(bads) == 0:
+            return data
+        
+        # Get EEG rows (a view when they are contiguous)
+        if picks is None:
+            picks = np.arange(len(data))
+        picks = np.asarray(picks)
+        if np.array_equal(picks, np.arange(picks[0], picks[0] + len(picks))):
+            eeg = data[picks[0]:picks[0] + len(picks)]
+        else:
+            eeg = data[picks]
+        
+        # Interpolate in a single matrix product (in the precision of data)
+        goods_idx, bads_idx, interpolation = self.matrix(bads)
+        interpolation_full = np.zeros((len(bads_idx), len(picks)), 
+                                      dtype=data.dtype)
+        interpolation_full[:, goods_idx] = interpolation
+        data[picks[bads_idx]] = interpolation_full @ eeg
+        
+        return data
+    
+    def average_reference(self, data, bads):
+        '''
+        Average over EEG channels of data after interpolating the bad ones, 
+        computed without modifying data (one vector-matrix product).
+            - data: (n_eeg_channels, n_times) array
+        Returns the reference (1, n_times).
+        '''
+        if len(bads) == 0:
+            return data.mean(-2, keepdims=True)
+        
+        weights = self.reference_weights(bads).astype(data.dtype)
+        
+        return (weights @ data)[np.newaxis]
+    
+    def reference_weights(self, bads):
+        '''
+        Weight of each EEG channel in the average reference computed after 
+        interpolating the bad channels (n_eeg_channels,).
+        '''
+        
+        # Weight of each good channel in the mean (own weight plus its 
+        # contribution to the interpolated channels), 0 for bad channels
+        weights = np.full(len(self.ch_names), 1. / len(self.ch_names))
+        if len(bads):
+            goods_idx, bads_idx, interpolation = self.matrix(bads)
+            weights[bads_idx] = 0.
+            weights[goods_idx] += interpolation.sum(axis=0) / len(self.ch_names)
+        
+        return weights
+    
+    def operator(self, bads):
+        '''
+        Linear operator (n_eeg_channels, n_eeg_channels) interpolating the 
+        bad channels, i.e. apply(data, bads) is operator(bads) @ data.
+        '''
+        operator = np.eye(len(self.ch_names))
+        if len(bads):
+            goods_idx, bads_idx, interpolation = self.matrix(bads)
+            operator[bads_idx] = 0.
+            operator[np.ix_(bads_idx, goods_idx)] = interpolation
+        return operator
@@ -0,0 +1,160 @@
+"""
+===============
+EEG working set
+===============
+
+The EEG channels of a run held as one contiguous float32 array, read once
+from the raw file. Referencing, the bad channel criteria and the plots work
+on views of this array (plus a single reused buffer for re-referenced data)
+instead of copies of the raw.
+
+Run this file to benchmark the peak memory against the copy-based version
+of 02-find_bad_eeg.py.
+
+"""
+
+import os.path as op
+import multiprocessing
+import resource
+import numpy as np
+
+import mne
+
+
+class EEGWorkingSet:
+    '''
+    EEG data of raw (n_eeg_channels, n_times) in float32.
+    '''
+    
+    def __init__(self, raw, block_duration=60.):
+        # Get EEG channels
+        self.picks = mne.pick_types(raw.info, meg=False, eeg=True, exclude=[])
+        if len(self.picks) == 0:
+            raise ValueError("No EEG channels")
+        self.info = mne.pick_info(raw.info, self.picks)
+        self.info['bads'] = []
+        self.ch_names = self.info['ch_names']
+        self.sfreq = raw.info['sfreq']
+        self.first_samp = raw.first_samp
+        
+        # Read EEG data block by block (a not preloaded raw is never loaded
+        # whole)
+        n_times = len(raw.times)
+        n_block = int(block_duration * self.sfreq)
+        self.data = np.empty((len(self.picks), n_times), dtype=np.float32)
+        for start in range(0, n_times, n_block):
+            stop = min(start + n_block, n_times)
+            self.data[:, start:stop] = raw.get_data(picks=self.picks,
+                                                    start=start,
+                                                    stop=stop)
+        
+        # Buffer for re-referenced data
+        self.buffer = None
+    
+    def median_reference(self, block_size=10000):
+        '''
+        Median over channels (1, n_times), computed block by block.
+        '''
+        ref = np.empty((1, self.data.shape[1]), dtype=self.data.dtype)
+        for start in range(0, self.data.shape[1], block_size):
+            ref[:, start:start + block_size] = np.median(
+                self.data[:, start:start + block_size], axis=-2, keepdims=True)
+        return ref
+    
+    def referenced(self, ref):
+        '''
+        Data minus ref, written in the (reused) re-referencing buffer.
+        '''
+        if self.buffer is None:
+            self.buffer = np.empty_like(self.data)
+        np.subtract(self.data, ref, out=self.buffer)
+        return self.buffer
+    
+    def free_buffer(self):
+        self.buffer = None
+    
+    def plot(self, data=None, bads=(), start=100, duration=5, **kwargs):
+        '''
+        Plot a window of data (default: the working set data). Only the
+        plotted window is copied into a Raw object.
+        '''
+        if data is None:
+            data = self.data
+        
+        # Get plotted window
+        first = int(round(start * self.sfreq))
+        last = min(first + int(round(duration * self.sfreq)), data.shape[1])
+        
+        # Make Raw of the window
+        raw_win = mne.io.RawArray(data[:, first:last],
+                                  self.info,
+                                  first_samp=self.first_samp + first,
+                                  verbose='error')
+        raw_win.info['bads'] = list(bads)
+        
+        return raw_win.plot(duration=duration, start=0, **kwargs)
+
+
+def benchmark_peak_memory(raw_fname):
+    '''
+    Peak memory (max RSS) of reading a run and referencing its EEG data with
+    the copies made by the previous version of 02-find_bad_eeg.py and with
+    the working set. Each version runs in a fresh process.
+    '''
+    for name, func in [('copies', _reference_with_copies),
+                       ('working set', _reference_with_working_set)]:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(1) as pool:
+            max_rss = pool.apply(_max_rss, (func, raw_fname))
+        print("%s, %s: peak memory %.2f GB"
+              % (op.basename(raw_fname), name, max_rss / 1024 ** 2))
+
+
+def _max_rss(func, raw_fname):
+    func(raw_fname)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reference_with_copies(raw_fname):
+    # Copies made by the previous version of find_bad_eeg
+    raw = mne.io.read_raw_fif(raw_fname, preload=True, verbose='error')
+    raw.copy().pick('eeg')
+    raw_eeg = raw.copy().pick('eeg')
+    raw_eeg_temp = raw_eeg.copy()
+    ref_temp = np.median(raw_eeg_temp._data.copy(), axis=-2, keepdims=True)
+    raw_eeg_temp._data -= ref_temp
+    lowpass_signal = raw_eeg_temp.copy().pick('eeg').filter(None, 50,
+                                                            verbose='error')
+    ref_temp = raw_eeg_temp._data.copy().mean(-2, keepdims=True)
+    raw_eeg_temp._data = raw_eeg._data.copy() - ref_temp
+    raw_eeg_bad = raw_eeg.copy()
+    ref_true = raw_eeg_bad._data.copy().mean(-2, keepdims=True)
+    eeg_idx = mne.pick_types(raw.info, meg=False, eeg=True, exclude=[])
+    raw._data[..., eeg_idx, :] -= ref_true
+    raw.copy().pick('eeg')
+    del lowpass_signal
+
+
+def _reference_with_working_set(raw_fname):
+    # Same steps on the working set
+    from eeg_criteria import lowpass
+    raw = mne.io.read_raw_fif(raw_fname, preload=False, verbose='error')
+    ws = EEGWorkingSet(raw)
+    eeg_temp = ws.referenced(ws.median_reference())
+    lowpass_signal = lowpass(eeg_temp, ws.sfreq, 50)
+    ref_temp = eeg_temp.mean(-2, keepdims=True)
+    eeg_temp = ws.referenced(ref_temp)
+    ref_true = ws.data.mean(-2, keepdims=True)
+    ws.free_buffer()
+    ws.data -= ref_true
+    raw.load_data()
+    raw._data[ws.picks] = ws.data
+    del lowpass_signal
+
+
+if __name__ == '__main__':
+    from config import out_path, file_names, method
+    
+    for file_name in file_names:
+        benchmark_peak_memory(op.join(out_path,
+                                      file_name + '_' + method + '.fif'))
@@ -0,0 +1,194 @@
+"""
+=============
+EOG detection
+=============
+
+Blink and saccade detection on all the EOG channels of a run at once.
+
+The EOG channels are read and filtered together (one filtering call per
+frequency band instead of one per channel and per detection), and the
+detected events and scores are stored in a sidecar file next to the data,
+which reruns read instead of detecting them again. 03 annotates the blinks
+and saccades.
+
+"""
+
+import os.path as op
+import numpy as np
+
+import mne
+from mne.preprocessing import peak_finder
+
+from cache import file_hash, make_key, atomic_open
+
+
+# EOG channels recorded as other channel types at some sites
+eog_remap = {'BIO002': 'EOG002'}
+
+
+def remap_eog(raw):
+    '''
+    Use BIO002 as EOG002 when raw has a single EOG channel. Returns the 
+    renamed channels ({old name: new name}).
+    '''
+    renames = {}
+    n_eog = len(mne.pick_types(raw.info, meg=False, eog=True, exclude=[]))
+    if n_eog < 2:
+        for ch, eog_ch in eog_remap.items():
+            if ch in raw.ch_names:
+                raw.set_channel_types({ch: 'eog'})
+                raw.rename_channels({ch: eog_ch})
+                renames[ch] = eog_ch
+    return renames
+
+
+def detect_eog(raw, event_id=998, l_freq=1, h_freq=10, filter_length='10s',
+               saccade_thresh=5., saccade_gap=0.2, blink_duration=0.5):
+    '''
+    Detect blinks and saccades on the EOG channels of raw.
+        - Blinks: same events as mne.preprocessing.find_eog_events, i.e.
+          peaks of the l_freq-h_freq filtered EOG channel with the highest
+          power.
+        - Saccades: onsets of the periods where the velocity of the h_freq
+          low-passed EOG (on any channel) exceeds saccade_thresh robust
+          standard deviations, outside blinks (+/- blink_duration / 2).
+          Periods less than saccade_gap s apart (filter ringing) are merged.
+    Returns a dict with the EOG channel names, their power ('scores'), the
+    channel used for blinks, the blink and saccade events (n_events, 3) and
+    their magnitudes.
+    '''
+    
+    # Read all EOG channels at once
+    picks = mne.pick_types(raw.info, meg=False, eog=True, exclude=[])
+    if len(picks) == 0:
+        raise ValueError("No EOG channels")
+    ch_names = [raw.ch_names[i] for i in picks]
+    sfreq = raw.info['sfreq']
+    eog = raw.get_data(picks=picks)
+    
+    # Filter all channels together (same filters as find_eog_events)
+    filter_kwargs = dict(filter_length=filter_length,
+                         l_trans_bandwidth=0.5,
+                         h_trans_bandwidth=0.5,
+                         phase='zero-double',
+                         fir_window='hann',
+                         fir_design='firwin2',
+                         verbose='error')
+    fmax = np.minimum(45, sfreq / 2. - 0.75)
+    eog_dc = mne.filter.filter_data(eog, sfreq, 2, fmax, **filter_kwargs)
+    eog_blink = mne.filter.filter_data(eog, sfreq, l_freq, h_freq,
+                                       **filter_kwargs)
+    eog_low = mne.filter.filter_data(eog, sfreq, None, h_freq,
+                                     **filter_kwargs)
+    
+    # Get power of each channel and select the blink channel
+    scores = np.sqrt(np.sum(eog_dc ** 2, axis=1))
+    blink_ch = int(np.argmax(scores))
+    del eog_dc
+    
+    ##########
+    # BLINKS #
+    ##########
+    
+    # Find peaks with the polarity of the largest deflection
+    x = eog_blink[blink_ch]
+    temp = x - np.mean(x)
+    extrema = 1 if np.abs(np.max(temp)) > np.abs(np.min(temp)) else -1
+    blink_idx, blink_mags = peak_finder(x, extrema=extrema, verbose='error')
+    blink_idx = np.atleast_1d(blink_idx).astype(int)
+    blink_mags = np.atleast_1d(blink_mags).astype(float)
+    
+    ############
+    # SACCADES #
+    ############
+    
+    # Get the velocity of all channels in robust z-scores (standard 
+    # deviation estimated from the median absolute velocity)
+    velocity = np.abs(np.diff(eog_low, axis=1))
+    std = np.median(velocity, axis=1, keepdims=True) / 0.6745
+    velocity_z = (velocity / std).max(axis=0)
+    del velocity, eog_low
+    
+    # Mask the blinks
+    fast = velocity_z > saccade_thresh
+    half = int(round(blink_duration / 2. * sfreq))
+    blink_mask = np.zeros(len(fast) + 1, dtype=int)
+    np.add.at(blink_mask, np.clip(blink_idx - half, 0, len(fast)), 1)
+    np.add.at(blink_mask, np.clip(blink_idx + half + 1, 0, len(fast)), -1)
+    fast &= np.cumsum(blink_mask)[:-1] == 0
+    
+    # Get onset and end of each fast period
+    edges = np.diff(np.concatenate([[0], fast.astype(np.int8), [0]]))
+    saccade_idx = np.where(edges == 1)[0]
+    saccade_stops = np.where(edges == -1)[0]
+    
+    # Merge periods separated by short gaps and get their peak velocity
+    saccade_mags = np.zeros(0)
+    if len(saccade_idx):
+        new = np.concatenate([[True], (saccade_idx[1:] - saccade_stops[:-1]
+                                       >= saccade_gap * sfreq)])
+        saccade_idx = saccade_idx[new]
+        saccade_stops = saccade_stops[np.concatenate([new[1:], [True]])]
+        bounds = np.stack([saccade_idx, saccade_stops], axis=1).ravel()
+        saccade_mags = np.maximum.reduceat(np.append(velocity_z, 0.),
+                                           bounds)[::2]
+    
+    return {'ch_names': ch_names,
+            'scores': scores,
+            'blink_ch': blink_ch,
+            'blinks': _make_events(blink_idx + raw.first_samp, event_id),
+            'blink_mags': blink_mags,
+            'saccades': _make_events(saccade_idx + raw.first_samp, event_id),
+            'saccade_mags': saccade_mags}
+
+
+def detect_eog_cached(raw, raw_fname, fname_sidecar, **kwargs):
+    '''
+    detect_eog() results of the data of raw_fname, read from the sidecar
+    file fname_sidecar when it was made from the same file, EOG channels
+    and parameters (or computed and stored in it otherwise).
+    '''
+    
+    # Identify the data and parameters
+    picks = mne.pick_types(raw.info, meg=False, eog=True, exclude=[])
+    key = make_key(file_hash(raw_fname),
+                   ch_names=[raw.ch_names[i] for i in picks],
+                   mne=mne.__version__,
+                   **kwargs)
+    
+    # Read sidecar
+    if op.exists(fname_sidecar):
+        eog = read_eog(fname_sidecar)
+        if eog.pop('key') == key:
+            print("    Reading EOG events from sidecar: %s" % fname_sidecar)
+            return eog
+    
+    # Detect and store
+    eog = detect_eog(raw, **kwargs)
+    with atomic_open(fname_sidecar) as f:
+        np.savez(f,
+                 key=key,
+                 ch_names=np.array(eog['ch_names'], dtype=str),
+                 **{k: v for k, v in eog.items() if k != 'ch_names'})
+    
+    return eog
+
+
+def read_eog(fname_sidecar):
+    '''
+    Read the EOG events and scores stored by detect_eog_cached().
+    '''
+    with np.load(fname_sidecar) as sidecar:
+        eog = {k: sidecar[k] for k in sidecar.files}
+    eog['ch_names'] = eog['ch_names'].tolist()
+    eog['blink_ch'] = int(eog['blink_ch'])
+    eog['key'] = str(eog['key'])
+    return eog
+
+
+def _make_events(samples, event_id):
+    # MNE events array of the samples
+    events = np.zeros((len(samples), 3), dtype=int)
+    events[:, 0] = samples
+    events[:, 2] = event_id
+    return events
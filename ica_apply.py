@@ -0,0 +1,122 @@
+"""
+=========
+ICA apply
+=========
+
+Removal of the excluded components of the MEG and EEG ICAs of a subject in
+a single pass over a recording.
+
+The cleaning of each ICA (ica.apply) is an affine transformation of its
+channels, obtained once per subject by applying it to the identity matrix
+(as a Raw object).
+The transformations of the MEG and EEG ICAs are combined into one
+block-diagonal operator, which CleanedRaw applies while the data are read,
+one float32 matrix product per chunk: plotting a CleanedRaw only cleans the
+plotted window, and saving it streams the cleaned recording to file without
+loading or copying it.
+
+"""
+
+import numpy as np
+import scipy.linalg
+
+import mne
+from mne.io import BaseRaw
+from mne.preprocessing import read_ica
+
+
+def read_icas(ica_fnames, excludes):
+    '''
+    ICAs of the files ica_fnames, with their excluded components.
+    '''
+    icas = []
+    for ica_fname, exclude in zip(ica_fnames, excludes):
+        ica = read_ica(ica_fname, verbose='error')
+        ica.exclude = [int(i) for i in exclude]
+        icas.append(ica)
+    return icas
+
+
+def cleaning_operator(icas):
+    '''
+    Transformation of the data by ica.apply() for each of icas (with their
+    excluded components), combined: channels ch_names, block-diagonal
+    operator and offset, so that the cleaned data of ch_names are
+    operator @ data + offset. ICAs without excluded components are skipped.
+    '''
+    ch_names = []
+    blocks = []
+    offsets = []
+    for ica in icas:
+        if not ica.exclude:
+            continue
+        overlap = set(ch_names) & set(ica.ch_names)
+        if overlap:
+            raise ValueError("The ICAs share the channels %s"
+                             % sorted(overlap))
+        
+        # Apply to no data (offset) and to unit impulses (matrix)
+        n_chan = len(ica.ch_names)
+        offset = _apply_ica(ica, np.zeros((n_chan, 1)))[:, 0]
+        matrix = _apply_ica(ica, np.eye(n_chan))
+        
+        ch_names += ica.ch_names
+        blocks.append(matrix - offset[:, np.newaxis])
+        offsets.append(offset)
+    
+    if not blocks:
+        return [], np.zeros((0, 0)), np.zeros(0)
+    return ch_names, scipy.linalg.block_diag(*blocks), np.concatenate(offsets)
+
+
+class CleanedRaw(BaseRaw):
+    '''
+    Raw object whose data are the data of raw (not preloaded), with the
+    channels ch_names replaced by operator @ data + offset (computed in
+    dtype) when they are read. All the channels of raw are read before the
+    requested channels are picked, so that picking a subset of ch_names
+    gives the same data as picking it after cleaning.
+    '''
+    
+    def __init__(self, raw, ch_names, operator, offset, dtype=np.float32):
+        extras = {'raw': raw,
+                  'first_samp': raw.first_samp,
+                  'idx': np.array([raw.ch_names.index(ch) for ch in ch_names],
+                                  dtype=int),
+                  'operator': operator.astype(dtype),
+                  'offset': offset.astype(dtype)[:, np.newaxis],
+                  'cals': raw._cals.copy()}
+        super().__init__(raw.info.copy(),
+                         preload=False,
+                         first_samps=[raw.first_samp],
+                         last_samps=[raw.last_samp],
+                         raw_extras=[extras],
+                         orig_format=raw.orig_format,
+                         verbose='error')
+        self.set_annotations(raw.annotations)
+    
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        extras = self._raw_extras[fi]
+        
+        # Read the data of raw
+        block = extras['raw'].get_data(start=start - extras['first_samp'],
+                                       stop=stop - extras['first_samp'])
+        
+        # Clean the channels of the operator
+        if len(extras['idx']):
+            block[extras['idx']] = extras['operator'] @ \
+                block[extras['idx']].astype(extras['operator'].dtype) + \
+                extras['offset']
+        
+        # Return uncalibrated data, as read from a file
+        block /= extras['cals'][:, np.newaxis]
+        if mult is not None:
+            data[:] = mult @ block[idx]
+        else:
+            data[:] = block[idx] * cals
+
+
+def _apply_ica(ica, data):
+    # ica.apply() on data (one row per channel of ica)
+    raw = mne.io.RawArray(data, ica.info, verbose='error')
+    return ica.apply(raw, verbose='error').get_data()
@@ -0,0 +1,419 @@
+"""
+=================
+ICA training data
+=================
+
+Concatenation of the downsampled and band-pass filtered runs of a subject,
+on which the ICA is fitted.
+
+The concatenated array is allocated once from the run headers (the number
+of samples of each run after resampling is known before reading it) and
+each run is resampled and filtered, then copied into its slice, so that the
+cost is linear in the number of runs and only one full-rate run per loading
+thread is held in memory. Annotations and boundaries between runs are the
+same as with mne.concatenate_raws.
+
+By default, each run is streamed from disk and resampled and filtered in a
+single frequency-domain pass per chunk (load_run_fused), written straight
+into its slice. Run this module to compare it with raw.resample followed by
+raw.filter on a synthetic recording.
+
+"""
+
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+import scipy.fft
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+
+import mne
+
+from sidecar import read_raw_stage
+from annot_index import AnnotationIndex
+
+
+def training_raw(file_names, sfreq, l_freq, h_freq, stage='artif',
+                 n_threads=1, fused=True, shared=False, n_samples=None,
+                 skip=('bad', 'blink')):
+    '''
+    Raw object of the runs file_names (as output by stage) resampled to
+    sfreq and filtered between l_freq and h_freq, concatenated.
+        - n_threads: number of runs read and processed at the same time
+        - fused: resample and filter in a single streamed pass
+          (load_run_fused), or with raw.resample and raw.filter (load_run)
+        - shared: allocate the data in a shared memory block (raw._shared,
+          unlinked when raw is deleted), which worker processes can read
+          without a copy (ica_fit.fit_icas)
+        - n_samples: keep only n_samples samples of the runs, outside the 
+          annotations whose description starts with one of skip (see
+          training_samples), in a raw object without annotations (None =
+          all samples)
+    '''
+    
+    # Read headers
+    raws = [read_raw_stage(file_name, stage) for file_name in file_names]
+    for raw in raws[1:]:
+        for kind in ['ch_names', 'bads']:
+            if raw.info[kind] != raws[0].info[kind]:
+                raise ValueError("The runs must have the same %s to be "
+                                 "concatenated" % kind)
+    n_times = [n_resampled(raw, sfreq) for raw in raws]
+    
+    # Get training samples of each run (from the run headers at sfreq)
+    samples = None
+    n_train = n_times
+    if n_samples is not None:
+        samples = training_samples(
+            [_stand_in(resampled_info(raw.info, sfreq, l_freq, h_freq),
+                       resampled_first_samp(raw, sfreq), n,
+                       raw.annotations)[0]
+             for raw, n in zip(raws, n_times)],
+            n_samples, skip)
+        n_train = [len(s) for s in samples]
+    
+    # Allocate concatenated data
+    bounds = np.concatenate([[0], np.cumsum(n_train)])
+    shape = (len(raws[0].ch_names), bounds[-1])
+    if shared:
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=8 * shape[0] * shape[1])
+        data = np.ndarray(shape, np.float64, buffer=shm.buf)
+    else:
+        data = np.empty(shape)
+    
+    # Fill each run slice
+    def fill(i):
+        print("  File: %s" % file_names[i])
+        raw = raws[i]
+        raws[i] = None
+        out = data[:, bounds[i]:bounds[i + 1]] if samples is None else None
+        
+        # Resample and filter in one pass (straight into the run slice when
+        # all samples are kept)
+        if fused:
+            run_data = load_run_fused(raw, sfreq, l_freq, h_freq, out=out)
+            info = resampled_info(raw.info, sfreq, l_freq, h_freq)
+            first_samp = resampled_first_samp(raw, sfreq)
+        
+        # Resample and filter
+        else:
+            raw = load_run(raw, sfreq, l_freq, h_freq)
+            if len(raw.times) != n_times[i]:
+                raise RuntimeError("Unexpected number of samples after "
+                                   "resampling %s" % file_names[i])
+            run_data = raw._data
+            info, first_samp = raw.info, raw.first_samp
+        
+        # Copy the training samples into the run slice
+        if run_data is not out:
+            data[:, bounds[i]:bounds[i + 1]] = \
+                run_data if samples is None else run_data[:, samples[i]]
+        del run_data
+        
+        # Keep header and annotations of the run only
+        return _stand_in(info, first_samp, n_times[i], raw.annotations)
+    
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            stand_ins = list(executor.map(fill, range(len(raws))))
+    else:
+        stand_ins = [fill(i) for i in range(len(raws))]
+    del raws
+    
+    # Make raw object of the training samples
+    if samples is not None:
+        raw_all = mne.io.RawArray(data, stand_ins[0][1],
+                                  copy=None,
+                                  verbose='error')
+        print("    %s training samples (%.0f s)"
+              % (shape[1], shape[1] / float(sfreq)))
+    
+    # Make raw object of the data, with annotations and boundaries between
+    # runs
+    else:
+        headers = mne.concatenate_raws([raw for raw, info in stand_ins])
+        raw_all = mne.io.RawArray(data, stand_ins[0][1],
+                                  first_samp=headers.first_samp,
+                                  copy=None,
+                                  verbose='error')
+        raw_all.set_annotations(headers.annotations)
+    
+    if shared:
+        raw_all._shared = shm
+        weakref.finalize(raw_all, shm.unlink)
+    
+    return raw_all
+
+
+def training_samples(raws, n_samples, skip=('bad', 'blink')):
+    '''
+    Samples of each of raws used to fit the ICA: n_samples in all (or all
+    the samples if there are fewer), outside the annotations whose 
+    description starts with one of skip (e.g. muscle artifacts and blinks
+    of 03), shared between the runs in proportion to their number of such
+    samples and evenly spaced within each run. Returns the sample indices of
+    each run.
+    '''
+    
+    # Find samples outside the skipped annotations
+    clean = []
+    for raw in raws:
+        index = AnnotationIndex.from_raw(raw, descriptions=skip)
+        times = raw.first_samp + np.arange(len(raw.times))
+        clean.append(np.where(~index.overlaps(times, times + 1))[0])
+    n_clean = np.array([len(c) for c in clean])
+    if n_samples >= n_clean.sum():
+        return clean
+    
+    # Share samples between runs (largest remainders)
+    share = n_samples * n_clean / n_clean.sum()
+    quotas = np.floor(share).astype(int)
+    quotas[np.argsort(quotas - share)[:n_samples - quotas.sum()]] += 1
+    
+    # Take evenly spaced samples
+    return [c[np.round(np.linspace(0, len(c) - 1, q)).astype(int)]
+            for c, q in zip(clean, quotas)]
+
+
+def training_head(file_name, sfreq, l_freq, h_freq, duration, 
+                  stage='artif', fused=True):
+    '''
+    Raw object of the first duration s of the run file_name (as output by
+    stage), resampled to sfreq and filtered between l_freq and h_freq as
+    in training_raw, e.g. to plot ICA sources when the ICA was fitted on a
+    subset of samples.
+    '''
+    raw = read_raw_stage(file_name, stage)
+    raw.crop(tmax=min(duration, raw.times[-1]))
+    if fused:
+        head = mne.io.RawArray(load_run_fused(raw, sfreq, l_freq, h_freq),
+                               resampled_info(raw.info, sfreq, l_freq, h_freq),
+                               first_samp=resampled_first_samp(raw, sfreq),
+                               verbose='error')
+        head.set_annotations(raw.annotations, verbose='error')
+        return head
+    return load_run(raw, sfreq, l_freq, h_freq)
+
+
+def load_run(raw, sfreq, l_freq, h_freq):
+    '''
+    Load the data of raw, resampled to sfreq and filtered between l_freq
+    and h_freq (in place, without a full-rate copy).
+    '''
+    raw.load_data()
+    raw.resample(sfreq)
+    raw.filter(l_freq, h_freq)
+    return raw
+
+
+def load_run_fused(raw, sfreq, l_freq, h_freq, out=None,
+                   chunk_duration=60.):
+    '''
+    Data of raw resampled to sfreq and filtered between l_freq and h_freq
+    in a single pass (float32), read chunk by chunk (raw does not need to be
+    preloaded). Each chunk (with margins) is transformed once to the
+    frequency domain, multiplied by the response of the band-pass filter
+    raw.filter uses at sfreq and transformed back keeping only the 
+    frequencies below the new Nyquist frequency, i.e. directly at sfreq 
+    (the stop band of the filter is below the new Nyquist frequency, so it
+    is also the anti-aliasing filter). Stimulus channels are decimated 
+    without filtering. Returns out (array of n_resampled() samples, 
+    allocated if None).
+    '''
+    orig_sfreq = raw.info['sfreq']
+    if h_freq is None or h_freq >= sfreq / 2.:
+        raise ValueError("h_freq (%s) must be below the Nyquist frequency "
+                         "of the resampled data (%s Hz)" % (h_freq, sfreq / 2.))
+    
+    # Get resampling factors
+    ratio = Fraction(float(sfreq) / orig_sfreq).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+    
+    # Band-pass filter with the transition bands raw.filter uses at sfreq
+    h = mne.filter.create_filter(
+        None, orig_sfreq, l_freq, h_freq,
+        h_trans_bandwidth=min(max(h_freq * 0.25, 2.), sfreq / 2. - h_freq),
+        fir_design='firwin',
+        verbose='error')
+    center = (len(h) - 1) // 2
+    responses = {}
+    
+    # Get filtered and stimulus channels
+    stim = mne.pick_types(raw.info, meg=False, stim=True, exclude=[])
+    picks = np.setdiff1d(np.arange(len(raw.ch_names)), stim)
+    
+    n_out = n_resampled(raw, sfreq)
+    if out is None:
+        out = np.empty((len(raw.ch_names), n_out))
+    n_chunk = int(chunk_duration * sfreq)
+    for start in range(0, n_out, n_chunk):
+        stop = min(start + n_chunk, n_out)
+        
+        # Read the chunk with margins of half the filter length (output 
+        # sample m is input sample m * down / up, the chunk starts on a
+        # multiple of down so that it falls on an output sample)
+        read_start = (start * down // up - center) // down * down
+        read_stop = -(-(stop - 1) * down // up) + center + 1
+        n_fft = down * scipy.fft.next_fast_len(
+            -(-(read_stop - read_start) // down))
+        x = _read_padded(raw, picks, read_start, read_start + n_fft)
+        
+        # Get zero-phase filter response
+        if n_fft not in responses:
+            h_fft = np.zeros(n_fft)
+            h_fft[:len(h)] = h
+            responses[n_fft] = scipy.fft.rfft(np.roll(h_fft, -center)
+                                              ).real.astype(np.float32)
+        
+        # Filter and keep the frequencies below the new Nyquist frequency
+        n_fft_out = n_fft * up // down
+        n_freqs = n_fft_out // 2 + 1
+        x_fft = scipy.fft.rfft(x, axis=-1)[:, :n_freqs]
+        x_fft *= responses[n_fft][:n_freqs]
+        y = scipy.fft.irfft(x_fft, n=n_fft_out, axis=-1)
+        first = start - read_start * up // down
+        out[picks, start:stop] = y[:, first:first + stop - start] * up / down
+        
+        # Decimate stimulus channels
+        if len(stim):
+            samples = np.minimum(np.round(np.arange(start, stop) * down / up),
+                                 len(raw.times) - 1).astype(int)
+            stim_data = raw.get_data(picks=stim,
+                                     start=samples[0],
+                                     stop=samples[-1] + 1)
+            out[stim, start:stop] = stim_data[:, samples - samples[0]]
+    
+    return out
+
+
+def resampled_info(info, sfreq, l_freq, h_freq):
+    '''
+    Copy of info after resampling to sfreq and filtering between l_freq and
+    h_freq.
+    '''
+    info = info.copy()
+    with info._unlock():
+        info['sfreq'] = float(sfreq)
+        info['lowpass'] = float(h_freq)
+        if l_freq is not None:
+            info['highpass'] = float(l_freq)
+    return info
+
+
+def n_resampled(raw, sfreq):
+    '''
+    Number of samples of raw after resampling to sfreq (each file of raw is
+    resampled separately, as in raw.resample).
+    '''
+    ratio = float(sfreq) / raw.info['sfreq']
+    return int(sum(max(int(round(ratio * n)), 1) for n in raw._raw_lengths))
+
+
+def resampled_first_samp(raw, sfreq):
+    '''
+    First sample of raw after resampling to sfreq.
+    '''
+    return int(np.round(raw.first_samp * sfreq / raw.info['sfreq']))
+
+
+def _stand_in(info, first_samp, n_times, annotations):
+    # One-channel raw with the length, first sample, measurement date and
+    # annotations of a run, and the info of the run
+    info_stand_in = mne.create_info(1, info['sfreq'])
+    with info_stand_in._unlock():
+        info_stand_in['meas_date'] = info['meas_date']
+    stand_in = mne.io.RawArray(np.zeros((1, n_times), np.float32),
+                               info_stand_in,
+                               first_samp=first_samp,
+                               verbose='error')
+    stand_in.set_annotations(annotations, verbose='error')
+    return stand_in, info
+
+
+def _read_padded(raw, picks, start, stop):
+    # Data (float32) of the samples start to stop, padded outside the 
+    # recording with point reflections (limited to the length of the data,
+    # then zeros, as MNE does)
+    n_times = len(raw.times)
+    x = raw.get_data(picks=picks,
+                     start=max(start, 0),
+                     stop=min(stop, n_times)).astype(np.float32)
+    n_left = max(-start, 0)
+    n_right = max(stop - n_times, 0)
+    if n_left or n_right:
+        n_l = min(n_left, x.shape[1] - 1)
+        n_r = min(n_right, x.shape[1] - 1)
+        x = np.concatenate([np.zeros((len(x), n_left - n_l), np.float32),
+                            2 * x[:, :1] - x[:, n_l:0:-1],
+                            x,
+                            2 * x[:, -1:] - x[:, -2:-n_r - 2:-1],
+                            np.zeros((len(x), n_right - n_r), np.float32)],
+                           axis=1)
+    return x
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def benchmark(n_channels=100, duration=600., orig_sfreq=1000., sfreq=200.,
+              l_freq=1., h_freq=40.):
+    '''
+    Time and peak memory of the two-step (load_run) and fused
+    (load_run_fused) paths on a synthetic recording read from disk, and
+    relative difference of their outputs to the decimated output of
+    raw.filter at the original sampling rate.
+    '''
+    import os.path as op
+    import tempfile
+    import time
+    import tracemalloc
+    
+    # Make synthetic recording (broadband noise and alpha oscillations)
+    rng = np.random.RandomState(0)
+    n_times = int(duration * orig_sfreq)
+    times = np.arange(n_times) / orig_sfreq
+    data = rng.randn(n_channels, n_times)
+    data += 5 * np.sin(2 * np.pi * 10 * times + rng.rand(n_channels, 1) * 6)
+    info = mne.create_info(n_channels, orig_sfreq, 'mag')
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = op.join(tmp_dir, 'benchmark_raw.fif')
+        mne.io.RawArray(data * 1e-12, info, verbose='error').save(
+            fname, verbose='error')
+        
+        # Run both paths
+        results = {}
+        for name in ['two-step', 'fused']:
+            raw = mne.io.read_raw_fif(fname, verbose='error')
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            if name == 'fused':
+                out = load_run_fused(raw, sfreq, l_freq, h_freq)
+            else:
+                with mne.utils.use_log_level('error'):
+                    out = load_run(raw, sfreq, l_freq, h_freq)._data
+            duration_s = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1] / 1024 ** 3
+            tracemalloc.stop()
+            results[name] = out
+            print("%s: %.2f s, peak memory %.2f GB" % (name, duration_s, peak))
+            del raw
+    
+    # Compare outputs with the decimated output of raw.filter at the 
+    # original sampling rate (on 10 channels), 10 s edges excluded
+    raw = mne.io.RawArray(data[:10] * 1e-12,
+                          mne.create_info(10, orig_sfreq, 'mag'),
+                          verbose='error')
+    ref = raw.filter(l_freq, h_freq, verbose='error').get_data()
+    n_out = results['fused'].shape[1]
+    ref = ref[:, np.round(np.arange(n_out) * orig_sfreq / sfreq).astype(int)]
+    edge = slice(int(10 * sfreq), -int(10 * sfreq))
+    for name, out in results.items():
+        print("%s: relative difference to the filtered data %.2e"
+              % (name, np.linalg.norm(out[:10, edge] - ref[:, edge])
+                 / np.linalg.norm(ref[:, edge])))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,476 @@
+"""
+=======
+ICA fit
+=======
+
+Fit of the MEG and EEG ICAs of a subject on the ICA training data.
+
+The two ICAs are fitted at the same time in separate worker processes,
+which read the training data from one shared memory block (no copy per
+worker), so that the fitting time is that of the slower ICA.
+
+The PCA of each fit (the singular value decomposition of the pre-whitened
+data, its most expensive step before the ICA solver) is cached on disk,
+keyed by the hash of the pre-whitened data: refitting the same data with
+another n_components, max_iter or solver only projects the data on the
+cached components. The cache replaces the private PCA class of MNE during
+the fit, which is only done with the MNE versions it was tested with (see
+mne_private).
+
+The solver (fastica, picard or extended infomax) can start from the unmixing
+matrix of a previous fit (warm start), e.g. the ICA files of the previous
+run of 05: the matrix is mapped from the PCA space of the previous fit to
+the new one, so that a refit after a small upstream change needs only a few
+iterations.
+
+The ICAs can also be fitted on a subset of the training samples (see
+ica_data.training_samples), and compared with a fit on all samples
+(component_match).
+
+Run this module to compare the solvers, and fits on subsets of samples
+with a fit on all samples, on synthetic mixtures.
+
+"""
+
+import os.path as op
+import io
+import hashlib
+import time
+import warnings
+import contextlib
+import functools
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import mne
+import mne.preprocessing.ica
+from mne.preprocessing import ICA
+
+from cache import make_key, cache_fname, atomic_open
+from parallel import run_parallel
+from mne_private import mne_private
+
+
+# PCA class used by ICA.fit
+_PCA = mne.preprocessing.ica._PCA
+
+# ICA solvers: MNE method, fit parameters and name of the parameter of the
+# initial unmixing matrix
+solvers = {'fastica': ('fastica', {}, 'w_init'),
+           'picard': ('picard', {'ortho': True, 'extended': True}, 'w_init'),
+           'extended-infomax': ('infomax', {'extended': True}, 'weights')}
+
+
+def fit_icas(raw, fits, n_jobs=2, max_mem=None):
+    '''
+    Fit one ICA per (picks, fit_ica parameters) in fits on raw (with
+    fit_ica). Returns the fitted ICAs and their fit statistics, in the order
+    of fits.
+        - n_jobs: number of ICAs fitted at the same time in worker processes
+          reading the data of raw from shared memory (1 = one after the
+          other, in this process)
+        - max_mem: address space cap per worker process in GB (see 
+          parallel.run_parallel; None = no cap)
+    '''
+    
+    # Serial fits
+    if n_jobs == 1 or len(fits) < 2:
+        return [fit_ica(raw, picks, **params) for picks, params in fits]
+    
+    # Use the shared memory block of the data (training_raw(shared=True)),
+    # or copy the data to a new one
+    shm = getattr(raw, '_shared', None)
+    copied = shm is None
+    if copied:
+        shm = shared_memory.SharedMemory(create=True, size=raw._data.nbytes)
+        data = np.ndarray(raw._data.shape, raw._data.dtype, buffer=shm.buf)
+        data[:] = raw._data
+        del data
+    
+    # Fit in worker processes
+    try:
+        jobs = [(shm.name, raw._data.shape, raw._data.dtype.str, raw.info,
+                 raw.first_samp, raw.annotations, picks, params)
+                for picks, params in fits]
+        icas = run_parallel(_fit_shared, jobs, n_jobs=n_jobs, max_mem=max_mem)
+    finally:
+        if copied:
+            shm.close()
+            shm.unlink()
+    
+    return icas
+
+
+def fit_ica(raw, picks, method='fastica', init=None, cache=True,
+            **params):
+    '''
+    ICA(**params) fitted on the channels picks of raw with the solver
+    method (see solvers), with its PCA read from the cache when the same
+    data was decomposed before (cache=True). Returns the ICA and its fit
+    statistics (solver, warm start, number of components and iterations,
+    fit time in s).
+        - init: ICA fitted before (e.g. read from the ICA file of a previous
+          run of 05), whose unmixing matrix is the initial matrix of the
+          solver if it has the same channels (warm start), or None (random)
+    '''
+    if method not in solvers:
+        raise ValueError("Unknown ICA solver %s, use one of %s"
+                         % (method, list(solvers)))
+    mne_method, fit_params, init_param = solvers[method]
+    ica = ICA(method=mne_method, fit_params=dict(fit_params), **params)
+    
+    # Fit
+    t0 = time.perf_counter()
+    with cached_pca(ica, init, init_param, cache) as used:
+        ica.fit(raw, picks=picks)
+    fit_time = time.perf_counter() - t0
+    if not used:
+        raise RuntimeError("ICA.fit did not use mne.preprocessing.ica._PCA "
+                           "in MNE %s, the PCA cache and warm start cannot "
+                           "be used" % mne.__version__)
+    
+    # Keep the initial matrix out of the ICA file
+    warm_start = ica.fit_params.pop(init_param, None) is not None
+    
+    stats = {'picks': picks,
+             'method': method,
+             'warm_start': warm_start,
+             'n_components': int(ica.n_components_),
+             'n_iter': int(ica.n_iter_),
+             'fit_time': fit_time}
+    print("    %s ICA (%s%s): %s components, %s iterations, %.1f s"
+          % (picks, method, ', warm start' if warm_start else '',
+             stats['n_components'], stats['n_iter'], fit_time))
+    
+    return ica, stats
+
+
+def read_init(fname):
+    '''
+    ICA of fname to warm-start a new fit (fit_ica), or None if the file does
+    not exist.
+    '''
+    if not op.exists(fname):
+        return None
+    print("    Reading initial ICA: %s" % fname)
+    return mne.preprocessing.read_ica(fname, verbose='error')
+
+
+@contextlib.contextmanager
+def cached_pca(ica=None, init=None, init_param='w_init', cache=True):
+    '''
+    Context in which ICA.fit uses CachedPCA (with the warm start of the 
+    solver of ica from init). Yields the list of the CachedPCA objects
+    fitted in the context, to check that ICA.fit used them.
+    '''
+    mne_private(mne.preprocessing.ica, '_PCA', 'The ICA PCA cache')
+    used = []
+    mne.preprocessing.ica._PCA = functools.partial(CachedPCA,
+                                                   ica=ica,
+                                                   init=init,
+                                                   init_param=init_param,
+                                                   cache=cache,
+                                                   used=used)
+    try:
+        yield used
+    finally:
+        mne.preprocessing.ica._PCA = _PCA
+
+
+class CachedPCA(_PCA):
+    '''
+    PCA of MNE (used by ICA.fit) whose decomposition is cached on disk,
+    keyed by the hash of the data and the PCA parameters. When init is given,
+    it also sets the initial unmixing matrix of the solver of ica
+    (fit_params[init_param]) from init, once the PCA space is known. Fitted
+    objects are added to used.
+    '''
+    
+    attributes = ['mean_', 'components_', 'explained_variance_',
+                  'explained_variance_ratio_', 'n_components_']
+    
+    def __init__(self, n_components=None, whiten=False, ica=None, init=None,
+                 init_param='w_init', cache=True, used=None):
+        super().__init__(n_components=n_components, whiten=whiten)
+        self.ica = ica
+        self.init = init
+        self.init_param = init_param
+        self.cache = cache
+        self.used = [] if used is None else used
+    
+    def fit_transform(self, X, y=None):
+        self.used.append(self)
+        U = self._cached_fit_transform(X) if self.cache else \
+            super().fit_transform(X)
+        
+        # Initial unmixing matrix of the solver (if init has the channels 
+        # of ica)
+        if self.init is not None and self.init.ch_names != self.ica.ch_names:
+            print("    The initial ICA has other channels, starting from a "
+                  "random unmixing matrix")
+        elif self.init is not None:
+            n_components = ica_n_components(self.ica,
+                                            self.explained_variance_ratio_)
+            self.ica.fit_params[self.init_param] = warm_unmixing(
+                self.init, self.ica, self, n_components)
+        
+        return U
+    
+    def _cached_fit_transform(self, X):
+        key = make_key(array_hash(X),
+                       n_components=self.n_components,
+                       whiten=self.whiten,
+                       mne=mne.__version__)
+        fname = cache_fname('ica_pca', key)
+        
+        # Decompose and store the decomposition
+        if not op.exists(fname):
+            U = super().fit_transform(X)
+            with atomic_open(fname) as f:
+                np.savez(f, **{attr: getattr(self, attr)
+                               for attr in self.attributes})
+            print("    Writing PCA to cache: %s" % fname)
+            return U
+        
+        # Read the decomposition
+        print("    Reading PCA from cache: %s" % fname)
+        with np.load(fname) as cached:
+            for attr in self.attributes:
+                setattr(self, attr, cached[attr])
+        self.n_components_ = int(self.n_components_)
+        
+        # Project the data on the components (X V / sqrt(variance) is the
+        # whitened U of the decomposition, X V is U S)
+        components = self.components_[:self.n_components_]
+        U = (X - self.mean_) @ components.T
+        if self.whiten:
+            scale = np.sqrt(self.explained_variance_[:self.n_components_])
+            U /= np.where(scale > 0, scale, np.inf)
+        return U
+
+
+def warm_unmixing(init, ica, pca, n_components):
+    '''
+    Unmixing matrix of init expressed in the whitened space of the first
+    n_components components of pca (the input of the solver of ica), 
+    orthogonalised. Components of init are dropped (smallest in this space
+    first), or completed by orthogonal ones, to get n_components.
+    '''
+    
+    # Unmixing of init in the pre-whitened sensor space of ica
+    unmixing = init.unmixing_matrix_ @ init.pca_components_[:init.n_components_]
+    unmixing = unmixing * (ica.pre_whitener_ / init.pre_whitener_).T
+    
+    # Project on the whitened PCA space
+    w = unmixing @ pca.components_[:n_components].T
+    w *= np.sqrt(pca.explained_variance_[:n_components])
+    w = w[np.argsort(-np.linalg.norm(w, axis=1))[:n_components]]
+    
+    # Orthogonalise (symmetric decorrelation) and complete
+    u, s, vt = np.linalg.svd(w)
+    return np.concatenate([u @ vt[:len(w)], vt[len(w):]])
+
+
+def ica_n_components(ica, explained_variance_ratio):
+    '''
+    Number of components ICA.fit keeps from a PCA (n_components_).
+    '''
+    n_components = ica.n_components
+    if n_components is None:
+        n_components = 0.999999
+    if isinstance(n_components, float):
+        cumul = np.cumsum(explained_variance_ratio)
+        cumul /= cumul[-1]
+        return int(min((cumul <= n_components).sum() + 1, len(cumul)))
+    return int(n_components)
+
+
+def component_match(ica, ref):
+    '''
+    Similarity of the components of ica to those of ref, fitted on the same
+    channels (e.g. on a subset of the samples and on all samples): absolute
+    correlation of the topographies of the components matched one to one.
+    Returns the mean and the minimum over the pairs.
+    '''
+    corr = _match(ica.get_components().T, ref.get_components().T)
+    return corr.mean(), corr.min()
+
+
+def array_hash(X, block_size=2**16):
+    '''
+    Content hash (sha1) of an array, including its shape and type (rows
+    are hashed by blocks, without a contiguous copy of the whole array).
+    '''
+    h = hashlib.sha1(('%s %s' % (X.shape, X.dtype.str)).encode())
+    for start in range(0, len(X), block_size):
+        h.update(np.ascontiguousarray(X[start:start + block_size]).data)
+    return h.hexdigest()
+
+
+def head_raw(raw, duration):
+    '''
+    Raw object of the first duration s of raw (data copied, with the
+    annotations in this span), e.g. to plot ICA sources without computing
+    them on the whole recording.
+    '''
+    stop = min(int(round(duration * raw.info['sfreq'])), len(raw.times))
+    head = mne.io.RawArray(raw.get_data(stop=stop), raw.info,
+                           first_samp=raw.first_samp,
+                           verbose='error')
+    head.set_annotations(raw.annotations, verbose='error')
+    return head
+
+
+def _match(a, b):
+    # Absolute correlation of the rows of a and b matched one to one (best
+    # total correlation)
+    corr = np.abs(np.corrcoef(a, b)[:len(a), len(a):])
+    rows, cols = linear_sum_assignment(-corr)
+    return corr[rows, cols]
+
+
+def _fit_shared(shm_name, shape, dtype, info, first_samp, annotations,
+                picks, params):
+    # fit_ica() on the data of a shared memory block (in a worker process)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    data = np.ndarray(shape, dtype, buffer=shm.buf)
+    raw = mne.io.RawArray(data, info,
+                          first_samp=first_samp,
+                          copy=None,
+                          verbose='error')
+    raw.set_annotations(annotations)
+    result = fit_ica(raw, picks, **params)
+    
+    del raw, data
+    shm.close()
+    return result
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def benchmark(n_channels=64, n_sources=20, duration=300., sfreq=200.,
+              methods=None, n_seeds=3, max_iter=1000):
+    '''
+    Compare the solvers on a synthetic mixture of sub- and super-gaussian
+    sources: fit time and iterations, component stability (mean absolute
+    correlation of the matched components of fits with different seeds),
+    accuracy (same, with the true sources), and iterations and fit time of
+    a refit of slightly changed data, cold and warm-started from the first
+    fit.
+    '''
+    
+    # Make synthetic mixture
+    sources, mixing = _synthetic_sources(n_channels, n_sources, duration,
+                                         sfreq)
+    raw = _synthetic_raw(sources, mixing, sfreq, seed=1)
+    raw_changed = _synthetic_raw(sources, mixing, sfreq, seed=2, gain=0.02)
+    
+    params = dict(n_components=n_sources, max_iter=max_iter)
+    print("%-17s %8s %6s %10s %9s %11s %11s"
+          % ('solver', 'time (s)', 'iter', 'stability', 'accuracy',
+             'cold refit', 'warm refit'))
+    for method in methods or list(solvers):
+        
+        # Cold fits with different seeds
+        try:
+            fits = [_quiet_fit(raw, 'eeg', method=method, random_state=seed,
+                               **params)
+                    for seed in range(n_seeds)]
+        except ImportError:
+            print("%-17s not installed" % method)
+            continue
+        estimates = [ica.get_sources(raw).get_data() for ica, stats in fits]
+        stability = np.mean([_match(estimates[i], estimates[j]).mean()
+                             for i in range(n_seeds)
+                             for j in range(i + 1, n_seeds)])
+        accuracy = np.mean([_match(est, sources).mean() for est in estimates])
+        
+        # Refit changed data, cold and warm-started
+        refits = [_quiet_fit(raw_changed, 'eeg', method=method, init=init,
+                             random_state=n_seeds, **params)[1]
+                  for init in [None, fits[0][0]]]
+        
+        print("%-17s %8.2f %6.0f %10.3f %9.3f %5d %5.2fs %5d %5.2fs"
+              % (method,
+                 np.mean([stats['fit_time'] for ica, stats in fits]),
+                 np.mean([stats['n_iter'] for ica, stats in fits]),
+                 stability, accuracy,
+                 refits[0]['n_iter'], refits[0]['fit_time'],
+                 refits[1]['n_iter'], refits[1]['fit_time']))
+
+
+def benchmark_subsample(n_channels=64, n_sources=20, duration=1800.,
+                        sfreq=200., n_samples=(20000, 50000, 100000),
+                        method='fastica'):
+    '''
+    Fit time, training data size and match with the fit on all samples
+    (component_match) of fits on subsets of the samples (training_samples,
+    skipping blink annotations) of a long synthetic mixture.
+    '''
+    from ica_data import training_samples
+    
+    # Make synthetic mixture, with a blink annotation every 5 s
+    sources, mixing = _synthetic_sources(n_channels, n_sources, duration,
+                                         sfreq)
+    raw = _synthetic_raw(sources, mixing, sfreq, seed=1)
+    onsets = np.arange(2., duration - 1., 5.)
+    raw.set_annotations(mne.Annotations(onsets, 0.5, 'Blink'))
+    
+    params = dict(method=method, n_components=n_sources, random_state=0)
+    full, full_stats = _quiet_fit(raw, 'eeg', **params)
+    print("%9s %8s %8s %10s %9s"
+          % ('samples', 'MB', 'time (s)', 'mean corr', 'min corr'))
+    print("%9s %8.0f %8.2f" % (len(raw.times), raw._data.nbytes / 1e6,
+                               full_stats['fit_time']))
+    for n in n_samples:
+        
+        # Fit on the subset
+        samples = training_samples([raw], n)[0]
+        subset = mne.io.RawArray(raw._data[:, samples], raw.info,
+                                 verbose='error')
+        ica, stats = _quiet_fit(subset, 'eeg', **params)
+        
+        print("%9s %8.0f %8.2f %10.4f %9.4f"
+              % ((n, subset._data.nbytes / 1e6, stats['fit_time'])
+                 + component_match(ica, full)))
+
+
+def _synthetic_sources(n_channels, n_sources, duration, sfreq):
+    # Sub-gaussian (sinusoids) and super-gaussian (laplacian) sources, and
+    # random mixing matrix
+    rng = np.random.RandomState(0)
+    n_times = int(duration * sfreq)
+    times = np.arange(n_times) / sfreq
+    n_sub = n_sources // 4
+    sources = np.concatenate([
+        np.sin(2 * np.pi * rng.uniform(1, 20, (n_sub, 1)) * times
+               + rng.uniform(0, 6, (n_sub, 1))),
+        rng.laplace(size=(n_sources - n_sub, n_times))])
+    return sources, rng.randn(n_channels, n_sources)
+
+
+def _synthetic_raw(sources, mixing, sfreq, seed, gain=0.):
+    # EEG raw object of the mixed sources with sensor noise (and random
+    # channel gain changes)
+    rng = np.random.RandomState(seed)
+    data = mixing @ sources
+    data += 0.05 * rng.randn(*data.shape)
+    data *= 1 + gain * rng.randn(len(mixing), 1)
+    info = mne.create_info(len(mixing), sfreq, 'eeg')
+    return mne.io.RawArray(data * 1e-6, info, verbose='error')
+
+
+def _quiet_fit(*args, **kwargs):
+    # fit_ica() without logs and cache
+    with mne.utils.use_log_level('error'), warnings.catch_warnings(), \
+            contextlib.redirect_stdout(io.StringIO()):
+        warnings.simplefilter('ignore')
+        return fit_ica(*args, cache=False, **kwargs)
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark_subsample()
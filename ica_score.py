@@ -0,0 +1,338 @@
+"""
+=========
+ICA score
+=========
+
+Automatic selection of the EOG- and ECG-related components of the MEG and
+EEG ICAs of a subject, on the ICA training data (05).
+
+The sources of all the components of both ICAs are computed once, as one
+matrix product of the stacked unmixing operators with the training data,
+and all components are scored in one batch:
+    - correlation with each EOG and ECG channel: the sources are filtered
+      together with the channels (one filtering call per frequency band),
+      then correlated as one product of the z-scored sources and channels
+      (same scores as ica.score_sources)
+    - cross-trial phase statistics (CTPS) over the heartbeats: the epochs
+      of all components are cut from the sources by indexing (same scores
+      as ica.find_bads_ecg with method='ctps')
+and the components are selected as in ica.find_bads_eog (outlier
+correlation, for each ICA) and ica.find_bads_ecg (CTPS above a threshold).
+The scores and selections are written to a table next to the ICA files,
+which 06 reads.
+
+Run this module to compare the scores and run time with the MNE methods on
+a synthetic recording.
+
+"""
+
+import os.path as op
+import time
+import numpy as np
+import pandas as pd
+import scipy.linalg
+
+import mne
+import mne.preprocessing.ctps_
+from mne.preprocessing import find_ecg_events
+
+from config import out_path
+from annot_index import AnnotationIndex
+from mne_private import mne_private
+
+
+# Filters applied to the sources and channels before scoring (same as
+# ica.score_sources)
+filter_kwargs = dict(filter_length='10s',
+                     l_trans_bandwidth=0.5,
+                     h_trans_bandwidth=0.5,
+                     phase='zero-double',
+                     fir_window='hann',
+                     fir_design='firwin2',
+                     verbose='error')
+
+
+def scores_fname(file_name):
+    '''
+    Component score table of the subject of file_name.
+    '''
+    return op.join(out_path, file_name[0:14] + 'ALL-ica_scores.csv')
+
+
+def sources_operator(icas):
+    '''
+    Transformation of the data into the sources of all the components of
+    icas (stacked in order): channels ch_names, block-diagonal operator and
+    offset, so that the sources are operator @ data + offset.
+    '''
+    ch_names = []
+    blocks = []
+    offsets = []
+    for ica in icas:
+        overlap = set(ch_names) & set(ica.ch_names)
+        if overlap:
+            raise ValueError("The ICAs share the channels %s"
+                             % sorted(overlap))
+        
+        # Transform no data (offset) and unit impulses (matrix)
+        n_chan = len(ica.ch_names)
+        offset = _sources(ica, np.zeros((n_chan, 1)))[:, 0]
+        matrix = _sources(ica, np.eye(n_chan))
+        
+        ch_names += ica.ch_names
+        blocks.append(matrix - offset[:, np.newaxis])
+        offsets.append(offset)
+    return ch_names, scipy.linalg.block_diag(*blocks), np.concatenate(offsets)
+
+
+def score_components(icas, raw, kinds, eog_threshold=3.0, ecg_threshold=0.3,
+                     contiguous=True, eog_band=(1, 10), ecg_band=(8, 16),
+                     block_size=2**16):
+    '''
+    Scores of the components of icas (named kinds, e.g. 'meg' and 'eeg') on
+    the data of raw (preloaded), outside its bad annotations. Returns a
+    table with one row per component:
+        - 'ica', 'component': kind and index of the component
+        - one column per EOG and ECG channel: correlation of the sources
+          and the channel, filtered in eog_band and ecg_band
+        - 'ctps': maximum CTPS of the source over the heartbeats (found on
+          the ECG channel, or on the magnetometers if there is none,
+          filtered in ecg_band)
+        - 'eog': EOG-related, i.e. correlation z-score with one of the EOG
+          channels above eog_threshold (among the components of its ICA)
+        - 'ecg': ECG-related, i.e. CTPS above ecg_threshold
+    contiguous: whether raw is a continuous recording; otherwise (e.g. the
+    subsampled training data), the data are scored as they are, without
+    filtering, and the ECG-related components are the outliers of the
+    correlation with the ECG channel (z-score above eog_threshold, no
+    CTPS).
+    '''
+    sfreq = raw.info['sfreq']
+    
+    # Find EOG and ECG channels
+    ref_names = {}
+    for kind in ['eog', 'ecg']:
+        picks = mne.pick_types(raw.info, meg=False, exclude=[],
+                               **{kind: True})
+        ref_names[kind] = [raw.ch_names[i] for i in picks]
+    refs = ref_names['eog'] + ref_names['ecg']
+    
+    # Compute the sources of all components at once, followed by the EOG
+    # and ECG channels
+    ch_names, operator, offset = sources_operator(icas)
+    picks = [raw.ch_names.index(ch) for ch in ch_names]
+    ref_picks = [raw.ch_names.index(ch) for ch in refs]
+    n_comp = len(operator)
+    data = np.empty((n_comp + len(refs), len(raw.times)))
+    for start in range(0, len(raw.times), block_size):
+        stop = min(start + block_size, len(raw.times))
+        data[:n_comp, start:stop] = operator @ raw._data[picks, start:stop] \
+            + offset[:, np.newaxis]
+        data[n_comp:, start:stop] = raw._data[ref_picks, start:stop]
+    
+    # Keep samples outside bad segments
+    times = raw.first_samp + np.arange(len(raw.times))
+    index = AnnotationIndex.from_raw(raw)
+    good = ~index.overlaps(times, times + 1)
+    
+    ###############
+    # CORRELATION #
+    ###############
+    
+    # Filter sources and channels together, once per band
+    corr = np.zeros((n_comp, len(refs)))
+    for kind, band in [('eog', eog_band), ('ecg', ecg_band)]:
+        if not ref_names[kind]:
+            continue
+        if contiguous:
+            filtered = mne.filter.filter_data(data, sfreq, band[0], band[1],
+                                              **filter_kwargs)
+        else:
+            filtered = data
+        
+        # Correlate all components with all channels of the band
+        rows = [n_comp + refs.index(ch) for ch in ref_names[kind]]
+        cols = [refs.index(ch) for ch in ref_names[kind]]
+        corr[:, cols] = _correlate(filtered[:n_comp][:, good],
+                                   filtered[rows][:, good])
+        del filtered
+    
+    ########
+    # CTPS #
+    ########
+    
+    ctps_scores = np.full(n_comp, np.nan)
+    if contiguous:
+        
+        # Find heartbeats and keep the epochs (+/- 0.5 s) in good segments
+        events = find_ecg_events(raw, l_freq=ecg_band[0], h_freq=ecg_band[1],
+                                 verbose='error')[0][:, 0]
+        half = int(round(0.5 * sfreq))
+        events = events[(events - half >= raw.first_samp) &
+                        (events + half < raw.first_samp + len(raw.times))]
+        events = events[~index.overlaps(events - half, events + half + 1)]
+        
+        # Cut the epochs of all components and get their CTPS
+        if len(events):
+            idx = (events - raw.first_samp)[:, np.newaxis] + \
+                np.arange(-half, half + 1)
+            epochs = data[:n_comp][:, idx].transpose(1, 0, 2)
+            ctps = mne_private(mne.preprocessing.ctps_, 'ctps',
+                               'The CTPS scoring of ICA components')
+            ctps_scores = ctps(epochs)[1].max(-1)
+        else:
+            print("    No heartbeats found, no ECG-related components")
+    del data
+    
+    #############
+    # SELECTION #
+    #############
+    
+    # Select outliers and CTPS above threshold within each ICA
+    table = []
+    bounds = np.cumsum([0] + [ica.n_components_ for ica in icas])
+    for kind, first, last in zip(kinds, bounds[:-1], bounds[1:]):
+        eog = np.zeros(last - first, dtype=bool)
+        ecg = np.zeros(last - first, dtype=bool)
+        for i, ch in enumerate(refs):
+            outliers = _outliers(corr[first:last, i],
+                                 threshold=eog_threshold)
+            if ch in ref_names['eog']:
+                eog[outliers] = True
+            elif not contiguous:
+                ecg[outliers] = True
+        if contiguous:
+            ecg = ctps_scores[first:last] >= ecg_threshold
+        
+        scores = pd.DataFrame(corr[first:last], columns=refs)
+        scores.insert(0, 'ica', kind)
+        scores.insert(1, 'component', np.arange(last - first))
+        scores['ctps'] = ctps_scores[first:last]
+        scores['eog'] = eog
+        scores['ecg'] = ecg
+        table.append(scores)
+    
+    return pd.concat(table, ignore_index=True)
+
+
+def read_scores(fname, kind):
+    '''
+    EOG- and ECG-related components of the ICA kind in the score table
+    fname (lists of component indices).
+    '''
+    scores = pd.read_csv(fname)
+    scores = scores[scores['ica'] == kind]
+    if not len(scores):
+        raise ValueError("No %s components in %s" % (kind, fname))
+    return ([int(i) for i in scores['component'][scores['eog']]],
+            [int(i) for i in scores['component'][scores['ecg']]])
+
+
+def _sources(ica, data):
+    # ica.get_sources() of data (one row per channel of ica)
+    raw = mne.io.RawArray(data, ica.info, verbose='error')
+    return ica.get_sources(raw).get_data()
+
+
+def _outliers(x, threshold, max_iter=2):
+    # Indices of the values of x whose absolute z-score exceeds threshold,
+    # z-scoring again without them (max_iter times), as ica.find_bads_eog
+    bad = np.zeros(len(x), dtype=bool)
+    for _ in range(max_iter):
+        z = np.abs(x - x[~bad].mean()) / x[~bad].std()
+        new = (z > threshold) & ~bad
+        if not new.any():
+            break
+        bad |= new
+    return np.where(bad)[0]
+
+
+def _correlate(x, y):
+    # Pearson correlation of each row of x with each row of y
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    y /= np.linalg.norm(y, axis=1, keepdims=True)
+    return x @ y.T
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def benchmark(n_eeg=60, n_mag=60, duration=600., sfreq=200., seed=0):
+    '''
+    Compare score_components with ica.find_bads_eog and ica.find_bads_ecg
+    (method='ctps') run on each ICA, on a synthetic MEG and EEG recording
+    with blinks and heartbeats: run time, largest score difference and
+    selected components.
+    '''
+    from mne.preprocessing import ICA
+    
+    # Make blink, heartbeat and background sources
+    rng = np.random.RandomState(seed)
+    n_times = int(duration * sfreq)
+    times = np.arange(n_times) / sfreq
+    blinks = np.zeros(n_times)
+    for onset in rng.uniform(0, duration - 1, int(duration / 4)):
+        blinks += np.exp(-((times - onset) / 0.08) ** 2)
+    beats = np.zeros(n_times)
+    for onset in np.arange(0.5, duration - 0.5, 0.9):
+        beats += np.exp(-((times - onset - 0.01 * rng.randn()) / 0.01) ** 2)
+    background = rng.laplace(size=(18, n_times))
+    sources = np.concatenate([[blinks], [beats], background])
+    
+    # Mix them into MEG, EEG, EOG and ECG channels
+    info = mne.create_info(['MEG%04d' % i for i in range(n_mag)] +
+                           ['EEG%03d' % i for i in range(n_eeg)] +
+                           ['EOG001', 'ECG001'], sfreq,
+                           ['mag'] * n_mag + ['eeg'] * n_eeg + ['eog', 'ecg'])
+    data = np.concatenate([
+        1e-12 * (rng.randn(n_mag, len(sources)) @ sources
+                 + 0.1 * rng.randn(n_mag, n_times)),
+        1e-6 * (rng.randn(n_eeg, len(sources)) @ sources
+                + 0.1 * rng.randn(n_eeg, n_times)),
+        1e-4 * (blinks + 0.1 * rng.randn(n_times))[np.newaxis],
+        1e-3 * (beats + 0.1 * rng.randn(n_times))[np.newaxis]])
+    raw = mne.io.RawArray(data, info, verbose='error')
+    
+    # Fit MEG and EEG ICAs
+    icas = []
+    for kind in ['meg', 'eeg']:
+        ica = ICA(n_components=20, random_state=seed, verbose='error')
+        ica.fit(raw, picks=kind, verbose='error')
+        icas.append(ica)
+    
+    # Score with MNE, one ICA and one method at a time
+    t0 = time.time()
+    mne_scores = []
+    for ica in icas:
+        eog_idx, eog_scores = ica.find_bads_eog(raw, verbose='error')
+        ecg_idx, ecg_scores = ica.find_bads_ecg(raw, method='ctps',
+                                                verbose='error')
+        mne_scores.append((eog_idx, eog_scores, ecg_idx, ecg_scores))
+    mne_time = time.time() - t0
+    
+    # Score in one batch
+    t0 = time.time()
+    scores = score_components(icas, raw, ['meg', 'eeg'])
+    batch_time = time.time() - t0
+    
+    print("%-5s %12s %12s %10s %10s" % ('ica', 'EOG ICs', 'ECG ICs',
+                                         'EOG diff', 'CTPS diff'))
+    for kind, (eog_idx, eog_scores, ecg_idx, ecg_scores) in \
+            zip(['meg', 'eeg'], mne_scores):
+        s = scores[scores['ica'] == kind]
+        print("%-5s %5s %6s %5s %6s %10.1e %10.1e"
+              % (kind,
+                 sorted(int(i) for i in eog_idx),
+                 [int(i) for i in np.where(s['eog'])[0]],
+                 sorted(int(i) for i in ecg_idx),
+                 [int(i) for i in np.where(s['ecg'])[0]],
+                 np.abs(s['EOG001'].values - eog_scores).max(),
+                 np.abs(s['ctps'].values - ecg_scores).max()))
+    print("MNE: %.2f s, batch: %.2f s" % (mne_time, batch_time))
+
+
+if __name__ == '__main__':
+    benchmark()
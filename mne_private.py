@@ -0,0 +1,50 @@
+"""
+===================
+MNE private helpers
+===================
+
+Guard for the private functions and classes of MNE used by the caches of
+the pipeline (SSS basis, EEG interpolation matrices, ICA PCA, CTPS).
+
+Private functions change between MNE releases without deprecation (e.g.
+their signature), and a cache built on a changed function may be silently
+wrong or unused. They are only used with the MNE versions they were tested
+with (tested_mne, the range pinned in requirements.txt).
+
+"""
+
+import re
+
+import mne
+
+
+# MNE versions the private functions were tested with: from the first
+# (included) to the second (excluded)
+tested_mne = ((1, 13), (1, 14))
+
+
+def mne_tested():
+    '''
+    Whether the installed MNE version is in tested_mne.
+    '''
+    version = tuple(int(v) for v in re.findall(r'\d+', mne.__version__)[:2])
+    return tested_mne[0] <= version < tested_mne[1]
+
+
+def mne_private(module, name, feature):
+    '''
+    Private function or class name of module, used by feature. Raises
+    RuntimeError when it does not exist or when the MNE version was not
+    tested.
+    '''
+    if not mne_tested():
+        raise RuntimeError("%s uses %s.%s, which was only tested with MNE "
+                           "%s.%s to %s.%s (installed: %s)"
+                           % ((feature, module.__name__, name)
+                              + tested_mne[0] + tested_mne[1]
+                              + (mne.__version__,)))
+    if not hasattr(module, name):
+        raise RuntimeError("%s uses %s.%s, which does not exist in MNE %s"
+                           % (feature, module.__name__, name,
+                              mne.__version__))
+    return getattr(module, name)
@@ -0,0 +1,184 @@
+"""
+=======================
+Muscle artifact scoring
+=======================
+
+Streaming version of mne.preprocessing.annotate_muscle_zscore applied on
+notch filtered data. The magnetometers are read in chunks (with overlapping
+margins), notch and band-pass filtered in a single fused FIR pass and
+turned into an envelope chunk by chunk, so that memory is bounded by the chunk size
+instead of two full-length filtered copies of the recording.
+
+"""
+
+import numpy as np
+import scipy.fft
+import scipy.ndimage
+import scipy.signal
+
+import mne
+
+
+def annotate_muscle_stream(raw, ch_type='mag', threshold=5.,
+                           min_length_good=0.2, filter_freq=(110., 140.),
+                           notch_freqs=(50., 100.), chunk_duration=60.,
+                           margin=1., score_sfreq=20.):
+    '''
+    Annotate muscle artifacts (same criterion as annotate_muscle_zscore on
+    raw.copy().notch_filter(notch_freqs)).
+        - chunk_duration: length of the chunks read at once in s
+        - margin: data added on each side of a chunk for the envelope in s
+        - score_sfreq: sampling rate of the returned score trace
+    Returns the 'BAD_muscle' annotations and the times and values of the
+    decimated z-score trace.
+    '''
+    
+    # Get channels and notch and band-pass filters
+    picks = mne.pick_types(raw.info, meg=ch_type, exclude='bads')
+    sfreq = raw.info['sfreq']
+    filters = muscle_filters(sfreq, filter_freq, notch_freqs)
+    
+    # Accumulate envelope mean and std of each channel over good samples
+    n_good = 0
+    env_sum = np.zeros(len(picks))
+    env_sumsq = np.zeros(len(picks))
+    for start, stop, env, good in _envelope_chunks(raw, picks, filters,
+                                                   chunk_duration, margin):
+        env = env[:, good].astype(np.float64)
+        n_good += env.shape[1]
+        env_sum += env.sum(axis=1)
+        env_sumsq += (env ** 2).sum(axis=1)
+    env_mean = env_sum / n_good
+    env_std = np.sqrt(env_sumsq / n_good - env_mean ** 2)
+    
+    # Sum the z-scored envelopes over channels (second pass on the chunks)
+    scores = np.empty(len(raw.times), dtype=np.float32)
+    good_mask = np.empty(len(raw.times), dtype=bool)
+    weights = (1. / env_std / np.sqrt(len(picks))).astype(np.float32)
+    offset = np.sum(env_mean * weights)
+    for start, stop, env, good in _envelope_chunks(raw, picks, filters,
+                                                   chunk_duration, margin):
+        scores[start:stop] = weights @ env - offset
+        good_mask[start:stop] = good
+    
+    # Smooth the scores of the good samples
+    scores_good = mne.filter.filter_data(scores[good_mask].astype(np.float64),
+                                         sfreq, None, 4, verbose='error')
+    scores[good_mask] = scores_good
+    scores[~good_mask] = np.nan
+    del scores_good
+    
+    # Find samples above threshold
+    art_mask = scores > threshold
+    
+    # Remove artifact free periods shorter than min_length_good
+    labels, n_labels = scipy.ndimage.label(~art_mask)
+    lengths = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    art_mask |= (lengths < min_length_good * sfreq)[labels] & (labels > 0)
+    
+    # Make annotations of the artifact periods
+    edges = np.diff(np.concatenate([[0], art_mask.astype(np.int8), [0]]))
+    starts = np.where(edges == 1)[0]
+    stops = np.where(edges == -1)[0]
+    onsets = starts / sfreq
+    if raw.info['meas_date'] is not None:
+        onsets = onsets + raw.first_time
+    annot = mne.Annotations(onset=onsets,
+                            duration=(stops - starts) / sfreq,
+                            description=['BAD_muscle'] * len(starts),
+                            orig_time=raw.info['meas_date'])
+    
+    # Decimate score trace (it is low-passed to 4 Hz)
+    decim = max(int(sfreq // score_sfreq), 1)
+    
+    return annot, raw.times[::decim], scores[::decim]
+
+
+def muscle_filters(sfreq, filter_freq=(110., 140.), notch_freqs=(50., 100.)):
+    '''
+    Zero-phase FIR notch filter (as raw.notch_filter with the default
+    parameters) and band-pass filter (as in annotate_muscle_zscore).
+    '''
+    
+    # Notch filter (band-stop around each frequency)
+    notch_freqs = np.atleast_1d(notch_freqs).astype(float)
+    notch_freqs = notch_freqs[notch_freqs < sfreq / 2.]
+    h = np.array([1.])
+    if len(notch_freqs):
+        tb_2 = 1. / 2.
+        widths = notch_freqs / 200.
+        h = mne.filter.create_filter(None, sfreq,
+                                     list(notch_freqs + widths / 2. + tb_2),
+                                     list(notch_freqs - widths / 2. - tb_2),
+                                     l_trans_bandwidth=tb_2,
+                                     h_trans_bandwidth=tb_2,
+                                     fir_design='firwin',
+                                     verbose='error')
+    
+    # Band-pass filter
+    h_band = mne.filter.create_filter(None, sfreq,
+                                      filter_freq[0], filter_freq[1],
+                                      fir_design='firwin',
+                                      verbose='error')
+    
+    return h, h_band
+
+
+def _envelope_chunks(raw, picks, filters, chunk_duration, margin):
+    # Yield start, stop, envelope (float32) and good sample mask of each
+    # chunk of data
+    sfreq = raw.info['sfreq']
+    n_times = len(raw.times)
+    n_chunk = int(chunk_duration * sfreq)
+    
+    # Fuse the filters in one (still symmetric, i.e. zero-phase)
+    h_fused = filters[0]
+    for h in filters[1:]:
+        h_fused = np.convolve(h_fused, h)
+    n_margin = len(h_fused) // 2 + int(margin * sfreq)
+    
+    for start in range(0, n_times, n_chunk):
+        stop = min(start + n_chunk, n_times)
+        
+        # Read chunk with margins
+        read_start = max(start - n_margin, 0)
+        read_stop = min(stop + n_margin, n_times)
+        x = raw.get_data(picks=picks, start=read_start, stop=read_stop)
+        
+        # Filter in a single pass with the fused filter, or one filter
+        # after the other at the edges of the recording (where each one is
+        # padded, as MNE does)
+        if read_start > 0 and read_stop < n_times:
+            x = _filter_valid(x, h_fused)
+        else:
+            for h in filters:
+                x = _filter_valid(x, h)
+        
+        # Get envelope (the FFT is not padded at the edges of the recording,
+        # as in MNE)
+        n_fft = x.shape[1]
+        if read_start > 0 and read_stop < n_times:
+            n_fft = scipy.fft.next_fast_len(n_fft)
+        env = np.abs(scipy.signal.hilbert(x, N=n_fft, axis=-1))
+        env = env[:, start - read_start:stop - read_start].astype(np.float32)
+        
+        # Get good samples (not in bad annotated segments)
+        good = ~np.isnan(raw.get_data(picks=picks[:1],
+                                      start=start,
+                                      stop=stop,
+                                      reject_by_annotation='NaN')[0])
+        
+        yield start, stop, env, good
+
+
+def _filter_valid(x, h):
+    # Zero-phase filtering of x, padded with point reflections (limited to 
+    # the length of x, then zeros, as MNE does) so that its length is kept
+    n_h = len(h) // 2
+    n_pad = min(n_h, x.shape[1] - 1)
+    x = np.concatenate([2 * x[:, :1] - x[:, n_pad:0:-1],
+                        x,
+                        2 * x[:, -1:] - x[:, -2:-n_pad - 2:-1]], axis=-1)
+    if n_pad < n_h:
+        x = np.pad(x, ((0, 0), (n_h - n_pad, n_h - n_pad)))
+    return scipy.signal.oaconvolve(x, h[np.newaxis], mode='valid', axes=-1)
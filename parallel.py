@@ -0,0 +1,56 @@
+"""
+==================
+Parallel utilities
+==================
+
+Run independent per-run jobs in a pool of worker processes.
+
+"""
+
+import multiprocessing
+import resource
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Address space (GB) allowed on top of max_mem: the cap is on the virtual 
+# address space of the workers (RLIMIT_AS), which also counts the BLAS and 
+# OpenMP thread arenas, shared libraries and memory maps (e.g. the shared 
+# ICA training data), not only the memory in use
+mem_headroom = 4.
+
+
+def run_parallel(func, jobs, n_jobs=1, max_mem=None):
+    '''
+    Call func(*job) for each job and return the results in job order.
+        - n_jobs: number of worker processes (1 = serial, in this process)
+        - max_mem: address space cap per worker process in GB, plus 
+          mem_headroom (None = no cap). It is not a cap on resident memory:
+          to limit the memory in use, lower n_jobs.
+    '''
+    
+    # Serial processing
+    if n_jobs == 1 or len(jobs) < 2:
+        return [func(*job) for job in jobs]
+    
+    # Send each job to a worker process ("spawn" avoids forking a process 
+    # holding open files, BLAS threads and figure windows)
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs)),
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(max_mem,)) as executor:
+        # map() yields the results in submission order
+        results = list(executor.map(func, *zip(*jobs)))
+    
+    return results
+
+
+def _init_worker(max_mem):
+    # Figures are only saved to file in the workers
+    import matplotlib
+    matplotlib.use('Agg')
+    
+    # Cap the address space of the worker process (a MemoryError is raised
+    # when it is exceeded)
+    if max_mem is not None:
+        limit = int((max_mem + mem_headroom) * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
@@ -0,0 +1,161 @@
+"""
+===========
+PSD service
+===========
+
+Power spectra for the QC figures, computed once per (data, picks, fmin/fmax,
+method) and cached on disk as compact arrays.
+
+The same spectrum feeds the power spectrum plots and the per-channel power
+summaries, instead of each figure estimating it again.
+
+"""
+
+import os.path as op
+import hashlib
+import numpy as np
+import scipy.signal
+
+import mne
+from mne.time_frequency import psd_array_multitaper
+import matplotlib.pyplot as plt
+
+from cache import file_hash, make_key, cache_fname, atomic_open
+
+
+# Scalings and units used to plot the power in dB
+_scalings = dict(mag=1e15, grad=1e13, eeg=1e6)
+_units = dict(mag='fT', grad='fT/cm', eeg='µV')
+
+
+def compute_psd(raw, picks, fmin=0., fmax=np.inf, method='welch', fname=None,
+                n_fft=2048, block_duration=60.):
+    '''
+    Power spectral density of the picked channels (bad channels excluded).
+        - picks: list of channel types, e.g. ['meg'] or ['eeg']
+        - method: 'welch' (computed block by block, without loading the
+          whole recording) or 'multitaper'
+        - fname: file raw was read from, if its data were not modified. The
+          cache is keyed by the file content, otherwise by the data.
+    Returns psds (n_channels, n_freqs), freqs, ch_names and ch_types.
+    '''
+    
+    # Select channels
+    idx = mne.pick_types(raw.info,
+                         meg='meg' in picks,
+                         eeg='eeg' in picks,
+                         exclude='bads')
+    ch_names = [raw.ch_names[i] for i in idx]
+    ch_types = raw.get_channel_types(picks=idx)
+    
+    # Get cache entry of these data and parameters
+    data_hash = file_hash(fname) if fname is not None else _data_hash(raw, idx)
+    key = make_key(data_hash,
+                   ch_names=ch_names,
+                   first_samp=raw.first_samp,
+                   n_times=len(raw.times),
+                   fmin=fmin,
+                   fmax=fmax,
+                   method=method,
+                   n_fft=n_fft)
+    fname_cache = cache_fname('psd', key)
+    
+    # Read cached spectrum
+    if op.exists(fname_cache):
+        with np.load(fname_cache) as cached:
+            return (cached['psds'], cached['freqs'],
+                    cached['ch_names'].tolist(), cached['ch_types'].tolist())
+    
+    # Compute spectrum
+    if method == 'welch':
+        freqs, psds = welch(
+            lambda start, stop: raw.get_data(picks=idx, start=start,
+                                             stop=stop),
+            len(raw.times), raw.info['sfreq'], n_fft, block_duration)
+        mask = (freqs >= fmin) & (freqs <= fmax)
+        psds, freqs = psds[:, mask], freqs[mask]
+    elif method == 'multitaper':
+        psds, freqs = psd_array_multitaper(raw.get_data(picks=idx),
+                                           raw.info['sfreq'],
+                                           fmin=fmin,
+                                           fmax=fmax,
+                                           verbose='error')
+    else:
+        raise ValueError("Unknown PSD method: %s" % method)
+    psds = psds.astype(np.float32)
+    
+    # Store spectrum in the cache
+    with atomic_open(fname_cache) as f:
+        np.savez(f,
+                 psds=psds,
+                 freqs=freqs,
+                 ch_names=np.array(ch_names, dtype=str),
+                 ch_types=np.array(ch_types, dtype=str))
+    
+    return psds, freqs, ch_names, ch_types
+
+
+def plot_psd(psds, freqs, ch_types, axes=None):
+    '''
+    Plot the power spectrum of each channel in dB, one axis per channel type.
+    '''
+    
+    # Get channel types in plotting order
+    types = [t for t in ['mag', 'grad', 'eeg'] if t in ch_types]
+    
+    # Create figure
+    if axes is None:
+        fig, axes = plt.subplots(len(types), 1, figsize=(8, 3 * len(types)),
+                                 squeeze=False)
+        axes = axes[:, 0]
+    else:
+        axes = np.atleast_1d(axes)
+        fig = axes[0].figure
+    
+    # Plot channels of each type
+    ch_types = np.array(ch_types)
+    for ax, t in zip(axes, types):
+        psd_db = 10. * np.log10(psds[ch_types == t] * _scalings[t] ** 2)
+        ax.plot(freqs, psd_db.T, color='k', lw=0.5, alpha=0.5)
+        ax.set(xlim=(freqs[0], freqs[-1]),
+               title=t.upper(),
+               xlabel='Frequency (Hz)',
+               ylabel='%s²/Hz (dB)' % _units[t])
+    fig.tight_layout()
+    
+    return fig
+
+
+def welch(read_block, n_times, sfreq, n_fft=2048, block_duration=60.):
+    '''
+    Welch estimate (non overlapping Hamming windows) accumulated over blocks
+    of whole windows, so that the data are read one block at a time.
+        - read_block: function returning the data from sample start to stop,
+          e.g. lambda start, stop: raw.get_data(picks, start, stop)
+    Returns freqs and psds (n_channels, n_freqs).
+    '''
+    n_fft = min(n_fft, n_times)
+    n_block = n_fft * max(int(block_duration * sfreq) // n_fft, 1)
+    psd_sum = 0.
+    n_win = 0
+    for start in range(0, n_times - n_fft + 1, n_block):
+        n = (min(start + n_block, n_times) - start) // n_fft
+        freqs, psd = scipy.signal.welch(read_block(start, start + n * n_fft),
+                                        fs=sfreq,
+                                        window='hamming',
+                                        nperseg=n_fft,
+                                        noverlap=0)
+        psd_sum = psd_sum + psd * n
+        n_win += n
+    return freqs, psd_sum / n_win
+
+
+def _data_hash(raw, idx, block_duration=60.):
+    # Content hash of the picked data, read one block at a time
+    h = hashlib.sha1()
+    n_block = int(block_duration * raw.info['sfreq'])
+    for start in range(0, len(raw.times), n_block):
+        h.update(raw.get_data(picks=idx,
+                              start=start,
+                              stop=start + n_block).tobytes())
+    return h.hexdigest()
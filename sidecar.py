@@ -0,0 +1,251 @@
+"""
+========
+Sidecars
+========
+
+Lightweight outputs of the stages that only modify part of a recording.
+
+Instead of a full copy of the Maxwell filtered recording, each stage writes
+a small sidecar file next to it:
+    - 02 (_intpl.npz): linear operator applied to the EEG channels
+      (reference and interpolation of the bad channels)
+    - 03 (_artif.npz): annotations and EOG channel remapping
+    - 06 (_ica.npz): ICA solutions and excluded components
+
+read_raw_stage() reads the Maxwell filtered recording and applies the
+sidecars of the stages up to the requested one. The EEG operator and the 
+ICA cleaning operator are applied while reading the data (they do not 
+require to preload them).
+
+Run this module to compare the channels read through the sidecars with the
+full copies of the stages, when both were written.
+
+"""
+
+import os.path as op
+import datetime
+import numpy as np
+
+import mne
+
+from config import out_path, method, use_sidecars
+from cache import file_hash, atomic_open
+from ica_apply import read_icas, cleaning_operator, CleanedRaw
+
+
+# Stages writing a sidecar (or a full copy of the recording), in order
+stages = ['intpl', 'artif', 'ica']
+
+
+def base_fname(file_name):
+    '''
+    Maxwell filtered recording the sidecars of file_name apply to.
+    '''
+    return op.join(out_path, file_name + '_' + method + '.fif')
+
+
+def sidecar_fname(file_name, stage):
+    return op.join(out_path, file_name + '_' + stage + '.npz')
+
+
+def write_sidecar(file_name, stage, **arrays):
+    '''
+    Store the arrays of a stage, with the hash of the recording they apply
+    to.
+    '''
+    fname = sidecar_fname(file_name, stage)
+    with atomic_open(fname) as f:
+        np.savez(f, base_hash=file_hash(base_fname(file_name)), **arrays)
+    print("    Writing %s sidecar: %s" % (stage, fname))
+
+
+def read_sidecar(file_name, stage):
+    '''
+    Read the arrays of a stage, checking that they were made from the
+    current version of the recording.
+    '''
+    fname = sidecar_fname(file_name, stage)
+    if not op.exists(fname):
+        raise FileNotFoundError("No %s sidecar for %s (%s), run the stage "
+                                "first" % (stage, file_name, fname))
+    with np.load(fname) as sidecar:
+        arrays = {k: sidecar[k] for k in sidecar.files}
+    if str(arrays.pop('base_hash')) != file_hash(base_fname(file_name)):
+        raise ValueError("The %s sidecar (%s) was made from another version "
+                         "of %s, run the stage again"
+                         % (stage, fname, base_fname(file_name)))
+    return arrays
+
+
+def write_eeg_operator(file_name, ch_names, operator):
+    '''
+    Stage 02: EEG data = operator @ EEG data of the Maxwell filtered file.
+    '''
+    write_sidecar(file_name, 'intpl',
+                  ch_names=np.array(ch_names, dtype=str),
+                  operator=operator)
+
+
+def write_artifacts(file_name, annotations, ch_types=None, ch_renames=None):
+    '''
+    Stage 03: channel types and names set on the recording, then its
+    annotations.
+    '''
+    ch_types = {} if ch_types is None else ch_types
+    ch_renames = {} if ch_renames is None else ch_renames
+    orig_time = annotations.orig_time
+    descriptions = [str(d) for d in annotations.description]
+    write_sidecar(file_name, 'artif',
+                  onset=annotations.onset,
+                  duration=annotations.duration,
+                  description=np.array(descriptions, dtype=str),
+                  orig_time='' if orig_time is None else orig_time.isoformat(),
+                  type_names=np.array(list(ch_types), dtype=str),
+                  types=np.array(list(ch_types.values()), dtype=str),
+                  old_names=np.array(list(ch_renames), dtype=str),
+                  new_names=np.array(list(ch_renames.values()), dtype=str))
+
+
+def write_ica(file_name, ica_fnames, excludes):
+    '''
+    Stage 06: ICA solutions applied to the recording, with their excluded
+    components.
+    '''
+    write_sidecar(file_name, 'ica',
+                  ica_fnames=np.array(ica_fnames, dtype=str),
+                  excludes=np.array([','.join(str(i) for i in exclude)
+                                     for exclude in excludes], dtype=str))
+
+
+def read_raw_stage(file_name, stage, preload=False):
+    '''
+    Read the recording of file_name as output by a stage ('sss'/'tsss',
+    'intpl', 'artif' or 'ica').
+    '''
+    
+    # Read full copy written by the stage
+    if not use_sidecars or stage == method:
+        return mne.io.read_raw_fif(op.join(out_path,
+                                           file_name + '_' + stage + '.fif'),
+                                   preload=preload,
+                                   verbose='error')
+    
+    # Read Maxwell filtered recording and apply the sidecars
+    raw = read_sidecar_stage(file_name, stage)
+    if preload:
+        raw.load_data()
+    
+    return raw
+
+
+def read_sidecar_stage(file_name, stage):
+    '''
+    Read the Maxwell filtered recording of file_name and apply the sidecars
+    of the stages up to stage (not preloaded).
+    '''
+    raw = mne.io.read_raw_fif(base_fname(file_name),
+                              preload=False,
+                              verbose='error')
+    for this_stage in stages[:stages.index(stage) + 1]:
+        sidecar = read_sidecar(file_name, this_stage)
+        
+        if this_stage == 'intpl':
+            # Apply EEG operator
+            raw = apply_operator(raw, sidecar['ch_names'].tolist(),
+                                 sidecar['operator'])
+        
+        elif this_stage == 'artif':
+            # Set channel types and names and annotations
+            raw.set_channel_types(dict(zip(sidecar['type_names'].tolist(),
+                                           sidecar['types'].tolist())))
+            raw.rename_channels(dict(zip(sidecar['old_names'].tolist(),
+                                         sidecar['new_names'].tolist())))
+            orig_time = str(sidecar['orig_time'])
+            raw.set_annotations(mne.Annotations(
+                onset=sidecar['onset'],
+                duration=sidecar['duration'],
+                description=sidecar['description'].tolist(),
+                orig_time=(datetime.datetime.fromisoformat(orig_time)
+                           if orig_time else None)))
+        
+        elif this_stage == 'ica':
+            # Remove the excluded components of all ICAs in one pass, when 
+            # the data are read
+            icas = read_icas(sidecar['ica_fnames'].tolist(),
+                             [[int(i) for i in exclude.split(',') if i]
+                              for exclude in sidecar['excludes'].tolist()])
+            raw = CleanedRaw(raw, *cleaning_operator(icas))
+    
+    return raw
+
+
+def apply_operator(raw, ch_names, operator, block_duration=60.):
+    '''
+    Replace the data of the channels ch_names of raw by operator @ data.
+    When raw is not preloaded, returns a Raw object applying the operator
+    when the data are read (CleanedRaw, which reads all the channels before
+    picking, so that a subset of ch_names is still combined with the other
+    channels of the operator), otherwise applies it block by block.
+    '''
+    
+    # Apply when the data are read
+    if not raw.preload:
+        return CleanedRaw(raw, ch_names, operator, np.zeros(len(ch_names)),
+                          dtype=np.float64)
+    
+    # Apply to preloaded data
+    idx = np.array([raw.ch_names.index(ch) for ch in ch_names])
+    n_block = int(block_duration * raw.info['sfreq'])
+    for start in range(0, len(raw.times), n_block):
+        raw._data[idx, start:start + n_block] = \
+            operator @ raw._data[idx, start:start + n_block]
+    return raw
+
+
+def check_stage(file_name, stage, picks):
+    '''
+    Largest relative difference between the channels picks of the recording
+    of file_name as output by stage, read through the sidecars and from the
+    full copy written by the stage.
+    '''
+    full = mne.io.read_raw_fif(op.join(out_path,
+                                       file_name + '_' + stage + '.fif'),
+                               verbose='error')
+    data = read_sidecar_stage(file_name, stage).pick(picks).get_data()
+    ref = full.pick(picks).get_data()
+    if data.shape != ref.shape:
+        raise ValueError("The full copy of the %s stage of %s has another "
+                         "size (%s) than its sidecars (%s)"
+                         % (stage, file_name, ref.shape, data.shape))
+    scale = np.abs(ref).max(axis=1, keepdims=True)
+    return float(np.max(np.abs(data - ref) / np.where(scale > 0, scale, 1)))
+
+
+# =============================================================================
+# CHECK
+# =============================================================================
+
+if __name__ == '__main__':
+    from config import file_names
+    
+    # Compare subsets of the EEG channels (and all MEG channels), read 
+    # through the sidecars, with the full copies of the stages written with 
+    # use_sidecars = False
+    for file_name in file_names:
+        for stage in stages:
+            fname_full = op.join(out_path, file_name + '_' + stage + '.fif')
+            if not (op.exists(sidecar_fname(file_name, stage)) and
+                    op.exists(fname_full)):
+                continue
+            info = mne.io.read_info(fname_full, verbose='error')
+            eeg = [info['ch_names'][i]
+                   for i in mne.pick_types(info, meg=False, eeg=True)]
+            meg = [info['ch_names'][i]
+                   for i in mne.pick_types(info, meg=True)]
+            for name, picks in [('EEG subset', eeg[::3]),
+                                ('one EEG channel', eeg[:1]),
+                                ('MEG', meg)]:
+                if picks:
+                    print("%s %s, %s: relative error %.1e"
+                          % (file_name, stage, name,
+                             check_stage(file_name, stage, picks)))
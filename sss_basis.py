@@ -0,0 +1,225 @@
+"""
+===============
+SSS basis cache
+===============
+
+Maxwell filtering with a cache of the SSS decomposition (the multipole basis
+expanded on the sensors and its pseudo-inverse).
+
+The decomposition only depends on the sensor array, the fine calibration,
+the expansion origin/orders and the device-to-head transform. It is cached
+on disk, keyed by a fingerprint of everything but the transform, and reused
+for another run of the same subject/site when the transforms differ by less
+than a tolerance.
+
+The cache relies on private functions of MNE: with an MNE version it was
+not tested with (see mne_private), the recordings are Maxwell filtered
+without it.
+
+Run this file to benchmark the time saved per run.
+
+"""
+
+import os.path as op
+import glob
+import hashlib
+import time
+import numpy as np
+
+import mne
+import mne.preprocessing.maxwell
+
+from cache import cache_fname, atomic_open
+from mne_private import mne_tested
+from config import sss_basis_tol_trans, sss_basis_tol_rot
+
+
+# Decompositions already used in this process, by fingerprint
+_decomps = {}
+
+
+def maxwell_filter_cached(raw, tol_trans=sss_basis_tol_trans,
+                          tol_rot=sss_basis_tol_rot, **kwargs):
+    '''
+    Same as mne.preprocessing.maxwell_filter(raw, **kwargs), but the SSS
+    decomposition is read from the cache when a cached one was computed for
+    a device-to-head transform within tol_trans (m) and tol_rot (deg).
+    Without the cache with MNE versions it was not tested with.
+    '''
+    maxwell = mne.preprocessing.maxwell
+    
+    # Prepare Maxwell filtering
+    params = None
+    if mne_tested() and all(hasattr(maxwell, name)
+                            for name in ['_prep_maxwell_filter',
+                                         '_run_maxwell_filter',
+                                         '_update_sss_info']):
+        params = maxwell._prep_maxwell_filter(raw=raw, **kwargs)
+    
+    # Maxwell filter without the cache
+    if params is None or '_get_this_decomp_trans' not in params:
+        print("    SSS basis cache not tested with MNE %s, Maxwell filtering "
+              "without it" % mne.__version__)
+        return mne.preprocessing.maxwell_filter(raw, **kwargs)
+    
+    # Swap in the cached decomposition
+    params['_get_this_decomp_trans'] = _CachedDecomp(
+        params['_get_this_decomp_trans'], tol_trans, tol_rot)
+    
+    # Perform Maxwell filtering
+    raw_sss = maxwell._run_maxwell_filter(raw, **params)
+    maxwell._update_sss_info(raw_sss, **params['update_kwargs'])
+    
+    return raw_sss
+
+
+class _CachedDecomp:
+    '''
+    Wraps the function computing the SSS decomposition for a given
+    device-to-head transform.
+    '''
+    
+    def __init__(self, get_decomp, tol_trans, tol_rot):
+        self.get_decomp = get_decomp
+        self.tol_trans = tol_trans
+        self.tol_rot = tol_rot
+        
+        # All inputs of the decomposition but the transform, and the MNE
+        # version computing it
+        self.fingerprint = _hash_obj([mne.__version__, get_decomp.keywords])
+        self.entries = _decomps.setdefault(self.fingerprint, [])
+    
+    def __call__(self, trans, *args, **kwargs):
+        trans_array = _trans_array(trans)
+        
+        # Look in this process, then on disk
+        decomp = self._lookup(trans_array)
+        if decomp is None:
+            decomp = self._read(trans_array)
+        
+        # Compute and store the decomposition
+        if decomp is None:
+            decomp = self.get_decomp(trans, *args, **kwargs)
+            self._write(trans_array, decomp)
+        
+        return decomp
+    
+    def _lookup(self, trans):
+        for trans_cached, decomp in self.entries:
+            if _trans_close(trans, trans_cached, self.tol_trans, self.tol_rot):
+                return decomp
+        return None
+    
+    def _read(self, trans):
+        for fname in sorted(glob.glob(cache_fname('sss_basis',
+                                                  self.fingerprint + '_*'))):
+            with np.load(fname) as cached:
+                trans_cached = cached['trans']
+                if not _trans_close(trans, trans_cached,
+                                    self.tol_trans, self.tol_rot):
+                    continue
+                print("    Reading SSS basis from cache: %s" % fname)
+                decomp = tuple(None if is_none
+                               else cached['out%d' % i][()] if is_int
+                               else cached['out%d' % i]
+                               for i, (is_none, is_int) in enumerate(
+                                       zip(cached['is_none'], cached['is_int'])))
+            self.entries.append((trans_cached, decomp))
+            return decomp
+        return None
+    
+    def _write(self, trans, decomp):
+        self.entries.append((trans, decomp))
+        fname = cache_fname('sss_basis',
+                            '%s_%s' % (self.fingerprint, _hash_obj(trans)[:16]))
+        with atomic_open(fname) as f:
+            np.savez(f,
+                     trans=trans,
+                     is_none=[out is None for out in decomp],
+                     is_int=[isinstance(out, (int, np.integer))
+                             for out in decomp],
+                     **{'out%d' % i: out for i, out in enumerate(decomp)
+                        if out is not None})
+
+
+def _trans_array(trans):
+    # Device-to-head transform as a 4x4 array (identity in MEG coordinates)
+    if trans is None:
+        return np.eye(4)
+    if isinstance(trans, dict):
+        trans = trans['trans']
+    return np.asarray(trans, dtype=float)
+
+
+def _trans_close(trans1, trans2, tol_trans, tol_rot):
+    # Translation difference (m)
+    d_trans = np.linalg.norm(trans1[:3, 3] - trans2[:3, 3])
+    
+    # Rotation angle between the transforms (deg)
+    cos = (np.trace(trans1[:3, :3].T @ trans2[:3, :3]) - 1) / 2
+    d_rot = np.rad2deg(np.arccos(np.clip(cos, -1, 1)))
+    
+    return d_trans <= tol_trans and d_rot <= tol_rot
+
+
+def _hash_obj(obj, h=None):
+    # Hash of nested dicts/lists/tuples of arrays and scalars
+    top = h is None
+    if top:
+        h = hashlib.sha1()
+    if isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            h.update(str(key).encode())
+            _hash_obj(obj[key], h)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[%d' % len(obj))
+        for item in obj:
+            _hash_obj(item, h)
+    elif isinstance(obj, np.ndarray):
+        h.update(str((obj.dtype, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        h.update(repr(obj).encode())
+    if top:
+        return h.hexdigest()
+
+
+def benchmark_sss_cache(raw_fnames, **kwargs):
+    '''
+    Time Maxwell filtering of each run with and without the SSS basis cache.
+    '''
+    for raw_fname in raw_fnames:
+        raw = mne.io.read_raw_fif(raw_fname,
+                                  allow_maxshield=True,
+                                  preload=True,
+                                  verbose='error')
+        raw.fix_mag_coil_types()
+        
+        # Without cache
+        t0 = time.perf_counter()
+        raw_ref = mne.preprocessing.maxwell_filter(raw, verbose='error',
+                                                   **kwargs)
+        t_ref = time.perf_counter() - t0
+        
+        # With cache (filled by the previous runs)
+        t0 = time.perf_counter()
+        raw_sss = maxwell_filter_cached(raw, verbose='error', **kwargs)
+        t_cached = time.perf_counter() - t0
+        
+        # Relative difference of the filtered data
+        err = (np.linalg.norm(raw_sss.get_data() - raw_ref.get_data())
+               / np.linalg.norm(raw_ref.get_data()))
+        
+        print("%s: %.1f s -> %.1f s (saved %.1f s, rel. difference %.1e)"
+              % (op.basename(raw_fname), t_ref, t_cached, t_ref - t_cached,
+                 err))
+
+
+if __name__ == '__main__':
+    from config import data_path, cal_path, site_id, file_names, st_duration
+    
+    benchmark_sss_cache(
+        [op.join(data_path, file_name + '.fif') for file_name in file_names],
+        cross_talk=op.join(cal_path, "ct_sparse_" + site_id + ".fif"),
+        calibration=op.join(cal_path, "sss_cal_" + site_id + ".dat"),
+        st_duration=st_duration)
@@ -0,0 +1,169 @@
+"""
+===========
+Stim events
+===========
+
+Events of a run read from its stimulus channel only.
+
+The samples of the stimulus channel are taken from the FIF data buffers
+through a memory map (a strided view on one channel of each buffer), without
+reading and calibrating the MEG and EEG data. The trigger steps are found
+once, and the response events (any duration) and the other events (minimum
+duration) are derived from them, giving the same events as the two
+mne.find_events calls of 04-extract_events.py.
+
+"""
+
+import numpy as np
+
+import mne
+from mne.io.constants import FIFF
+
+
+# Data types of the FIF data buffers read through the memory map
+buffer_dtypes = {FIFF.FIFFT_SHORT: '>i2',
+                 FIFF.FIFFT_INT: '>i4',
+                 FIFF.FIFFT_FLOAT: '>f4',
+                 FIFF.FIFFT_DOUBLE: '>f8',
+                 FIFF.FIFFT_DAU_PACK16: '>i2'}
+
+
+def read_stim(fname, stim_channel='STI101'):
+    '''
+    Samples of the stimulus channel of a FIF file (and its split parts).
+    Returns the data (int64), the first sample and the sampling rate.
+    '''
+    raw = mne.io.read_raw_fif(fname,
+                              allow_maxshield=True,
+                              preload=False,
+                              verbose='error')
+    idx = raw.ch_names.index(stim_channel)
+    
+    # Read channel from each data buffer of each file
+    data = np.zeros(len(raw.times))
+    offset = 0
+    for fi, extras in enumerate(raw._raw_extras):
+        bounds = extras['bounds'] - extras['bounds'][0]
+        n_chan = extras['orig_nchan']
+        mm = np.memmap(raw._filenames[fi], dtype=np.uint8, mode='r')
+        for ei, ent in enumerate(extras['ent']):
+            start = offset + bounds[ei]
+            stop = offset + bounds[ei + 1]
+            
+            # Gaps are zeros
+            if ent is None:
+                continue
+            
+            # Other buffer types are read by MNE
+            if ent.type not in buffer_dtypes:
+                data[start:stop] = raw.get_data(picks=[idx],
+                                                start=start,
+                                                stop=stop)[0]
+                continue
+            
+            # Strided view on the channel (after the 16 bytes tag header)
+            dtype = np.dtype(buffer_dtypes[ent.type])
+            data[start:stop] = np.ndarray(
+                (stop - start,),
+                dtype=dtype,
+                buffer=mm,
+                offset=ent.pos + 16 + idx * dtype.itemsize,
+                strides=(n_chan * dtype.itemsize,)) * raw._cals[idx]
+        offset += bounds[-1]
+        del mm
+    
+    return data.astype(np.int64), raw.first_samp, raw.info['sfreq']
+
+
+def find_run_events(data, first_samp, sfreq, response_id=255,
+                    min_duration=0.001001, mask=65280, shortest_event=2):
+    '''
+    Events of a stimulus channel: responses (response_id, any duration,
+    as find_events with consecutive=False) and the other events (at least
+    min_duration s, as find_events with consecutive=True), sorted by sample.
+    Trigger values are masked with mask_type='not_and'.
+    '''
+    
+    # Make sure trigger channel is positive (as find_events)
+    data = np.abs(data)
+    
+    # Find steps of the trigger channel (once for both event types)
+    steps = _find_steps(data, first_samp)
+    
+    # Response events
+    response = _steps_to_events(steps, mask, False, shortest_event)
+    response = response[response[:, 2] == response_id]
+    
+    # All other events (steps less than min_duration apart are merged)
+    min_samples = min_duration * sfreq
+    merge = int(min_samples // 1)
+    if merge == min_samples:
+        merge -= 1
+    events = _steps_to_events(_merge_steps(steps, merge), mask, True,
+                              shortest_event)
+    events = events[events[:, 2] != response_id]
+    
+    # Concatenate all events
+    events = np.concatenate([response, events], axis=0)
+    events = events[events[:, 0].argsort(), :]
+    
+    return events
+
+
+def read_run_events(fname, stim_channel='STI101', **kwargs):
+    '''
+    find_run_events() on the stimulus channel of a FIF file.
+    '''
+    return find_run_events(*read_stim(fname, stim_channel), **kwargs)
+
+
+def _find_steps(data, first_samp):
+    # Steps of the trigger channel (sample, value before, value after),
+    # with a final step to 0
+    idx = np.where(np.diff(data) != 0)[0]
+    steps = np.c_[idx + 1 + first_samp, data[idx], data[idx + 1]]
+    if len(data) and data[-1] != 0:
+        steps = np.append(steps, [[len(data) + first_samp, data[-1], 0]],
+                          axis=0)
+    return steps.reshape(-1, 3).astype(np.int64)
+
+
+def _merge_steps(steps, merge):
+    # Keep the later of the steps at most merge samples apart
+    if merge <= 0 or len(steps) < 2:
+        return steps
+    steps = steps.copy()
+    close = np.diff(steps[:, 0]) <= merge
+    where = np.where(close)[0]
+    steps[where + 1, 1] = steps[where, 1]
+    keep = np.append(~close, True) & (steps[:, 1] != steps[:, 2])
+    return steps[keep]
+
+
+def _steps_to_events(steps, mask, consecutive, shortest_event):
+    # Events at the onsets of the masked steps
+    steps = steps.copy()
+    steps[:, 1:] &= ~mask
+    steps = steps[steps[:, 1] != steps[:, 2]]
+    
+    # Determine event onsets and offsets
+    if consecutive:
+        onset_idx = np.where(steps[:, 2] > 0)[0]
+        offset_idx = np.where(steps[:, 1] > 0)[0]
+    else:
+        onset_idx = np.where(steps[:, 1] == 0)[0]
+        offset_idx = np.where(steps[:, 2] == 0)[0]
+    if len(onset_idx) == 0 or len(offset_idx) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+    
+    # Remove orphaned onset at the end
+    if onset_idx[-1] > offset_idx[-1]:
+        onset_idx = onset_idx[:-1]
+    events = steps[onset_idx]
+    
+    # Check for spurious short events (as find_events)
+    if np.any(np.diff(events[:, 0]) < shortest_event):
+        raise ValueError("Events shorter than %s samples were found on the "
+                         "stimulus channel" % shortest_event)
+    
+    return events
@@ -0,0 +1,157 @@
+"""
+===========
+Trial store
+===========
+
+Events and metadata tables of a subject stored together in one typed,
+columnar file (uncompressed npz).
+
+Each table of the file (one per run, written by 04, and one for the epochs,
+written by 07) holds its event array and each metadata column as an array
+with its type:
+    - 'category': integer codes (-1 for missing values) and categories,
+      read back as a pandas Categorical without parsing any string
+    - 'bool', 'int', 'float': the column values
+    - 'nullable_int': values and missing value mask (pandas Int64)
+so that booleans, labels and response times keep their type, and filtering
+trials on a label compares integer codes.
+
+"""
+
+import os.path as op
+import numpy as np
+import pandas as pd
+
+from config import out_path
+from cache import atomic_open
+
+
+def trials_fname(file_name):
+    '''
+    Trial store of the subject of file_name.
+    '''
+    return op.join(out_path, file_name[0:13] + 'ALL-trials.npz')
+
+
+def write_trials(fname, tables):
+    '''
+    Write tables ({name: (events, metadata)}) to the store fname (replacing
+    its content).
+    '''
+    arrays = {'names': np.array(list(tables), dtype=str)}
+    for name, (events, metadata) in tables.items():
+        arrays.update(_table_arrays(name, events, metadata))
+    with atomic_open(fname) as f:
+        np.savez(f, **arrays)
+
+
+def append_trials(fname, name, events, metadata):
+    '''
+    Add the table name to the store fname (created if needed), replacing the
+    table of the same name if any.
+    '''
+    tables = read_trials(fname) if op.exists(fname) else {}
+    tables[name] = (events, metadata)
+    write_trials(fname, tables)
+    print("    Writing %s trials to store: %s" % (name, fname))
+
+
+def read_trials(fname, names=None):
+    '''
+    Read the tables names (all by default) of the store fname. Returns
+    {name: (events, metadata)}, in the order of names.
+    '''
+    tables = {}
+    with np.load(fname) as store:
+        stored = store['names'].tolist()
+        if names is None:
+            names = stored
+        for name in names:
+            if name not in stored:
+                raise KeyError("No %s trials in %s" % (name, fname))
+            tables[name] = _read_table(store, name)
+    return tables
+
+
+def concat_metadata(metadata_list):
+    '''
+    Concatenate metadata tables, merging the categories of the categorical
+    columns (pd.concat turns them to object columns when they differ).
+    '''
+    metadata = pd.concat(metadata_list, ignore_index=True)
+    for col in metadata_list[0].columns:
+        if all(isinstance(m[col].dtype, pd.CategoricalDtype)
+               for m in metadata_list):
+            metadata[col] = pd.api.types.union_categoricals(
+                [m[col] for m in metadata_list])
+    return metadata
+
+
+def epochs_trials(fname, epochs, name='ALL_epo'):
+    '''
+    Metadata table name of the store fname for epochs, checking that it
+    was written for the same epochs.
+    '''
+    events, metadata = read_trials(fname, [name])[name]
+    if not np.array_equal(events, epochs.events):
+        raise ValueError("The %s trials of %s do not match the epochs, run "
+                         "07-make_epochs.py again" % (name, fname))
+    return metadata
+
+
+def select_trials(metadata, column, value):
+    '''
+    Indices of the trials whose column is value.
+    '''
+    return np.where((metadata[column] == value).values)[0]
+
+
+def _table_arrays(name, events, metadata):
+    # Arrays of a table, with the schema (column names and types)
+    arrays = {name + '/events': np.asarray(events, dtype=np.int64),
+              name + '/columns': np.array(list(metadata.columns), dtype=str)}
+    kinds = []
+    for i, col in enumerate(metadata.columns):
+        key = '%s/%s/' % (name, i)
+        values = metadata[col]
+        if pd.api.types.is_bool_dtype(values.dtype) and not values.isna().any():
+            kinds.append('bool')
+            arrays[key + 'values'] = values.to_numpy(dtype=bool)
+        elif isinstance(values.dtype, pd.api.extensions.ExtensionDtype) and \
+                pd.api.types.is_integer_dtype(values.dtype):
+            kinds.append('nullable_int')
+            arrays[key + 'values'] = values.fillna(0).to_numpy(dtype=np.int64)
+            arrays[key + 'mask'] = values.isna().to_numpy()
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            kinds.append('int')
+            arrays[key + 'values'] = values.to_numpy(dtype=np.int64)
+        elif pd.api.types.is_float_dtype(values.dtype):
+            kinds.append('float')
+            arrays[key + 'values'] = values.to_numpy(dtype=np.float64)
+        else:
+            kinds.append('category')
+            cat = pd.Categorical(values)
+            arrays[key + 'values'] = cat.codes
+            arrays[key + 'categories'] = np.array(
+                [str(c) for c in cat.categories], dtype=str)
+    arrays[name + '/kinds'] = np.array(kinds, dtype=str)
+    return arrays
+
+
+def _read_table(store, name):
+    # Events and metadata of a table
+    events = store[name + '/events']
+    columns = store[name + '/columns'].tolist()
+    kinds = store[name + '/kinds'].tolist()
+    data = {}
+    for i, (col, kind) in enumerate(zip(columns, kinds)):
+        key = '%s/%s/' % (name, i)
+        values = store[key + 'values']
+        if kind == 'category':
+            data[col] = pd.Categorical.from_codes(
+                values, store[key + 'categories'].tolist())
+        elif kind == 'nullable_int':
+            data[col] = pd.arrays.IntegerArray(values, store[key + 'mask'])
+        else:
+            data[col] = values
+    return events, pd.DataFrame(data, columns=columns)
@@ -0,0 +1,428 @@
+"""
+===============
+Trial metadata
+===============
+
+Metadata table of the trials of a run, decoded from its events.
+
+The trigger protocol of each experiment is described in protocols (trial
+start and end triggers, then one rule per column of the table) and compiled
+once into a TrialDecoder, which decodes all the trials of a run at once:
+each trial is delimited by its stimulus trigger and the next end of trial
+trigger (or the next stimulus), and each column is computed as a whole
+array from the triggers of a range found within the trials, or at a fixed
+position after the stimulus. The cost is a few passes over the event array
+instead of one DataFrame assignment per trial and column.
+
+A new paradigm only needs a new protocol, e.g.:
+
+    protocols[3] = {
+        'stimulus': (1, 40),        # trial start triggers (range)
+        'trial_end': 97,            # optional end of trial trigger
+        'max_trial_events': 9,      # events from stimulus to trial end
+        'columns': [
+            ('Stim_trigger', {}),   # stimulus trigger
+            ('Side', {'find': (101, 102),           # first trigger of
+                      'start': 101,                 # the range in the
+                      'labels': ['Left', 'Right']}),  # trial, as label
+            ('Response', {'find': (255, 255),
+                          'value': 'found'}),       # whether in the trial
+            ('RT', {'find': (255, 255),
+                    'value': 'latency',             # samples from the
+                    'optional': True})]}            # stimulus
+
+Column rules:
+    - position of the trigger: 'find' (first trigger of a range in the
+      trial), 'offset' (number of events after the stimulus) or none (the
+      stimulus)
+    - 'value': 'code' (trigger value, or label with 'labels'), 'found'
+      (whether the trigger is in the trial) or 'latency' (samples from the
+      stimulus, or from the event at offset 'latency_from')
+    - 'labels': label of each trigger value (categorical), indexed by
+      ((value - 'start') // 'step') % 'modulo' (defaults 0, 1, None)
+    - 'optional': the column is missing (NaN) when the trigger is not found,
+      instead of raising an error
+    - 'only' / 'unless': (column, label) the column is only decoded for the
+      trials where (or where not) a previous column has this label
+
+Run this module to check the tables against the row by row builder of the
+previous version of 04-extract_events.py and to time both on synthetic runs.
+
+"""
+
+import time
+import numpy as np
+import pandas as pd
+
+
+# Trigger protocols of the experiments
+protocols = {
+    1: {'stimulus': (1, 80),
+        'trial_end': 97,
+        'max_trial_events': 9,
+        'columns': [
+            ('Stim_trigger', {}),
+            ('Category', {'start': 1,
+                          'step': 20,
+                          'labels': ['face', 'object', 'letter', 'false']}),
+            ('Orientation', {'find': (101, 103),
+                             'start': 101,
+                             'labels': ['Center', 'Left', 'Right']}),
+            ('Duration', {'find': (151, 153),
+                          'start': 151,
+                          'labels': ['500ms', '1000ms', '1500ms']}),
+            ('Task_relevance', {'find': (201, 203),
+                                'start': 201,
+                                'labels': ['Relevant target',
+                                           'Relevant non-target',
+                                           'Irrelevant']}),
+            ('Trial_ID', {'find': (111, 148)}),
+            ('Response', {'find': (255, 255),
+                          'value': 'found'}),
+            ('Response_time(s)', {'find': (255, 255),
+                                  'value': 'latency',
+                                  'optional': True})]},
+    2: {'stimulus': (1, 50),
+        'columns': [
+            ('Trial_type', {'offset': 1,
+                            'modulo': 10,
+                            'labels': ['Filler', 'Probe']}),
+            ('Stim_trigger', {}),
+            ('Stimuli_type', {'step': 20,
+                              'labels': ['Face', 'Object', 'Blank']}),
+            ('Location', {'offset': 1,
+                          'start': 60,
+                          'step': 10,
+                          'labels': ['Upper Left', 'Upper Right',
+                                     'Lower Right', 'Lower Left'],
+                          'unless': ('Stimuli_type', 'Blank')}),
+            ('Response', {'offset': 4,
+                          'start': 98,
+                          'labels': ['Seen', 'Unseen'],
+                          'only': ('Trial_type', 'Probe')}),
+            ('Response_time(s)', {'offset': 4,
+                                  'value': 'latency',
+                                  'latency_from': 3,
+                                  'only': ('Trial_type', 'Probe')})]},
+}
+
+# Compiled protocols
+decoders = {}
+
+
+class TrialDecoder:
+    '''
+    Decoder of the trials of a trigger protocol (see the module docstring),
+    checked and compiled once for all runs.
+    '''
+    
+    rule_keys = {'find', 'offset', 'value', 'latency_from', 'start', 'step',
+                 'modulo', 'labels', 'optional', 'only', 'unless'}
+    
+    def __init__(self, protocol):
+        self.stimulus = protocol['stimulus']
+        self.trial_end = protocol.get('trial_end')
+        self.max_trial_events = protocol.get('max_trial_events')
+        
+        # Check and complete column rules
+        self.columns = []
+        names = []
+        for name, rule in protocol['columns']:
+            unknown = set(rule) - self.rule_keys
+            if unknown:
+                raise ValueError("Unknown keys in the rule of column %s: %s"
+                                 % (name, sorted(unknown)))
+            if 'find' in rule and 'offset' in rule:
+                raise ValueError("Column %s has both 'find' and 'offset'"
+                                 % name)
+            rule = dict(rule)
+            rule.setdefault('value', 'code')
+            if rule['value'] not in ['code', 'found', 'latency']:
+                raise ValueError("Unknown value of column %s: %s"
+                                 % (name, rule['value']))
+            if 'labels' in rule:
+                # Categories (unique labels) and category of each label
+                rule['categories'] = list(dict.fromkeys(rule['labels']))
+                rule['label_codes'] = np.array(
+                    [rule['categories'].index(label)
+                     for label in rule['labels']])
+            for key in ['only', 'unless']:
+                if key in rule and rule[key][0] not in names:
+                    raise ValueError("Column %s depends on %s, which is not "
+                                     "a previous column" % (name, rule[key][0]))
+            self.columns.append((name, rule))
+            names.append(name)
+        
+        # Lookup tables of the trigger ranges (trigger value -> in range)
+        ranges = [self.stimulus] + [rule['find'] for name, rule in
+                                    self.columns if 'find' in rule]
+        if self.trial_end is not None:
+            ranges.append((self.trial_end, self.trial_end))
+        n_codes = max(high for low, high in ranges) + 2
+        self.tables = {}
+        for low, high in ranges:
+            table = np.zeros(n_codes, dtype=bool)
+            table[low:high + 1] = True
+            self.tables[(low, high)] = table
+    
+    def in_range(self, codes, trigger_range):
+        # Whether each trigger value is in the range (values above all the
+        # ranges use the last entry of the table, which is False)
+        table = self.tables[tuple(trigger_range)]
+        return table[np.minimum(codes, len(table) - 1)]
+    
+    def decode(self, events):
+        '''
+        Metadata table of the trials of events (one row per stimulus).
+        '''
+        codes = events[:, 2]
+        n_events = len(codes)
+        is_stim = self.in_range(codes, self.stimulus)
+        stim = np.where(is_stim)[0]
+        
+        # Find the end of each trial (end trigger, or next stimulus)
+        if self.trial_end is not None:
+            end = _next_index(self.in_range(codes, (self.trial_end,) * 2))[stim]
+            n_max = self.max_trial_events or n_events
+            missing = end - stim >= n_max
+            if np.any(missing):
+                raise ValueError(
+                    "No end of trial trigger (%s) after the stimulus at "
+                    "sample %s" % (self.trial_end,
+                                   events[stim[np.argmax(missing)], 0]))
+        else:
+            end = np.append(stim[1:], n_events)
+        
+        # Decode the columns
+        metadata = pd.DataFrame(index=np.arange(len(stim)))
+        first = {}
+        for name, rule in self.columns:
+            
+            # Get trials where the column is decoded
+            use = np.ones(len(stim), dtype=bool)
+            if 'only' in rule:
+                use &= (metadata[rule['only'][0]] == rule['only'][1]).values
+            if 'unless' in rule:
+                use &= (metadata[rule['unless'][0]] != rule['unless'][1]).values
+            
+            # Find the trigger of each trial
+            if 'find' in rule:
+                key = tuple(rule['find'])
+                if key not in first:
+                    first[key] = _next_index(self.in_range(codes, key))[stim]
+                idx = first[key]
+                found = idx < end
+            elif 'offset' in rule:
+                idx = stim + rule['offset']
+                found = idx < n_events
+            else:
+                idx = stim
+                found = np.ones(len(stim), dtype=bool)
+            
+            # Whether it was found
+            if rule['value'] == 'found':
+                metadata[name] = found & use
+                continue
+            missing = use & ~found
+            if np.any(missing) and not rule.get('optional', False):
+                raise ValueError("No trigger for column %s in the trial of "
+                                 "the stimulus at sample %s"
+                                 % (name, events[stim[np.argmax(missing)], 0]))
+            use &= found
+            idx = idx[use]
+            
+            # Get latency
+            if rule['value'] == 'latency':
+                ref = stim[use]
+                if 'latency_from' in rule:
+                    ref = ref + rule['latency_from']
+                values = pd.array([pd.NA] * len(stim), dtype='Int64')
+                values[use] = events[idx, 0] - events[ref, 0]
+                metadata[name] = values
+                continue
+            
+            # Get label (categorical, missing where not decoded)
+            values = codes[idx]
+            if 'labels' in rule:
+                label_idx = (values - rule.get('start', 0)) // rule.get('step', 1)
+                if rule.get('modulo'):
+                    label_idx %= rule['modulo']
+                bad = (label_idx < 0) | (label_idx >= len(rule['labels']))
+                if np.any(bad):
+                    raise ValueError("Unknown trigger %s for column %s"
+                                     % (values[np.argmax(bad)], name))
+                cat_codes = np.full(len(stim), -1, dtype=np.int8)
+                cat_codes[use] = rule['label_codes'][label_idx]
+                metadata[name] = pd.Categorical.from_codes(
+                    cat_codes, rule['categories'])
+            
+            # Get trigger value
+            elif np.all(use):
+                metadata[name] = values
+            else:
+                metadata[name] = pd.array([pd.NA] * len(stim), dtype='Int64')
+                metadata.loc[use, name] = values
+        
+        return metadata
+
+
+def get_decoder(experiment_id):
+    '''
+    Compiled trigger protocol of an experiment.
+    '''
+    if experiment_id not in decoders:
+        if experiment_id not in protocols:
+            raise ValueError("No trigger protocol for experiment %s"
+                             % experiment_id)
+        decoders[experiment_id] = TrialDecoder(protocols[experiment_id])
+    return decoders[experiment_id]
+
+
+def make_metadata(events, experiment_id=1):
+    '''
+    Metadata table of the trials of events (one row per stimulus), as
+    written by 04-extract_events.py. Response times are in samples.
+    '''
+    return get_decoder(experiment_id).decode(events)
+
+
+def _next_index(mask):
+    # Index of the first True at or after each position (len(mask) if none)
+    n = len(mask)
+    idx = np.where(mask, np.arange(n), n)
+    return np.minimum.accumulate(idx[::-1])[::-1]
+
+
+# =============================================================================
+# CHECK AND BENCHMARK
+# =============================================================================
+
+def metadata_loop(events, experiment_id=1):
+    '''
+    Row by row builder of the previous version of 04-extract_events.py
+    (reference for check_metadata).
+    '''
+    eve = events.copy()
+    category = ['face', 'object', 'letter', 'false']
+    orientation = ['Center', 'Left', 'Right']
+    duration = ['500ms', '1000ms', '1500ms']
+    relevance = ['Relevant target', 'Relevant non-target', 'Irrelevant']
+    trial_type = ['Filler', 'Probe']
+    stimuli_type = ['Face', 'Object', 'Blank']
+    location = ['Upper Left', 'Upper Right', 'Lower Right', 'Lower Left']
+    response = ['Seen', 'Unseen']
+    columns = [name for name, rule in protocols[experiment_id]['columns']]
+    if experiment_id == 1:
+        metadata = pd.DataFrame({}, index=np.arange(np.sum(eve[:, 2] < 81)),
+                                columns=columns)
+        k = 0
+        for i in range(eve.shape[0]):
+            if eve[i, 2] < 81:
+                t = [t for t, j in enumerate(eve[i:i + 9, 2]) if j == 97][0]
+                metadata.loc[k, 'Stim_trigger'] = eve[i, 2]
+                metadata.loc[k, 'Category'] = category[int((eve[i, 2] - 1) // 20)]
+                metadata.loc[k, 'Orientation'] = orientation[
+                    [j - 100 for j in eve[i:i + t, 2]
+                     if j in [101, 102, 103]][0] - 1]
+                metadata.loc[k, 'Duration'] = duration[
+                    [j - 150 for j in eve[i:i + t, 2]
+                     if j in [151, 152, 153]][0] - 1]
+                metadata.loc[k, 'Task_relevance'] = relevance[
+                    [j - 200 for j in eve[i:i + t, 2]
+                     if j in [201, 202, 203]][0] - 1]
+                metadata.loc[k, 'Trial_ID'] = [j for j in eve[i:i + t, 2]
+                                               if (j > 110) and (j < 149)][0]
+                metadata.loc[k, 'Response'] = \
+                    True if any(eve[i:i + t, 2] == 255) else False
+                if metadata.loc[k, 'Response'] == True:
+                    r = [r for r, j in enumerate(eve[i:i + t, 2])
+                         if j == 255][0]
+                    metadata.loc[k, 'Response_time(s)'] = eve[i + r, 0] - eve[i, 0]
+                k += 1
+    elif experiment_id == 2:
+        metadata = pd.DataFrame({}, index=np.arange(np.sum(eve[:, 2] < 51)),
+                                columns=columns)
+        k = 0
+        for i in range(eve.shape[0]):
+            if eve[i, 2] < 51:
+                metadata.loc[k, 'Stim_trigger'] = eve[i, 2]
+                t = int(eve[i + 1, 2] % 10)
+                metadata.loc[k, 'Trial_type'] = trial_type[t]
+                if eve[i, 2] == 50:
+                    metadata.loc[k, 'Stimuli_type'] = stimuli_type[2]
+                else:
+                    metadata.loc[k, 'Stimuli_type'] = stimuli_type[eve[i, 2] // 20]
+                    metadata.loc[k, 'Location'] = location[eve[i + 1, 2] // 10 - 6]
+                if t == 1:
+                    metadata.loc[k, 'Response'] = response[int(eve[i + 4, 2] - 98)]
+                    metadata.loc[k, 'Response_time(s)'] = eve[i + 4, 0] - eve[i + 3, 0]
+                k += 1
+    return metadata
+
+
+def synthetic_events(n_events=10 ** 5, experiment_id=1, seed=0):
+    '''
+    Events of a synthetic run with about n_events events, following the
+    trigger protocol of the experiment.
+    '''
+    rng = np.random.RandomState(seed)
+    trials = []
+    while sum(len(trial) for trial in trials) < n_events:
+        if experiment_id == 1:
+            # Stimulus, orientation, duration, trial ID, relevance,
+            # miniblock (sometimes), response (sometimes), end of trial
+            trial = [rng.randint(1, 81), rng.randint(101, 104),
+                     rng.randint(151, 154), rng.randint(111, 149),
+                     rng.randint(201, 204)]
+            if rng.rand() < 0.1:
+                trial.insert(1, rng.randint(161, 201))
+            if rng.rand() < 0.3:
+                trial.insert(rng.randint(1, len(trial) + 1), 255)
+            trial.append(97)
+        else:
+            # Stimulus, trial type and location, fixation, probe onset,
+            # response (probes only)
+            stim = rng.choice([rng.randint(1, 40), 50])
+            t = rng.randint(2)
+            trial = [stim, 10 * rng.randint(6, 10) + t, 51]
+            if t == 1:
+                trial += [52, rng.choice([98, 99])]
+        trials.append(trial)
+    codes = np.concatenate(trials)
+    events = np.zeros((len(codes), 3), dtype=np.int64)
+    events[:, 0] = np.cumsum(rng.randint(50, 500, len(codes)))
+    events[:, 2] = codes
+    return events
+
+
+def check_metadata(events, experiment_id=1):
+    '''
+    Check that make_metadata() writes the same csv table as the row by row
+    builder.
+    '''
+    new = make_metadata(events, experiment_id).to_csv(index=False)
+    old = metadata_loop(events, experiment_id).to_csv(index=False)
+    if new != old:
+        raise AssertionError("Metadata tables of experiment %s differ"
+                             % experiment_id)
+    print("Metadata tables of experiment %s are identical (%s events)"
+          % (experiment_id, len(events)))
+
+
+def benchmark(n_events=10 ** 5, experiment_id=1):
+    '''
+    Time make_metadata() and the row by row builder on a synthetic run.
+    '''
+    events = synthetic_events(n_events, experiment_id)
+    for name, func in [('vectorised', make_metadata),
+                       ('row by row', metadata_loop)]:
+        t0 = time.perf_counter()
+        metadata = func(events, experiment_id)
+        print("Experiment %s, %s: %s trials in %.3f s"
+              % (experiment_id, name, len(metadata), time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    for experiment_id in [1, 2]:
+        check_metadata(synthetic_events(5000, experiment_id), experiment_id)
+        benchmark(10 ** 5, experiment_id)